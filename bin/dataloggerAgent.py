@@ -1,8 +1,7 @@
 #!/usr/bin/env python2.7
-import sys, time, threading, Queue
-from itertools import groupby
+import sys, time, Queue
+import numpy
 from operator import attrgetter
-from threading import Timer
 sys.path.append(sys.path[0]+'/../lib/')
 from agent import Agent
 from datalogger import DataloggerListener
@@ -10,12 +9,17 @@ from m2fsConfig import m2fsConfig
 from SelectedConnection import SelectedSocket
 import logging
 from LoggerRecord import *
+from LoggerStore import LoggerStore, TempsRing, binTemps, recordsToArrays
 
 LOGGING_LEVEL=logging.DEBUG  #This will not have any effect if it is more agressive than the conf file
 
 DATALOGGER_VERSION_STRING='Datalogger Agent v0.1'
 POLL_AGENTS_INTERVAL=60.0
+POLL_AGENTS_TIMEOUT=5.0
+MAX_POLL_BACKOFF=16*POLL_AGENTS_INTERVAL
 READING_EXPIRE_INTERVAL=120.0
+MERGE_HOLD=10.0
+MAX_HISTORY_BINS=1000
 
 
 def logDebugInfo(logger, records):
@@ -35,6 +39,86 @@ def logDebugInfo(logger, records):
         logger.debug("Earliest: %s Latest: %s" %
                      (records[0].timeString(), records[-1].timeString()))
 
+class AgentTempPoller(object):
+    """
+    Poll other agents for temperatures through the agent's event loop
+    
+    sources is a list of (connection, query, field) tuples, field being the
+    LoggerRecord keyword the reply is reported as. Every interval poll() sends
+    the queries due concurrently as tagged requests with a deadline of
+    timeout seconds. Once all have been answered or failed it returns a single
+    LoggerRecord of the readings (or None if there were none).
+    
+    A source whose query fails (cannot connect or times out) is skipped for
+    exponentially longer, up to maxBackoff seconds, until it answers again.
+    """
+    def __init__(self, sources, logger, interval=POLL_AGENTS_INTERVAL,
+                 timeout=POLL_AGENTS_TIMEOUT, maxBackoff=MAX_POLL_BACKOFF):
+        self.sources=sources
+        self.logger=logger
+        self.interval=interval
+        self.timeout=timeout
+        self.maxBackoff=maxBackoff
+        self.nextCycle=time.time()+interval
+        self._failures=dict((field, 0) for c,q,field in sources)
+        self._retryAt=dict((field, 0) for c,q,field in sources)
+        self._outstanding=set()
+        self._readings={}
+        self._cycleTime=None
+    
+    def poll(self, now):
+        """
+        Start a cycle if one is due. Return the LoggerRecord of a cycle once it
+        completes, otherwise None.
+        """
+        if self._outstanding:
+            return None
+        if self._cycleTime is not None:
+            record=None
+            if self._readings:
+                record=LoggerRecord(self._cycleTime, **self._readings)
+            self._cycleTime=None
+            return record
+        if now >= self.nextCycle:
+            self._startCycle(now)
+        return None
+    
+    def _startCycle(self, now):
+        self._cycleTime=now
+        self.nextCycle=now+self.interval
+        self._readings={}
+        due=[s for s in self.sources if self._retryAt[s[2]] <= now]
+        self._outstanding.update(field for c,q,field in due)
+        for connection, query, field in due:
+            connection.sendMessage(query,
+                responseCallback=self._makeResponseCallback(field),
+                errorCallback=self._makeErrorCallback(field),
+                timeout=self.timeout, tagged=True)
+    
+    def _makeResponseCallback(self, field):
+        def callback(source, response):
+            self._outstanding.discard(field)
+            self._failures[field]=0
+            self._retryAt[field]=0
+            try:
+                self._readings[field]=float(response)
+            except ValueError:
+                self.logger.debug('Bad %s reading from %s: %s' %
+                                  (field, source.addr_str(), response))
+        return callback
+    
+    def _makeErrorCallback(self, field):
+        def callback(source, error):
+            self._outstanding.discard(field)
+            self._failures[field]+=1
+            backoff=min(self.interval*2**(self._failures[field]-1),
+                        self.maxBackoff)
+            self._retryAt[field]=time.time()+backoff
+            self.logger.debug('Failed to poll %s for temp, retry in %is (%s)' %
+                              (source.addr_str(), backoff, error))
+        return callback
+
+
 class DataloggerAgent(Agent):
     """
     This is the M2FS Datalogger Agent. It gatheres temperature and accelerometer
@@ -43,6 +127,8 @@ class DataloggerAgent(Agent):
     """
     def __init__(self):
         Agent.__init__(self,'DataloggerAgent')
+        #Commands are answered in order, the director may pipeline them
+        self.max_commands_per_source=16
         #Initialize the dataloggers
         self.recordQueue=Queue.Queue()
         self.dataloggerR=DataloggerListener('R','/dev/dataloggerR', self.recordQueue)
@@ -50,15 +136,23 @@ class DataloggerAgent(Agent):
         self.dataloggerB=DataloggerListener('B', '/dev/dataloggerB', self.recordQueue)
         self.dataloggerB.start()
         agent_ports=m2fsConfig.getAgentPorts()
-        self.shoeR=SelectedSocket('localhost', agent_ports['ShoeAgentR'])
-        self.shoeB=SelectedSocket('localhost', agent_ports['ShoeAgentB'])
-        self.shackHartman=SelectedSocket('localhost',
-                                         agent_ports['ShackHartmanAgent'])
-        self.logfile=open(m2fsConfig.getDataloggerLogfileName(),'a')
+        for name in ('ShoeAgentR', 'ShoeAgentB', 'ShackHartmanAgent'):
+            self.connections[name]=SelectedSocket('localhost',
+                                                  agent_ports[name])
+        self.tempPoller=AgentTempPoller([
+            (self.connections['ShoeAgentR'], 'SLITS_TEMP', 'cradleRTemp'),
+            (self.connections['ShoeAgentB'], 'SLITS_TEMP', 'cradleBTemp'),
+            (self.connections['ShackHartmanAgent'], 'TEMP', 'shackhartmanTemp')],
+            self.logger)
+        self.store=LoggerStore(m2fsConfig.getDataloggerStoreDir())
+        self.tempsRing=TempsRing()
+        self.merger=RecordMerger(hold=MERGE_HOLD)
         self.currentRecord=LoggerRecord(time.time())
         self.command_handlers.update({
             #Return a list of the temperature values
-            'TEMPS':self.TEMPS_command_handler})
+            'TEMPS':self.TEMPS_command_handler,
+            #Return temperature statistics over a time range
+            'TEMPS_HISTORY':self.TEMPS_HISTORY_command_handler})
         self.logger.setLevel(LOGGING_LEVEL)
         self.bUpdateTime=0
         self.rUpdateTime=0
@@ -80,6 +174,66 @@ class DataloggerAgent(Agent):
         """ Report the current temperatures """
         command.setReply(self.currentRecord.tempsString())
     
+    def TEMPS_HISTORY_command_handler(self, command):
+        """
+        Report temperature statistics over a time range
+        
+        TEMPS_HISTORY start end bin: start & end are unixtimes, bin is the bin
+        width in seconds. The reply is a ; delimited list of the bins with
+        records, each the bin start time (to the second) followed by space
+        delimited min:mean:max triplets for the temperatures in TEMPS order (U
+        if there were no readings in the bin). If there are no records in the
+        range the reply is None.
+        
+        At most MAX_HISTORY_BINS bins may be requested.
+        """
+        try:
+            start, end, binSize=map(float, command.string.split()[1:])
+        except ValueError:
+            self.bad_command_handler(command)
+            return
+        if not (end > start and binSize > 0):
+            self.bad_command_handler(command)
+            return
+        if (end-start)/binSize > MAX_HISTORY_BINS:
+            command.setReply('!ERROR: Too many bins, limit is %i.' %
+                             MAX_HISTORY_BINS)
+            return
+        temps=self.tempsHistory(start, end)
+        binStarts, counts, mins, means, maxs=binTemps(temps, start, binSize)
+        if not len(binStarts):
+            command.setReply('None')
+            return
+        bins=[]
+        for i, binStart in enumerate(binStarts):
+            fields=['%.0f' % binStart]
+            for c in range(mins.shape[1]):
+                if counts[i,c]:
+                    fields.append('%.4f:%.4f:%.4f' %
+                                  (mins[i,c], means[i,c], maxs[i,c]))
+                else:
+                    fields.append('U')
+            bins.append(' '.join(fields))
+        command.setReply(';'.join(bins))
+    
+    def tempsHistory(self, start, end):
+        """
+        Return a TEMPS_DTYPE array of the temperatures from start to end
+        
+        Recent rows come from the in memory ring, anything older than the ring
+        from the store.
+        """
+        temps=self.tempsRing.read(start, end)
+        oldest=self.tempsRing.oldest()
+        if start < oldest:
+            try:
+                older=self.store.readTemps(start, min(end, oldest))
+                older=older[older['unixtime'] < oldest]
+                temps=numpy.concatenate((older, temps))
+            except (IOError, OSError, ValueError), e:
+                self.logger.error('Failed to read temps history: %s' % str(e))
+        return temps
+    
     def get_status_list(self):
         """
         Return a list of two element tuples to be formatted into a status reply
@@ -88,12 +242,6 @@ class DataloggerAgent(Agent):
         """
         return [(self.get_version_string(),self.cookie)]
     
-    def runSetup(self):
-        """ execute before main loop """
-        self.queryAgentsTimer=Timer(POLL_AGENTS_INTERVAL, self.queryAgentTemps)
-        self.queryAgentsTimer.daemon=True
-        self.queryAgentsTimer.start()
-    
     def run(self):
         """
         Called once per main loop, after select & any handlers but
@@ -102,6 +250,10 @@ class DataloggerAgent(Agent):
         Grab any data from the dataloggers that is in the queues, compile it
         and add it to the database.
         """
+        #Poll the other agents for temps, their record joins the queue
+        agentRecord=self.tempPoller.poll(time.time())
+        if agentRecord is not None:
+            self.recordQueue.put(agentRecord)
         records=[]
         #Get all the new records
         try:
@@ -109,41 +261,24 @@ class DataloggerAgent(Agent):
                 records.append(self.recordQueue.get_nowait())
         except Queue.Empty:
             pass
-        #Cases
-        #1) Got nothing -> do nothing
-        #2) Got something from one source, sort them try updating current state
-        # with most recent, and log the records
-        #3) Got something from multiple sources, sort them, merge any that can
-        # be merged, update current state with most recent of each source, and
-        #log
-        if len(records)>0:
-            self.logger.debug('Have {} records'.format(len(records)))
-        logMerge=len(records) > 1
-        records.sort(key=attrgetter('unixtime'))
-        toRemove=[]
-        for minute, group in groupby(records, lambda x: int(x.unixtime)/60):
-            recordGroup=list(group)
-            #Cases:
-            # 1) One record this minute, do nothing, we will log it later
-            # 2) Multiple records this minute, attempt to merge, keep merged and
-            # any that don't merge
-            if len(recordGroup) == 1:
-                pass
-            else:
-                for record in recordGroup[1:]:
-                    try:
-                        recordGroup[0].merge(record)
-                        toRemove.append(record)
-                    except Unmergable:
-                        pass
-        if toRemove:
-            map(records.remove, toRemove)
-        if logMerge:
-            self.logger.debug('Have {} records after merging'.format(len(records)))
+        #Sort the new records, keep the live state current with those from
+        # the latest minute, and merge them into the open per minute buckets.
+        # Log the records of any minutes which have closed.
         if records:
-            logDebugInfo(self.logger, records)
-            self.updateCurrentReadingsWith(records[-1])
-            self.logRecords(records)
+            self.logger.debug('Have {} records'.format(len(records)))
+            records.sort(key=attrgetter('unixtime'))
+            for record in records:
+                self.merger.add(record)
+            latestMinute=int(records[-1].unixtime)//60
+            first=len(records)
+            while first > 0 and int(records[first-1].unixtime)//60 == latestMinute:
+                first-=1
+            for record in records[first:]:
+                self.updateCurrentReadingsWith(record)
+        closed=self.merger.flush(time.time())
+        if closed:
+            logDebugInfo(self.logger, closed)
+            self.logRecords(closed)
     
     def updateCurrentReadingsWith(self, record):
         """
@@ -203,54 +338,24 @@ class DataloggerAgent(Agent):
     
     def logRecords(self, records):
         """
-        Write all the LoggerRecords in records to the log file
+        Append all the LoggerRecords in records to the LoggerStore & the
+        in memory temperature history
+        
+        The store batches fsyncs, so a crash may lose the last few seconds.
         """
-        #with open(self.logfile,'a') as file:
         self.logger.debug('Logging {} records'.format(len(records)))
-        for r in records:
-            self.logfile.write(str(r)+'\n')
+        temps, accels=recordsToArrays(records)
+        self.tempsRing.extend(temps)
+        try:
+            self.store.appendArrays(temps, accels)
+        except IOError, e:
+            self.logger.error('Failed to log records: %s' % str(e))
     
     def _exitHook(self):
-        self.logfile.close()
-    
-    def queryAgentTemps(self):
-        try:
-            self.shoeR.connect() #in case we lost connection
-            self.shoeR.sendMessageBlocking('SLITS_TEMP')
-            cradleRTemp=float(self.shoeR.receiveMessageBlocking())
-        except IOError:
-            self.logger.debug("Failed to poll shoeR for temp")
-            cradleRTemp=None
-        except ValueError:
-            cradleRTemp=None
-        try:
-            self.shoeB.connect()
-            self.shoeB.sendMessageBlocking('SLITS_TEMP')
-            cradleBTemp=float(self.shoeB.receiveMessageBlocking())
-        except IOError:
-            self.logger.debug("Failed to poll shoeB for temp")
-            cradleBTemp=None
-        except ValueError:
-            cradleBTemp=None
-        try:
-            self.shackHartman.connect()
-            self.shackHartman.sendMessageBlocking('TEMP')
-            shTemp=float(self.shackHartman.receiveMessageBlocking())
-        except IOError:
-            self.logger.debug("Failed to poll S-H for temp")
-            shTemp=None
-        except ValueError:
-            shTemp=None
-        #Create a record and stick it in the queue
-        if not (shTemp == None and cradleBTemp==None and cradleRTemp==None):
-            self.recordQueue.put(LoggerRecord(time.time(),
-                                             shackhartmanTemp=shTemp,
-                                             cradleRTemp=cradleRTemp,
-                                             cradleBTemp=cradleBTemp))
-        #Do it again in in a few
-        self.queryAgentsTimer=Timer(POLL_AGENTS_INTERVAL, self.queryAgentTemps)
-        self.queryAgentsTimer.daemon=True
-        self.queryAgentsTimer.start()
+        closed=self.merger.flush()
+        if closed:
+            self.logRecords(closed)
+        self.store.close()
 
 if __name__=='__main__':
     agent=DataloggerAgent()
@@ -13,6 +13,15 @@ POLL_NUT_INTERVAL=15
 MIN_UPS_RUNTIME=360
 NUT_LOGIN="monitor"
 NUT_PASSWORD="1"
+#Seconds to wait for an agent to reply to a forwarded command
+AGENT_REPLY_TIMEOUT=30
+#Seconds to wait for an agent to reply to STATUS
+STATUS_DEADLINE=2.0
+#Default seconds an agent's status is reported without requerying the agent
+DEFAULT_STATUS_TTL=2.0
+#Seconds past the TTL a cached status may still be reported while it is
+# refreshed, older statuses must be refreshed before replying
+STATUS_MAX_STALE=30.0
 
 class Director(Agent):
     """
@@ -33,6 +42,13 @@ class Director(Agent):
         processing them when self.main() is called
         """
         Agent.__init__(self,'Director')
+        #The GUI may pipeline commands
+        self.max_commands_per_source=16
+        #Agent STATUS replies, keyed by connection name, as (time, reply)
+        self.statusCache={}
+        self._statusInFlight=set()
+        #STATUS commands waiting on agents, as (command, set of agents)
+        self._statusWaiters=[]
         #Fetch the agent ports
         agent_ports=m2fsConfig.getAgentPorts()
         #Galil Agents
@@ -148,7 +164,8 @@ class Director(Agent):
             #The director passes the command along to the agent.
             #
             #Authoritative command discriptions are in dataloggerAgent.py
-            'TEMPS':self.datalogger_command_handler})
+            'TEMPS':self.datalogger_command_handler,
+            'TEMPS_HISTORY':self.datalogger_command_handler})
         #Ensure stawed shutdown is disabled by default
         m2fsConfig.disableStowedShutdown()
         self.batteryState=[('Battery','Unknown')]
@@ -173,6 +190,18 @@ class Director(Agent):
         parser
         """
         return "This is the M2FS Director"
+    
+    def add_additional_cli_arguments(self):
+        """
+        Additional CLI arguments may be added by implementing this function.
+        
+        Arguments should be added as:
+        self.cli_parser.add_argument(See ArgumentParser.add_argument for syntax)
+        """
+        self.cli_parser.add_argument('--status-ttl', dest='STATUS_TTL',
+                                action='store', required=False, type=float,
+                                default=DEFAULT_STATUS_TTL,
+                                help='seconds to cache agent status replies')
 
     def get_version_string(self):
         """ Return a string with the version."""
@@ -256,81 +285,53 @@ class Director(Agent):
             bstate+='NONE'
         command.setReply('%s %s' % (rstate, bstate))
     
+    def forward_command(self, agent, command, command_string=None):
+        """
+        Pass a command along to another agent.
+        
+        The command string (or command_string, if given) is sent to the agent
+        as a tagged request so any number of commands may be in flight to the
+        agent. The response and error callbacks are the command's setReply
+        function. The command fails if the agent doesn't reply within 
+        AGENT_REPLY_TIMEOUT.
+        """
+        if command_string is None:
+            command_string=command.string
+        self.connections[agent].sendMessage(command_string,
+            responseCallback=command.setReply, errorCallback=command.setReply,
+            timeout=AGENT_REPLY_TIMEOUT, tagged=True)
+    
     def shackhartman_command_handler(self, command):
         """
         Handle commands for the Shack-Hartman system
         
-        Pass the command string along to the SH agent. The response and error
-        callbacks are the command's setReply function.
+        Pass the command string along to the SH agent.
         """
-        self.connections['ShackHartmanAgent'].sendMessage(command.string,
-            responseCallback=command.setReply, errorCallback=command.setReply)
+        self.forward_command('ShackHartmanAgent', command)
     
     def SLITS_comand_handler(self, command):
         """
         Handle commands for the fiber slit system
         
         Pass the command string along to the slit controller agent. 
-        The response callback is the command's setReply function.
-        
-        This routine implements the same functionality as
-        shackhartman_command_handler, but in a different manner.
-        Using the errorCallback is much cleaner and removes dependence on an
-        additional function, but does not provide direct control over the error
-        messages.
         """
-        try:
-            self.connections['SlitController'].connect()
-            self.connections['SlitController'].sendMessage(command.string, 
-                responseCallback=command.setReply)
-        except SelectedConnection.ConnectError, err:
-            command.setReply('ERROR: Could not establish a connection with the slit controller.')
-        except SelectedConnection.WriteError, err:
-            command.setReply('ERROR: Could not send to slit controller.')
+        self.forward_command('SlitController', command)
     
     def datalogger_command_handler(self, command):
         """
         Handle commands for the datalogging system
         
         Pass the command string along to the datalogger agent.
-        The response callback is the command's setReply function.
-        
-        This routine implements the same functionality as
-        shackhartman_command_handler, but in a different manner.
-        Using the errorCallback is much cleaner and removes dependence on an
-        additional function, but does not provide direct control over the error
-        messages.
         """
-        try:
-            self.connections['DataloggerAgent'].connect()
-            self.connections['DataloggerAgent'].sendMessage(command.string, 
-                responseCallback=command.setReply)
-        except SelectedConnection.ConnectError, err:
-            command.setReply('ERROR: Could not establish a connection with the datalogger agent.')
-        except SelectedConnection.WriteError, err:
-            command.setReply('ERROR: Could not send to datalogger agent.')
+        self.forward_command('DataloggerAgent', command)
     
     def PLUGGING_command_handler(self, command):
         """
         Handle commands for the plugging system
         
         Pass the command string along to the plug controller agent.
-        The response callback is the command's setReply function.
-        
-        This routine implements the same functionality as
-        shackhartman_command_handler, but in a different manner.
-        Using the errorCallback is much cleaner and removes dependence on an
-        additional function, but does not provide direct control over the error
-        messages.
         """
-        try:
-            self.connections['PlugController'].connect()
-            self.connections['PlugController'].sendMessage(command.string, 
-                responseCallback=command.setReply)
-        except SelectedConnection.ConnectError, err:
-            command.setReply('ERROR: Could not establish a connection with the plug controller.')
-        except SelectedConnection.WriteError, err:
-            command.setReply('ERROR: Could not send to plug controller.')
+        self.forward_command('PlugController', command)
     
     def plugmode_command_handler(self, command):
         """
@@ -349,11 +350,12 @@ class Director(Agent):
         inserted.
 
         Considering the FLS system isn't yet operational, this command is 
-        just a dummy to excersise the FLS Pickoffs
+        just a dummy to excersise the FLS Pickoffs. The reply is sent once both
+        galil agents have replied, it is an error if either does.
         
         TODO When this really matters I need to take into accout that the 
-        FLSIM OUT and FLSIM IN commands might result in an ERROR, which I would
-        need to trap a and handle. The most likely cause, which is also expected
+        FLSIM OUT and FLSIM IN commands might result in an ERROR. The most
+        likely cause, which is also expected
         behavior would be to have the instrument be entering plugmode right as
         the gratings and disperser are being reconfigured, perhaps causing the
         galils to temporarily not have a free thread to execute FLSIM.
@@ -368,49 +370,130 @@ class Director(Agent):
             command.setReply(reply)
         elif 'OFF' in command.string and 'ON' not in command.string:
             #Turn plugmode off
-            try:
-                self.connections['GalilAgentR'].sendMessage('FLSIM OUT')
-                self.connections['GalilAgentB'].sendMessage('FLSIM OUT')
-                command.setReply('OK')
-            except WriteError:
-                command.setReply('ERROR: Could not set pickoff position')
+            self._set_pickoffs(command, 'FLSIM OUT')
         elif 'ON' in command.string and 'OFF' not in command.string:
             #Turn plugmode on
-            try:
-                self.connections['GalilAgentR'].sendMessage('FLSIM IN')
-                self.connections['GalilAgentB'].sendMessage('FLSIM IN')
-                command.setReply('OK')
-            except WriteError:
-                command.setReply('ERROR: Could not set pickoff position')
+            self._set_pickoffs(command, 'FLSIM IN')
         else:
             self.bad_command_handler(command)
+    
+    def _set_pickoffs(self, command, galil_command):
+        """
+        Send galil_command to both galil agents, replying to command when both
+        have replied.
+        """
+        replies={}
+        def makeCallback(agent):
+            def callback(source, reply):
+                replies[agent]=reply
+                if len(replies)==2:
+                    if any('ERROR' in r for r in replies.values()):
+                        command.setReply('ERROR: Could not set pickoff position')
+                    else:
+                        command.setReply('OK')
+            return callback
+        for agent in ('GalilAgentR', 'GalilAgentB'):
+            callback=makeCallback(agent)
+            self.connections[agent].sendMessage(galil_command,
+                responseCallback=callback, errorCallback=callback,
+                timeout=AGENT_REPLY_TIMEOUT, tagged=True)
 
+    def status_command_handler(self, command):
+        """
+        Handle a status request
+        
+        STATUS is sent to all the agents at once, as tagged requests through
+        the main loop, each with a deadline of STATUS_DEADLINE. Agent replies 
+        are cached for STATUS_TTL seconds. A cached reply older than that is
+        still used for up to STATUS_MAX_STALE seconds more, while a refresh is 
+        requested in the background. The command is answered immediately if
+        every agent has a usable cached reply, otherwise once the missing
+        agents have replied or passed their deadline.
+        """
+        waitingOn=self.request_agent_statuses()
+        if waitingOn:
+            self._statusWaiters.append((command, waitingOn))
+        else:
+            Agent.status_command_handler(self, command)
+    
+    def _agentConnectionNames(self):
+        """ Return the names of the connections to other agents """
+        return [k for k in self.connections if not k.startswith('INCOMING')]
+    
+    def request_agent_statuses(self):
+        """
+        Request STATUS from each agent whose cached status is past its TTL
+        
+        Requests are not repeated for agents with one in flight. Return the set
+        of agents without a status recent enough to report.
+        """
+        now=time.time()
+        for name in self._agentConnectionNames():
+            cached=self.statusCache.get(name)
+            if cached and now-cached[0] < self.args.STATUS_TTL:
+                continue
+            if name in self._statusInFlight:
+                continue
+            self._statusInFlight.add(name)
+            self.connections[name].sendMessage('STATUS',
+                responseCallback=self._makeStatusCallback(name),
+                errorCallback=self._makeStatusCallback(name, error=True),
+                timeout=STATUS_DEADLINE, tagged=True)
+        #Replies may have been set synchronously (e.g. if unable to connect)
+        now=time.time()
+        return set(name for name in self._agentConnectionNames()
+                   if name not in self.statusCache or
+                   now-self.statusCache[name][0] >= (self.args.STATUS_TTL+
+                                                     STATUS_MAX_STALE))
+    
+    def _makeStatusCallback(self, name, error=False):
+        """ Return a callback which records an agent's STATUS reply """
+        def callback(source, response):
+            agentName=m2fsConfig.nameFromAddrStr(source.addr_str())
+            agentName=agentName.replace(':','_').replace(' ','_')
+            response=response.rstrip()
+            if error and 'timed out' in response:
+                response='%s:Not_Responding' % agentName
+            elif error:
+                response='%s:Offline' % agentName
+            elif response=='':
+                response='%s:Not_Responding' % agentName
+            self._statusInFlight.discard(name)
+            self.statusCache[name]=(time.time(), response)
+            self._statusReceived(name)
+        return callback
+    
+    def _statusReceived(self, name):
+        """ Answer any STATUS commands no longer waiting on any agent """
+        for waiter in self._statusWaiters[:]:
+            command, waitingOn=waiter
+            waitingOn.discard(name)
+            if not waitingOn:
+                self._statusWaiters.remove(waiter)
+                Agent.status_command_handler(self, command)
+    
     def get_status_list(self):
         """
         Report the status of all instrument subsystems
         
-        Return a list of key:value pairs plus the status responses resulting
-        from STATUS requests to each agent. If an agent doesnt respond report 
-        it's status it is listed as Offline.
+        Return a list of key:value pairs plus the cached status responses 
+        resulting from STATUS requests to each agent. If an agent didn't respond
+        its status is listed as Not_Responding, if it couldn't be reached it is
+        listed as Offline.
         TODO make the agent name reported meaningful to the end used.
         """
         status=[(self.get_version_string(),self.cookie)]
         #Get the battery backup state
         status.extend(self.batteryState)
-        #Poll all the agents for their status
-        for k, d in self.connections.items():
-            if k.startswith('INCOMING'):
-                continue
-            agentName=m2fsConfig.nameFromAddrStr(d.addr_str())
-            agentName=agentName.replace(':','_').replace(' ','_')
+        #Report the agents' statuses
+        for k in self._agentConnectionNames():
             try:
-                d.sendMessageBlocking('STATUS')
-                response=d.receiveMessageBlocking()
-            except IOError:
-                response='%s:Offline' % agentName
-            if response=='':
-                response='%s:Not_Responding' % agentName
-            status.append(response)
+                status.append(self.statusCache[k][1])
+            except KeyError:
+                agentName=m2fsConfig.nameFromAddrStr(
+                    self.connections[k].addr_str())
+                agentName=agentName.replace(':','_').replace(' ','_')
+                status.append('%s:Not_Responding' % agentName)
         return status
     
     
@@ -449,13 +532,9 @@ class Director(Agent):
         RorB,junk,args=args.partition(' ')
         galil_command=command_name+' '+args
         if RorB =='R':
-            self.connections['GalilAgentR'].sendMessage(galil_command,
-                responseCallback=command.setReply,
-                errorCallback=command.setReply)
+            self.forward_command('GalilAgentR', command, galil_command)
         elif RorB =='B':
-            self.connections['GalilAgentB'].sendMessage(galil_command,
-                responseCallback=command.setReply,
-                errorCallback=command.setReply)
+            self.forward_command('GalilAgentB', command, galil_command)
         else:
             self.bad_command_handler(command)
 
@@ -464,22 +543,8 @@ class Director(Agent):
         Handle commands for the guider system
         
         Pass the command string along to the guider agent.
-        The response callback is the command's setReply function.
-        
-        This routine implements the same functionality as
-        shackhartman_command_handler, but in a different manner.
-        Using the errorCallback is much cleaner and removes dependence on an
-        additional function, but does not provide direct control over the error
-        messages.
         """
-        try:
-            self.connections['GuiderAgent'].connect()
-            self.connections['GuiderAgent'].sendMessage(command.string,
-                responseCallback=command.setReply)
-        except SelectedConnection.ConnectError, err:
-            command.setReply('ERROR: Could not establish a connection with the guider agent.')
-        except SelectedConnection.WriteError, err:
-            command.setReply('ERROR: Could not send to guider agent.')
+        self.forward_command('GuiderAgent', command)
     
 
 if __name__=='__main__':
@@ -1,5 +1,5 @@
 #!/usr/bin/env python2.7
-import sys
+import sys, time, threading
 sys.path.append(sys.path[0]+'/../lib/')
 from agent import Agent
 from galil import GalilSerial
@@ -7,6 +7,98 @@ from galil import GalilSerial
 GALIL_AGENT_VERSION_STRING='Galil Agent v0.2'
 GALIL_AGENT_VERSION_STRING_SHORT='v0.2'
 MAX_FILTER_POS=4096
+#Axes reported by the position poller, in the order they are polled
+POSITION_AXES=('FILTER', 'LREL', 'HREL', 'HRAZ', 'FOCUS', 'GES', 'FLSIM')
+#Positions are served from the poller's snapshot while younger than this many
+# poll cycles
+POSITION_MAX_AGE_CYCLES=3
+
+class PositionPoller(threading.Thread):
+    """
+    Poll the galil for the positions of all the axes at a fixed rate
+    
+    queries is a dict of axis: the GalilSerial status query function for the
+    axis. Every interval seconds the poller runs the query of each axis in
+    POSITION_AXES, holding the galil's lock for each, and records the replies
+    with the time received in a snapshot. Queries for positions may then be
+    answered from the snapshot so the load on the galil is the same however
+    many clients poll.
+    
+    The galil computes the reported positions in its status programs (e.g.
+    encoder counts to a filter number, limit switches to IN/OUT), so the
+    status programs are run rather than reading raw axis variables.
+    
+    Calling invalidate after commanding the galil discards the snapshot,
+    including any query in progress, and starts a new cycle. callback is
+    called from the poller's thread after each cycle.
+    """
+    def __init__(self, galil, queries, interval, callback=None):
+        threading.Thread.__init__(self, name='PositionPoller')
+        self.daemon=True
+        self.galil=galil
+        self.queries=queries
+        self.interval=interval
+        self.callback=callback
+        self.lock=threading.Lock()
+        self.snapshot={}
+        self.cycles=0
+        self.maxAge=POSITION_MAX_AGE_CYCLES*interval
+        self._generation=0
+        self._wake=threading.Event()
+        self._stop=False
+    
+    def run(self):
+        while not self._stop:
+            start=time.time()
+            self._wake.clear()
+            for axis in POSITION_AXES:
+                if self._stop:
+                    return
+                with self.galil.rlock:
+                    generation=self._generation
+                    try:
+                        reply=self.queries[axis]()
+                    except Exception, e:
+                        #Keep polling whatever goes wrong
+                        reply='ERROR: '+str(e)
+                with self.lock:
+                    if generation==self._generation:
+                        self.snapshot[axis]=(reply, time.time())
+            duration=time.time()-start
+            with self.lock:
+                self.cycles+=1
+                self.maxAge=POSITION_MAX_AGE_CYCLES*max(self.interval,
+                                                        duration)
+            if self.callback:
+                self.callback()
+            self._wake.wait(max(self.interval-duration, 0))
+    
+    def stop(self):
+        """ Stop polling, returns once the poller has stopped """
+        self._stop=True
+        self._wake.set()
+        self.join()
+    
+    def invalidate(self):
+        """ Discard the snapshot and poll again now """
+        with self.lock:
+            self._generation+=1
+            self.snapshot={}
+        self._wake.set()
+    
+    def get(self, axis):
+        """ Return the last position of axis or None if stale or unknown """
+        with self.lock:
+            reply, t=self.snapshot.get(axis, (None, 0))
+            if time.time()-t < self.maxAge:
+                return reply
+            return None
+    
+    def positions(self):
+        """ Return [(axis, position, time)] of the axes in the snapshot """
+        with self.lock:
+            return [(axis,)+self.snapshot[axis] for axis in POSITION_AXES
+                    if axis in self.snapshot]
 
 class GalilAgent(Agent):
     """
@@ -17,11 +109,17 @@ class GalilAgent(Agent):
     Much of the detailed device functionality is handled by the Galil object,
     which is a subclass of SelectedSerial. See galil.py.
     
+    With --poll-rate the agent polls the positions of all the axes in the
+    background (see PositionPoller), answers position queries from the latest
+    poll, and sends the positions to clients which SUBSCRIBE POSITIONS.
+    
     For additional details please refrence the M2FS Control Systems
     document.
     """
     def __init__(self):
         Agent.__init__(self,'GalilAgent')
+        #Commands are answered in order, the director may pipeline them
+        self.max_commands_per_source=16
         #Update the list of command handlers
         self.command_handlers.update({
             #Send the command string directly to the Galil
@@ -82,7 +180,12 @@ class GalilAgent(Agent):
             #Encoder tolerance for filter elevator (feselrg)
             'FILTER_DEFTOL':self.defaults_command_handler,
             #Do a soft reset of the galil
-            'RESET':self.reset_command_handler})
+            'RESET':self.reset_command_handler,
+            #Report the positions of all the axes from the position poller
+            'POSITIONS':self.positions_command_handler,
+            #Start/stop sending POSITIONS to the client after every poll
+            'SUBSCRIBE':self.subscribe_command_handler,
+            'UNSUBSCRIBE':self.subscribe_command_handler})
         self.command_settingName_map={
             'FILTER_DEFENC 1':'filter1encoder','FILTER_DEFENC 2':'filter2encoder',
             'FILTER_DEFENC 3':'filter3encoder','FILTER_DEFENC 4':'filter4encoder',
@@ -125,6 +228,21 @@ class GalilAgent(Agent):
             'HRAZ_CALIBRATE':self.connections['galil'].calibrate_hraz,
             'GES_CALIBRATE':self.connections['galil'].calibrate_ges,
             'GES_MOVE':self.connections['galil'].nudge_ges}
+        #Start the position poller, if requested
+        self.subscribers=[]
+        self.published_cycle=0
+        self.positionPoller=None
+        if self.args.POLL_RATE > 0:
+            #Let a client subscribe directly alongside the director
+            self.max_clients=2
+            self.positionPoller=PositionPoller(self.connections['galil'],
+                self.query_commands, 1.0/self.args.POLL_RATE,
+                callback=self._wake_main_loop)
+    
+    def runSetup(self):
+        """ Start the position poller, if enabled """
+        if self.positionPoller:
+            self.positionPoller.start()
     
     def get_cli_help_string(self):
         """
@@ -149,6 +267,10 @@ class GalilAgent(Agent):
         self.cli_parser.add_argument('--device', dest='DEVICE',
                                 action='store', required=False, type=str,
                                 help='the device to control')
+        self.cli_parser.add_argument('--poll-rate', dest='POLL_RATE',
+                                action='store', required=False, type=float,
+                                help='poll the axis positions at this rate (Hz)',
+                                default=0.0)
 
     def get_version_string(self):
         """ Return a string with the version."""
@@ -197,14 +319,98 @@ class GalilAgent(Agent):
         #Grab the setting name
         settingName=self.command_settingName_map[command_name]
         #Getting or Setting?
-        if '?' in command.string:
-            command.setReply(self.connections['galil'].getDefault(settingName))
-        else:
-            command.setReply(self.connections['galil'].setDefault(settingName, args))
+        galil=self.connections['galil']
+        with galil.rlock:
+            if '?' in command.string:
+                command.setReply(galil.getDefault(settingName))
+            else:
+                command.setReply(galil.setDefault(settingName, args))
+                self._invalidate_positions()
     
     def reset_command_handler(self, command):
         """ Reset the galil """
-        command.setReply(self.connections['galil'].reset())
+        with self.connections['galil'].rlock:
+            command.setReply(self.connections['galil'].reset())
+            self._invalidate_positions()
+    
+    def _invalidate_positions(self):
+        """ Have the position poller, if running, discard its positions """
+        if self.positionPoller:
+            self.positionPoller.invalidate()
+    
+    def _positions_string(self):
+        """
+        Return the poller's positions as 'POSITIONS <time> AXIS:position ...'
+        
+        Positions follow the status syntax, spaces and colons replaced by _.
+        The time is that of the oldest position.
+        """
+        positions=self.positionPoller.positions()
+        t=min([p[2] for p in positions] or [time.time()])
+        items=['%s:%s' % (axis, position.replace(':','_').replace(' ','_'))
+               for axis, position, junk in positions]
+        return ' '.join(['POSITIONS', '%.3f' % t]+items)
+    
+    def positions_command_handler(self, command):
+        """ Report the positions of all the axes from the position poller """
+        if not self.positionPoller:
+            command.setReply('ERROR: Position polling not enabled.')
+        else:
+            command.setReply(self._positions_string())
+    
+    def subscribe_command_handler(self, command):
+        """
+        Add/remove the source of the command to/from the POSITIONS subscribers
+        
+        Subscribers are sent an unsolicited POSITIONS message (see
+        _positions_string) after each poll of the axes. They are dropped when
+        they disconnect.
+        """
+        command_name,junk,args=command.string.partition(' ')
+        if args.strip().upper()!='POSITIONS':
+            self.bad_command_handler(command)
+        elif not self.positionPoller:
+            command.setReply('ERROR: Position polling not enabled.')
+        elif command_name=='SUBSCRIBE':
+            if command.source not in self.subscribers:
+                self.subscribers.append(command.source)
+            command.setReply('OK')
+        else:
+            if command.source in self.subscribers:
+                self.subscribers.remove(command.source)
+            command.setReply('OK')
+    
+    def _run_overridden(self):
+        """
+        Keep the main loop's indefinite wait, the position poller wakes the
+        loop after each poll so run needn't be polled
+        """
+        return False
+    
+    def run(self):
+        """
+        Called once per main loop, after select & any handlers but
+            before closing out commands.
+        
+        Send the positions to the subscribers after each poll, dropping any
+        who have disconnected. The poller wakes the main loop after each poll.
+        """
+        if not self.positionPoller:
+            return
+        self.subscribers=[s for s in self.subscribers if s.isOpen()]
+        cycle=self.positionPoller.cycles
+        if cycle==self.published_cycle:
+            return
+        self.published_cycle=cycle
+        if self.subscribers:
+            message=self._positions_string()
+            for subscriber in self.subscribers:
+                subscriber.sendMessage(message)
+    
+    def _exitHook(self):
+        """ Stop the position poller before the galil is closed """
+        if self.positionPoller and self.positionPoller.is_alive():
+            self.positionPoller.stop()
     
     def _stowShutdown(self):
         """
@@ -221,6 +427,9 @@ class GalilAgent(Agent):
         
         This implementationn is a bit clunkuy, using two dicts and some string
         analysis. I've not come up with anything better and it works.
+        
+        Queries are answered from the position poller while it has a recent
+        position. Any other command invalidates the poller's positions.
         """
         command_name,junk,args=command.string.partition(' ')
         query='?' in command.string and not 'GALILRAW' in command.string
@@ -232,13 +441,21 @@ class GalilAgent(Agent):
         if query:
             if command_name not in self.query_commands:
                 self.bad_command_handler(command)
-            else:
+                return
+            if self.positionPoller:
+                reply=self.positionPoller.get(command_name)
+                if reply is not None:
+                    command.setReply(reply)
+                    return
+            with self.connections['galil'].rlock:
                 command.setReply(self.query_commands[command_name]())
         else:
             if command_name not in self.action_commands:
                 self.bad_command_handler(command)
             else:
-                command.setReply(self.action_commands[command_name](args))
+                with self.connections['galil'].rlock:
+                    command.setReply(self.action_commands[command_name](args))
+                    self._invalidate_positions()
     
 
 if __name__=='__main__':
@@ -75,6 +75,8 @@ class GuiderAgent(Agent):
     """
     def __init__(self):
         Agent.__init__(self,'GuiderAgent')
+        #Commands are answered in order, the director may pipeline them
+        self.max_commands_per_source=16
         self.focus=0
         self.commanded_position={FOCUS_CHANNEL:None, FILTER_CHANNEL:None}
         self.connections['guider']=GuiderSerial('/dev/guider', 115200, timeout=1)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python2.7
+"""
+Serve simulated M2FS hardware on pseudo-terminals
+
+Each device named is simulated on its own pseudo-terminal, and a symlink
+named for the device (e.g. galilR) is made to it in the link directory. Point
+the agents at the links, e.g. galilAgent.py --side R --device LINKDIR/galilR,
+or use /dev as the link directory (as root) to run the agents with their
+default devices. Runs until interrupted.
+
+Usage: hardwareSimulator.py [--link-dir DIR] [--latency S] [--jitter S]
+    [--drop-rate F] [--error-rate F] [--time-scale F] [--seed N] DEVICE [...]
+"""
+import sys, time, argparse, logging
+sys.path.append(sys.path[0]+'/../lib/')
+import simulators
+
+DEVICES={
+    'galilR':(simulators.GalilSimulator, {}),
+    'galilB':(simulators.GalilSimulator, {}),
+    'shoeR':(simulators.ShoeSimulator, {'side':'R'}),
+    'shoeB':(simulators.ShoeSimulator, {'side':'B'}),
+    'guider':(simulators.MaestroSimulator, {}),
+    'shLenslet':(simulators.SMCSimulator, {}),
+    'shLED':(simulators.LEDSimulator, {})}
+
+def startDevices(names, linkDir=None, **options):
+    """ Create & start the named simulators, return them """
+    devices=[]
+    for name in names:
+        deviceClass, kwargs=DEVICES[name]
+        kwargs=dict(kwargs, **options)
+        if linkDir:
+            kwargs['link']=linkDir.rstrip('/')+'/'+name
+        devices.append(deviceClass(name, **kwargs).start())
+    return devices
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='M2FS hardware simulator')
+    parser.add_argument('devices', nargs='+', choices=sorted(DEVICES),
+                        metavar='DEVICE',
+                        help='devices to simulate: '+', '.join(sorted(DEVICES)))
+    parser.add_argument('--link-dir', dest='linkDir', default=None,
+                        help='directory in which to link the devices')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0,
+                        help='reply latency (s)')
+    parser.add_argument('--jitter', dest='jitter', type=float, default=0.0,
+                        help='maximum random additional latency (s)')
+    parser.add_argument('--drop-rate', dest='dropRate', type=float,
+                        default=0.0, help='fraction of commands to drop')
+    parser.add_argument('--error-rate', dest='errorRate', type=float,
+                        default=0.0, help='fraction of commands to reject')
+    parser.add_argument('--time-scale', dest='timeScale', type=float,
+                        default=1.0, help='multiplier for motion times')
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='random seed for jitter & errors')
+    parser.add_argument('-v', dest='verbose', action='store_true',
+                        help='log dropped & rejected commands')
+    args=parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    devices=startDevices(args.devices, linkDir=args.linkDir,
+                         latency=args.latency, jitter=args.jitter,
+                         dropRate=args.dropRate, errorRate=args.errorRate,
+                         timeScale=args.timeScale, seed=args.seed)
+    for d in devices:
+        print d
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for d in devices:
+            print '%s: %s' % (d.name, d.counts)
+            d.stop()
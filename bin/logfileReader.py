@@ -7,12 +7,13 @@
 #next byte if file end != header size: record length
 #next length bytes: record
 #rinse lather repeat
-import sys
+import sys, time, argparse
 sys.path.append(sys.path[0]+'/../lib/')
 from construct import ULInt32
 import numpy as np
 
 from LoggerRecord import tempsParser, accelsParser, COMPOSITE_RECORD_LENGTH, ACCEL_RECORD_LENGTH, TEMP_RECORD_LENGTH, ACCELS_TO_GEES,N_TEMP_SENSORS
+from LoggerRecord import RECORD_DTYPES, ADXL_FIFO_LENGTH, NUM_AXES
 
 ulint32=ULInt32('f').parse
 
@@ -74,4 +75,110 @@ def parseRecord(data):
     unixtime=float(ulint32(data[-8:-4]))
     unixtime+=float(ulint32(data[-4:]) % 1000) /1000
 
-    return (unixtime, temps, accels)
\ No newline at end of file
+    return (unixtime, temps, accels)
+
+def findRecords(buf, headersize, wp, rp, eof):
+    """
+    Return an array of the offsets of the records in buf (after the length
+    byte) following the ring buffer exactly as processLogfile does.
+    
+    Stops at the first record with an unknown length, raises IOError if a
+    record runs past the end of the file.
+    """
+    starts=[]
+    pos=headersize
+    wrapped=False
+    while True:
+        if pos >= len(buf):
+            raise IOError('Record truncated in file')
+        rl=buf[pos]
+        if rl not in RECORD_DTYPES:
+            break
+        if pos+1+rl > len(buf):
+            raise IOError('Record truncated in file')
+        starts.append(pos+1)
+        pos+=1+rl
+        if pos == wp:
+            #we've read out all the valid data
+            break
+        if pos == eof and wp < rp:
+            if wrapped:
+                break
+            wrapped=True
+            pos=headersize
+    return np.array(starts, dtype=np.intp)
+
+def decodeLogfile(file):
+    """
+    Decode a logfile in bulk, returning a dict of contiguous arrays:
+    
+    unixtime    (n,) float64 time of each record, in file order
+    temps       (n,N_TEMP_SENSORS) float32 raw temperatures, NaN for records
+                    without temperatures
+    accelsIndex (m,) indices into unixtime of the records with accelerations
+    accels      (m,ADXL_FIFO_LENGTH,NUM_AXES) float32 accelerations in Gs
+    
+    The record boundaries are found in one pass over the length bytes, the
+    payloads are then gathered & decoded per record type with numpy. Composite
+    records are decoded as temps (12 bytes), accels (192 bytes), timestamp.
+    """
+    mm=np.memmap(file, dtype=np.uint8, mode='r')
+    headersize=int(mm[0])
+    wp,rp,eof=(int(x) for x in
+               np.frombuffer(mm, dtype='<u4', count=3, offset=headersize-12))
+    assert rp < eof
+    assert wp <= eof
+    assert rp >=headersize
+    assert wp >= headersize
+    assert rp!=wp
+    
+    starts=findRecords(bytearray(mm), headersize, wp, rp, eof)
+    lengths=mm[starts-1] if len(starts) else np.empty(0, dtype=np.uint8)
+    
+    n=len(starts)
+    unixtime=np.empty(n)
+    temps=np.empty((n, N_TEMP_SENSORS), dtype=np.float32)
+    temps.fill(np.nan)
+    accelParts=[]
+    for length, dtype in RECORD_DTYPES.items():
+        which=np.flatnonzero(lengths==length)
+        if not len(which):
+            continue
+        raw=mm[starts[which,np.newaxis]+np.arange(length)]
+        records=raw.view(dtype).reshape(-1)
+        unixtime[which]=(records['seconds'] +
+                         (records['millis'] % 1000)/1000.0)
+        if 'temps' in dtype.names:
+            temps[which]=records['temps']
+        if 'accels' in dtype.names:
+            accelParts.append((which, records['accels']))
+    
+    if accelParts:
+        accelsIndex=np.concatenate([w for w,a in accelParts])
+        accels=np.concatenate([a for w,a in accelParts])
+        order=np.argsort(accelsIndex, kind='mergesort')
+        accelsIndex=accelsIndex[order]
+        accels=(ACCELS_TO_GEES*accels[order]).astype(np.float32)
+    else:
+        accelsIndex=np.empty(0, dtype=np.intp)
+        accels=np.empty((0, ADXL_FIFO_LENGTH, NUM_AXES), dtype=np.float32)
+    return {'unixtime':unixtime, 'temps':temps,
+            'accelsIndex':accelsIndex, 'accels':accels}
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Decode a datalogger logfile')
+    parser.add_argument('logfile', help='SD card logfile')
+    parser.add_argument('--npz', dest='npz', default='',
+                        help='write the decoded arrays to this .npz file')
+    args=parser.parse_args()
+    t=time.time()
+    decoded=decodeLogfile(args.logfile)
+    elapsed=time.time()-t
+    unixtime=decoded['unixtime']
+    print '%i records (%i with accels) decoded in %.3f s' % (len(unixtime),
+        len(decoded['accels']), elapsed)
+    if len(unixtime):
+        print 'From %s to %s' % (time.ctime(unixtime.min()),
+                                 time.ctime(unixtime.max()))
+    if args.npz:
+        np.savez(args.npz, **decoded)
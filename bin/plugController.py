@@ -9,12 +9,19 @@ from m2fsConfig import m2fsConfig
 from fnmatch import fnmatch
 from glob import glob
 import shutil
+from multiprocessing.pool import ThreadPool
+from dirwatch import DirectoryWatcher
+from plateIndex import PlateIndex
+from collections import OrderedDict
 
 
 MAX_ID_STRING_LEN=26 #Based on christop and what the fits header can handle
 PLUG_CONTROLLER_VERSION_STRING='Plugging Controller v0.1'
 UPLOAD_CHECK_INTERVAL=5
+UPLOAD_WORKERS=2
 FILE_SIZE_LIMIT_BYTES=1048576
+PLATE_CACHE_SIZE=8
+PLATE_INDEX_FILE='.plateindex.sqlite'
 
 PLATEMANAGER_LOG_LEVEL=logging.DEBUG
 
@@ -42,18 +49,29 @@ class PlateManager(threading.Thread):
     Class for Managing database of plates
     
     Runs as a daemon thread, automatically maintaining
-    database of plates. The manager check the plate upload directory every
-    UPLOAD_CHECK_INTERVAL seconds for files, exclusive of dotfiles, README,
-    sample.plate, symlinks, & directories. If it finds any it attempts deletion
-    of those larger than 1MB or not ending in .plate (case-insensitive).
+    database of plates. The manager watches the plate upload directory for
+    files, exclusive of dotfiles, README, sample.plate, symlinks, &
+    directories, being written or moved in (see dirwatch, if inotify isn't
+    available the directory is checked every UPLOAD_CHECK_INTERVAL seconds).
+    When it finds any it attempts deletion of those larger than 1MB or not
+    ending in .plate (case-insensitive).
     
     Of the remaining files, it verifies that they are valid plates (e.g.
-    Plate(file) does not throw an exception). Valid plates are moved to the 
-    plates directory, while enforcing lowercase files names, and added to the
-    plate database (I use the term loosely). Invalid plates are moved to the
+    Plate(file) does not throw an exception) using a pool of UPLOAD_WORKERS
+    threads. Valid plates are moved to the plates directory, while enforcing
+    lowercase files names, and added to the plate database (I use the term
+    loosely) in a single update. Invalid plates are moved to the
     rejected directory and a file named platefile.reject is created with an
     explanation of why the plate was rejected. A plate with the same name as 
     an existing plate is considered invalid.
+    
+    The names, setups, and hole & fiber counts of all plates are kept in a
+    PlateIndex in the plates directory (PLATE_INDEX_FILE), which is brought
+    up to date when the thread starts and as plates are added.
+    
+    Parsed plates are kept in a PLATE_CACHE_SIZE entry LRU cache, keyed by
+    path and invalidated if the file's mtime or size change. Plates are parsed
+    without holding the lock.
     """
     def __init__(self):
         """
@@ -65,6 +83,9 @@ class PlateManager(threading.Thread):
         self.logger=logging.getLogger('PlateManager')
         self.logger.setLevel(PLATEMANAGER_LOG_LEVEL)
         self._plates={}
+        self._cache=OrderedDict()
+        self.cacheHits=0
+        self.cacheMisses=0
         self._plateDir=os.getcwd()+os.sep+m2fsConfig.getPlateDir()
         self._rejectDir=os.getcwd()+os.sep+m2fsConfig.getPlateRejectDir()
         self._uploadDir=os.getcwd()+os.sep+m2fsConfig.getPlateUploadDir()
@@ -74,6 +95,20 @@ class PlateManager(threading.Thread):
             self._plates[name]=file
         self.logger.info("Plate database initialized with %i plates" %
             len(self._plates))
+        self._index=PlateIndex(self._plateDir+PLATE_INDEX_FILE)
+    
+    def _wantUpload(self, fname):
+        """
+        Return true if fname in _uploadDir is a file we care to process
+        
+        That is any file EXCEPT: dotfiles, symlinks, README, and sample.plate.
+        Directories are excluded.
+        """
+        path=os.path.join(self._uploadDir, fname)
+        return not (fnmatch(fname, '.*') or fnmatch(fname, 'README') or
+                    fnmatch(fname, 'sample.plate') or
+                    os.path.isdir(path) or os.path.islink(path) or
+                    not os.path.exists(path))
     
     def _lsUploadDir(self):
         """
@@ -83,26 +118,53 @@ class PlateManager(threading.Thread):
         and sample.plate. It does not include directories.
         """
         try:
-            os.chdir(self._uploadDir)
-            files=os.listdir('.')
-            def filterFunc(file):
-                return not (fnmatch(file, '.*') or fnmatch(file, 'README') or
-                            fnmatch(file, 'sample.plate') or
-                            os.path.isdir(file) or os.path.islink(file))
-            files=filter(filterFunc, files)
-            return files
+            return filter(self._wantUpload, os.listdir(self._uploadDir))
         except OSError:
-            files=[]
-
+            return []
+    
+    def _categorizeUpload(self, fname):
+        """
+        Return the category of an uploaded file and, for a reject, the reason
+        
+        Returns ('good', plate), ('trash', None), or ('reject', exception).
+        See _catergorizeUploads. Safe to call from the worker pool.
+        """
+        path=os.path.join(self._uploadDir, fname)
+        try:
+            if (len(fname) < 6 or fname[-6:].lower() != '.plate' or
+                os.path.getsize(path) > FILE_SIZE_LIMIT_BYTES):
+                return ('trash', None)
+            try:
+                #Reject if plate isn't a valid plate, or plate by
+                # same name already exists, file case is ignored
+                # for name comparison. All plates are stored
+                # in lower case, so use lower for comparison
+                parsed=plate.Plate(path)
+                if os.path.exists(self._plateDir+fname.lower()):
+                    raise plate.InvalidPlate('Plate already exists.')
+                return ('good', parsed)
+            except plate.InvalidPlate, e:
+                return ('reject', e)
+            except IOError, e:
+                return ('reject', e)
+        except Exception, e:
+            import traceback
+            e=traceback.format_exception_only(type(e),e)[0][0:-1]
+            self.logger.warning(CATERGORIZE_UPLOAD_WARNING.format(
+                                file=fname,
+                                err=e))
+            return ('trash', None)
+    
     def _catergorizeUploads(self, files):
         """
         Divide files into three groups good files, trash files, & reject files
         
-        Returns a dict with keys 'good', 'trash', & 'reject'
+        Returns a dict with keys 'good', 'trash', 'reject', & 'plates'
         Values are (possibly empty) lists of:
         good: file names
         trash: file names
         reject: two element tuples containing ( file name, rejection exception)
+        and for plates a dict of good file name:parsed plate.
         
         Files are trash if they are do not end in .plate (ignoring case), 
         do not have a name, or are larger than the file size limit.
@@ -112,112 +174,155 @@ class PlateManager(threading.Thread):
         
         Files are good if they are in neither previous category, that is, they 
         are new, valid plates.
+        
+        Files are vetted concurrently by the worker pool.
         """
-        rejectFiles=[]
-        trashFiles=[]
-        goodFiles=[]
-        os.chdir(self._uploadDir)
-        for fname in files:
-            try:
-                if (len(fname) < 6 or fname[-6:].lower() != '.plate' or
-                    os.path.getsize(fname) > FILE_SIZE_LIMIT_BYTES):
-                    trashFiles.append(fname)
-                else:
-                    try:
-                        #Reject if plate isn't a valid plate, or plate by
-                        # same name already exists, file case is ignored
-                        # for name comparison. All plates are stored
-                        # in lower case, so use lower for comparison
-                        plate.Plate(fname)
-                        if os.path.exists(self._plateDir+fname.lower()):
-                            raise plate.InvalidPlate('Plate already exists.')
-                        goodFiles.append(fname)
-                    except plate.InvalidPlate, e:
-                        rejectFiles.append((fname,e))
-                    except IOError, e:
-                        rejectFiles.append((fname,e))
-            except Exception, e:
-                import traceback
-                e=traceback.format_exception_only(type(e),e)[0][0:-1]
-                self.logger.warning(CATERGORIZE_UPLOAD_WARNING.format(
-                                    file=fname,
-                                    err=e))
-                trashFiles.append(fname)
-        return {'good':goodFiles,'trash':trashFiles,'reject':rejectFiles}
+        categorized={'good':[],'trash':[],'reject':[],'plates':{}}
+        if len(files) > 1:
+            results=self._pool.map(self._categorizeUpload, files)
+        else:
+            results=map(self._categorizeUpload, files)
+        for fname, (category, reason) in zip(files, results):
+            if category=='reject':
+                categorized['reject'].append((fname, reason))
+            else:
+                categorized[category].append(fname)
+            if category=='good':
+                categorized['plates'][fname]=reason
+        return categorized
     
-    def run(self):
+    def _processUploads(self, files):
         """
-        Main loop for the plate manager thread
+        Sort files by good, trash, & reject and deal with them accordingly
         
-        Run forever, monitoring the upload directory for files, when found
-        (Barring the readme or sample plate) they are:
         1) If ending in .plate and <1MB, checked for validity and and moved to
         either the plate repository or the rejected plates directory. Valid 
         plates are also added to the database of known plates.
         2) If not ending in .plate or >1MB they are deleted.
+        """
+        if not files:
+            return
+        #Sort the uploads by good, trash, & reject
+        categorizedFiles=self._catergorizeUploads(files)
+        #Delete trash files
+        for f in categorizedFiles['trash']:
+            try:
+                os.remove(os.path.join(self._uploadDir, f))
+            except:
+                self.logger.warn('Faild to delete trash: %s' % f)
+                pass
+        #Log and move bad files to reject directory, with reason
+        for f,reason in categorizedFiles['reject']:
+            self.logger.info("%s has issue %s" % (f,str(reason)))
+            try:
+                if os.path.exists(self._rejectDir+f):
+                    os.remove(self._rejectDir+f)
+                shutil.move(os.path.join(self._uploadDir, f), self._rejectDir)
+                reasonFile=file(self._rejectDir+f+'.reject',"w")
+                reasonFile.write(str(reason))
+                reasonFile.close()
+            except Exception, e:
+                self.logger.error('Caught while rejecting plate: %s' % str(e))
+        #Move good files into plates directory, then add them to the database
+        # all at once
+        imported={}
+        for f in categorizedFiles['good']:
+            try:
+                importPath=self._plateDir+f.lower()
+                shutil.move(os.path.join(self._uploadDir, f), importPath)
+                #Store plate with name as key, fully qualified path as item
+                imported[f.lower()[:-6]]=importPath
+            except Exception, e:
+                self.logger.error('Caught while importing plate: %s' % str(e))
+                continue
+            try:
+                self._index.add(f.lower()[:-6], importPath,
+                                categorizedFiles['plates'][f])
+            except Exception, e:
+                self.logger.error('Caught while indexing plate: %s' % str(e))
+        if imported:
+            with self.lock:
+                self._plates.update(imported)
+            for name in imported:
+                self.logger.info("Plate %s added to database." % name)
+    
+    def run(self):
+        """
+        Main loop for the plate manager thread
+        
+        Run forever, processing the files in the upload directory at startup
+        and then as they arrive (Barring the readme or sample plate), see
+        _processUploads. If the watcher asks for a rescan the whole upload
+        directory is processed.
         
         TODO: add removal of directories in upload directory if we finalize
         decision not to support uploading folders on new plate files. At present
         they won't be copied, but they also won't be removed.
         """
+        with self.lock:
+            plates=self._plates.copy()
+        self._index.sync(plates)
+        self._pool=ThreadPool(UPLOAD_WORKERS)
+        watcher=DirectoryWatcher(self._uploadDir,
+                                 pollInterval=UPLOAD_CHECK_INTERVAL)
+        self.logger.info('Watching for uploads using %s' % watcher.kind)
+        files=self._lsUploadDir()
         while True:
-            #Get list of files in upload directory
-            #import pdb;pdb.set_trace()
-            files=self._lsUploadDir()
-            #Sort the uploads by good, trash, & reject
-            categorizedFiles=self._catergorizeUploads(files)
-            #Delete trash files
-            os.chdir(self._uploadDir)
-            for f in categorizedFiles['trash']:
-                try:
-                    os.remove(f)
-                except:
-                    self.logger.warn('Faild to delete trash: %s' % f)
-                    pass
-            #Log and move bad files to reject directory, with reason
-            for f,reason in categorizedFiles['reject']:
-                self.logger.info("%s has issue %s" % (f,str(reason)))
-                try:
-                    if os.path.exists(self._rejectDir+f):
-                        os.remove(self._rejectDir+f)
-                    shutil.move(f, self._rejectDir)
-                    reasonFile=file(self._rejectDir+f+'.reject',"w")
-                    reasonFile.write(str(reason))
-                    reasonFile.close()
-                except Exception, e:
-                    self.logger.error('Caught while rejecting plate: %s' % str(e))
-            #Log and move good files into plates directory, add to database
-            for f in categorizedFiles['good']:
-                try:
-                    importPath=self._plateDir+f.lower()
-                    shutil.move(f, importPath)
-                    try:
-                        self.lock.acquire(True)
-                        #Store plate with name as key, fully qualified path as item
-                        self._plates[f.lower()[:-6]]=importPath
-                        self.logger.info("Plate %s added to database." % f)
-                    except Exception, e:
-                        raise e
-                    finally:
-                        self.lock.release()
-                except Exception, e:
-                    self.logger.error('Caught while importing plate: %s' % str(e))
-            time.sleep(UPLOAD_CHECK_INTERVAL)
+            try:
+                self._processUploads(files)
+            except Exception, e:
+                self.logger.error('Caught while processing uploads: %s' % str(e))
+            arrived=watcher.wait()
+            if arrived is None:
+                files=self._lsUploadDir()
+            else:
+                files=filter(self._wantUpload, arrived)
     
     def getPlate(self, name):
-        """ Return a plate by name, raise KeyError if no such plate"""
-        self.lock.acquire(True)
+        """
+        Return a plate by name, raise KeyError if no such plate
+        
+        The plate is parsed only if it isn't cached or the file has changed.
+        Plates returned from the cache are shared and must not be modified.
+        """
+        with self.lock:
+            path=self._plates[name]
         try:
-            return plate.Plate(self._plates[name])
-        except IOError:
-            import os.path
+            stat=os.stat(path)
+            key=(stat.st_mtime, stat.st_size)
+            with self.lock:
+                cached=self._cache.pop(path, None)
+                if cached is not None and cached[0]==key:
+                    self._cache[path]=cached
+                    self.cacheHits+=1
+                    return cached[1]
+                self.cacheMisses+=1
+            parsed=plate.Plate(path)
+        except (IOError, OSError):
             err=('Platefile %s has gone missing from the disk.' %
-                 os.path.basename(self._plates[name]))
+                 os.path.basename(path))
             self.logger.error(err)
-            self._plates.pop(name)
+            with self.lock:
+                self._plates.pop(name, None)
+            self._index.remove(name)
             raise KeyError(err)
-        finally:
-            self.lock.release()
+        with self.lock:
+            self._cache[path]=(key, parsed)
+            while len(self._cache) > PLATE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return parsed
+    
+    def getCacheStats(self):
+        """ Return a tuple of the plate cache hit & miss counts """
+        with self.lock:
+            return self.cacheHits, self.cacheMisses
+    
+    def getSetupSummaries(self):
+        """
+        Return a list of (plate name, n_holes, [(setup name, n_fibers), ...])
+        for all indexed plates, without parsing any plate files
+        """
+        return self._index.setupSummaries()
     
     def getPlateNames(self):
         """ Return a list of all the plate names """
@@ -248,6 +353,8 @@ class PlugController(Agent):
     """
     def __init__(self):
         Agent.__init__(self,'PlugController')
+        #Commands are answered in order, the director may pipeline them
+        self.max_commands_per_source=16
         #Start the plate manager
         self.plateManager=PlateManager()
         self.plateManager.start()
@@ -278,13 +385,41 @@ class PlugController(Agent):
         """
         return "This is the M2FS Plugplate manager & plugging controller"
     
+    def get_status_list(self):
+        """
+        Return a list of two element tuples to be formatted into a status reply
+        
+        Report the Key:Value pairs name:cookie and the plate cache hits and
+        misses.
+        """
+        hits, misses=self.plateManager.getCacheStats()
+        return [(self.get_version_string(), self.cookie),
+                ('Plate cache', 'hits %i misses %i' % (hits, misses))]
+    
     def PLATELIST_command_handler(self, command):
         """
         Reply with a space delimited list of available plates and their setups.
         Spaces in plate names are escaped with _
         
+        PLATELIST SETUPS replies with a ; delimited list of plates, each the 
+        plate name, its hole count, and for each setup 'setup name':nfibers,
+        space delimited. This is answered from the plate index without
+        reading any plate files.
+        
         The list of available plates is maintained by the plate manager.
         """
+        arg=command.string.partition(' ')[2].strip().upper()
+        if arg == 'SETUPS':
+            summaries=[]
+            for name, nHoles, setups in self.plateManager.getSetupSummaries():
+                summary=[name.replace(' ', '_'), str(nHoles)]
+                summary+=["'%s':%i" % s for s in setups]
+                summaries.append(' '.join(summary))
+            command.setReply('; '.join(summaries)+'\n')
+            return
+        elif arg:
+            self.bad_command_handler(command)
+            return
         plateList=self.plateManager.getPlateNames()
         plateList=[ plate.replace(' ', '_') for plate in plateList]
         #\n is required to force sending of empty response if needed
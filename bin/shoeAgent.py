@@ -71,8 +71,7 @@ class ShoeSerial(SelectedConnection.SelectedSerial):
         time.sleep(SHOE_BOOT_TIME)
         #verify the firmware version
         self.sendMessageBlocking('PV')
-        response=self.receiveMessageBlocking()
-        self.receiveMessageBlocking(nBytes=1) #discard the :
+        response=self.receiveAcknowledgedReplies(1)[0][1]
         if response != EXPECTED_FIBERSHOE_INO_VERSION:
             error_message=("Incompatible Firmware, Shoe reported '%s' , expected '%s'."  %
                 (response,EXPECTED_FIBERSHOE_INO_VERSION))
@@ -174,8 +173,8 @@ class ShoeAgent(Agent):
         
         Procedure is as follows:
         Send the command string to the shoe
-        grab a singe byte from the shoe and if it isn't a : or a ? listen for
-        a \n delimeted response followed by a :.
+        Receive the :, ?, or data\r\n: reply with receiveAcknowledgedReplies,
+        the shoe uses the same framing as the galil.
         
         Return a string of the response to the commands.
         Note the : ? are not considered responses. ? gets the exception and :
@@ -186,33 +185,21 @@ class ShoeAgent(Agent):
             return ''
         #Send the command(s)
         self.connections['shoe'].sendMessageBlocking(command_string)
-        #Get the first byte from the galil, typically this will be it
-        response=self.connections['shoe'].receiveMessageBlocking(nBytes=1)
-        # 3 cases:, :, ?, or stuff followed by \r\n:
-        #case 1, command succeeds but returns nothing, return
-        if response ==':':
-            return ''
+        ack,response,raw=self.connections['shoe'].receiveAcknowledgedReplies(1)[0]
+        #command succeeded, possibly returning something
+        if ack==':':
+            return response
         #command fails
-        elif response =='?':
+        elif ack=='?':
             raise ShoeCommandNotAcknowledgedError(
                 "ERROR: Shoe did not acknowledge command '%s' (%s)" %
-                (command_string, response) )
-        #command is returning something
+                (command_string, raw) )
+        #Consider it a failure, but log it.
         else:
-            #do a blocking receive on \n
-            response=response+self.connections['shoe'].receiveMessageBlocking()
-            #...and a single byte read to grab the :
-            confByte=self.connections['shoe'].receiveMessageBlocking(nBytes=1)
-            if confByte==':':
-                return response.strip()
-            else:
-                #Consider it a failure, but log it. Add the byte to the
-                # response for logging
-                response+=confByte
-                err=("Shoe did not adhere to protocol. '%s' got '%s'" %
-                    (command_string, response))
-                self.logger.warning(err)
-                raise ShoeCommandNotAcknowledgedError('ERROR: %s' % err)
+            err=("Shoe did not adhere to protocol. '%s' got '%s'" %
+                (command_string, raw))
+            self.logger.warning(err)
+            raise ShoeCommandNotAcknowledgedError('ERROR: %s' % err)
     
     def _do_online_only_command(self, command):
         """
@@ -1,6 +1,6 @@
-import time
+import time, struct
 from construct import UBInt32, StrictRepeater, LFloat32, SLInt16, ULInt32
-from numpy import array as numpyarray
+from numpy import array as numpyarray, dtype as numpydtype, frombuffer
 
 #Temp sensor quantity and order
 N_TEMP_SENSORS=3
@@ -32,6 +32,28 @@ ACCEL_RECORD_LENGTH=TIMESTAMP_LENGTH+NUM_AXES*ACCELERATION_BYTES*ADXL_FIFO_LENGT
 TEMP_RECORD_LENGTH=TIMESTAMP_LENGTH + TEMPERATURE_BYTES*N_TEMP_SENSORS
 COMPOSITE_RECORD_LENGTH=ACCEL_RECORD_LENGTH+TEMP_RECORD_LENGTH-TIMESTAMP_LENGTH
 
+#numpy dtypes for the binary record layouts, for bulk decoding. The timestamp
+# is seconds followed by milliseconds, only the low 3 digits of which are valid
+_TIMESTAMP_FIELDS=[('seconds', '<u4'), ('millis', '<u4')]
+TEMP_RECORD_DTYPE=numpydtype([('temps', '<f4', (N_TEMP_SENSORS,))]+
+                             _TIMESTAMP_FIELDS)
+ACCEL_RECORD_DTYPE=numpydtype([('accels', '<i2', (ADXL_FIFO_LENGTH, NUM_AXES))]+
+                              _TIMESTAMP_FIELDS)
+COMPOSITE_RECORD_DTYPE=numpydtype([('temps', '<f4', (N_TEMP_SENSORS,)),
+                                   ('accels', '<i2', (ADXL_FIFO_LENGTH, NUM_AXES))]+
+                                  _TIMESTAMP_FIELDS)
+RECORD_DTYPES={TEMP_RECORD_LENGTH:TEMP_RECORD_DTYPE,
+               ACCEL_RECORD_LENGTH:ACCEL_RECORD_DTYPE,
+               COMPOSITE_RECORD_LENGTH:COMPOSITE_RECORD_DTYPE}
+
+
+#Precompiled parsers used by fromDataloggerData. The temperatures precede the
+# accelerations in a composite record.
+_TEMPS_STRUCT=struct.Struct('<%if' % N_TEMP_SENSORS)
+_TIMESTAMP_STRUCT=struct.Struct('<2I')
+_ACCELS_DTYPE=numpydtype(('<i2', (ADXL_FIFO_LENGTH, NUM_AXES)))
+_ACCELS_OFFSET={COMPOSITE_RECORD_LENGTH:TEMPERATURE_BYTES*N_TEMP_SENSORS,
+                ACCEL_RECORD_LENGTH:0}
 
 #These are constructs which take the raw binary data for the accelerations or
 # temps and parse them into lists of numbers
@@ -54,24 +76,23 @@ def fromDataloggerData(side, data):
     if side!='R' and side!='B':
         raise ValueError('Side must be R or B')
     #Parse the raw data
-    if len(data)==COMPOSITE_RECORD_LENGTH:
-        temps=tempsParser(data[0:4*N_TEMP_SENSORS+1])
-        accels=accelsParser(data[0:-8])
-    elif len(data)==ACCEL_RECORD_LENGTH:
-        temps=None
-        accels=accelsParser(data[0:-8])
-    elif len(data)==TEMP_RECORD_LENGTH:
-        temps=tempsParser(data[0:-8])
-        accels=None
+    length=len(data)
+    if length not in RECORD_DTYPES:
+        raise ValueError("Malformed Record (%i bytes)" % length)
+    if length!=ACCEL_RECORD_LENGTH:
+        temps=_TEMPS_STRUCT.unpack_from(data, 0)
     else:
-        raise ValueError("Malformed Record (%i bytes)" % len(data))
-    unixtime=float(unsigned32BitParser(data[-8:-4]))
-    unixtime+=float(unsigned32BitParser(data[-4:]) % 1000) /1000
+        temps=None
+    seconds, millis=_TIMESTAMP_STRUCT.unpack_from(data, length-TIMESTAMP_LENGTH)
+    unixtime=float(seconds)+float(millis % 1000)/1000
     #Convert the raw accelerometer data to Gs
-    if accels !=None:
-        accels=ACCELS_TO_GEES*numpyarray(accels).reshape([32,3])
+    if length in _ACCELS_OFFSET:
+        accels=ACCELS_TO_GEES*frombuffer(data, dtype=_ACCELS_DTYPE, count=1,
+                                         offset=_ACCELS_OFFSET[length])[0]
+    else:
+        accels=None
     #Extract the sensor values
-    if temps!=None:
+    if temps is not None:
         if side == 'R':
             echelleTemp=temps[ECHELLE_INDEX_R]+ECHELLE_OFFSET_R
             prismTemp=temps[PRISM_INDEX_R]+PRISM_OFFSET_R
@@ -141,13 +162,13 @@ class LoggerRecord(object):
     
     def empty(self):
         """ Return true if the record contains no data """
-        if self.shackhartmanTemp!=None:
+        if self.shackhartmanTemp is not None:
             return False
         for k in self.sideR.keys():
-            if self.sideR[k] != None:
+            if self.sideR[k] is not None:
                 return False
         for k in self.sideB.keys():
-            if self.sideB[k] != None:
+            if self.sideB[k] is not None:
                 return False
         return True
     
@@ -159,16 +180,16 @@ class LoggerRecord(object):
     
     def haveBData(self):
         for k in self.sideB.keys():
-            if self.sideB[k] != None:
+            if self.sideB[k] is not None:
                 return True
 
     def haveRData(self):
         for k in self.sideR.keys():
-            if self.sideR[k] != None:
+            if self.sideR[k] is not None:
                 return True
     
     def haveSHData(self):
-        return self.shackhartmanTemp!=None
+        return self.shackhartmanTemp is not None
 
     def rOnly(self):
         """ Return true iff the record only contains R side data """
@@ -180,19 +201,19 @@ class LoggerRecord(object):
         timestr=self.timeString()
         temps=self.tempsString()
         accels='No Accels'
-        if self.sideB['accels'] != None or self.sideR['accels'] != None:
+        if self.sideB['accels'] is not None or self.sideR['accels'] is not None:
             accels='Accels '
-        if self.sideB['accels'] != None:
+        if self.sideB['accels'] is not None:
             accels+='B'
-        if self.sideR['accels'] != None:
+        if self.sideR['accels'] is not None:
             accels+='R'
         return ' '.join([timestr, temps, accels])
 
     def accelsString(self):
         """ Return a space delimited string of acceleration values with side """
-        if self.sideB['accels'] != None:
+        if self.sideB['accels'] is not None:
             return 'B\n'+str(self.sideB['accels'])
-        elif self.sideR['accels'] != None:
+        elif self.sideR['accels'] is not None:
             return 'R\n'+str(self.sideR['accels'])
         else:
             return 'No Accels'
@@ -204,7 +225,7 @@ class LoggerRecord(object):
                self.sideR['echelleTemp'], self.sideB['echelleTemp'],
                self.sideR['prismTemp'], self.sideB['prismTemp'],
                self.sideR['loresTemp'], self.sideB['loresTemp']]
-        temps=['{:.4f}'.format(t) if t != None else 'U' for t in temps]
+        temps=['{:.4f}'.format(t) if t is not None else 'U' for t in temps]
         return ' '.join(temps)
     
     def timeString(self):
@@ -223,14 +244,16 @@ class LoggerRecord(object):
         if self.shackhartmanTemp and other.shackhartmanTemp:
             return False
         for k in self.sideR.keys():
-            if self.sideR[k] != None and other.sideR[k] != None:
+            if self.sideR[k] is not None and other.sideR[k] is not None:
                 return False
         for k in self.sideB.keys():
-            if self.sideB[k] != None and other.sideB[k] != None:
+            if self.sideB[k] is not None and other.sideB[k] is not None:
                 return False
         #Ensure both don't contain acceleration data
-        if (self.sideR['accels']!=None and other.sideB['accels']!=None or
-            self.sideB['accels']!=None and other.sideR['accels']!=None):
+        if (self.sideR['accels'] is not None and
+            other.sideB['accels'] is not None or
+            self.sideB['accels'] is not None and
+            other.sideR['accels'] is not None):
             return False
         if int(other.unixtime)/60 != int(self.unixtime)/60:
             return False
@@ -245,14 +268,59 @@ class LoggerRecord(object):
         if not force and not self.recordsMergable(other):
             raise Unmergable()
         # acceleration timestamp has priority
-        if (not force and (other.sideR['accels'] != None or
-                          other.sideB['accels'] != None)):
+        if (not force and (other.sideR['accels'] is not None or
+                          other.sideB['accels'] is not None)):
                 self.unixtime=other.unixtime
         for k,v in other.sideB.items():
-            if v != None:
+            if v is not None:
                 self.sideB[k]=v
         for k,v in other.sideR.items():
-            if v != None:
+            if v is not None:
                 self.sideR[k]=v
-        if other.shackhartmanTemp!=None:
+        if other.shackhartmanTemp is not None:
             self.shackhartmanTemp=other.shackhartmanTemp
+
+
+class RecordMerger(object):
+    """
+    Streaming merge of LoggerRecords into per minute buckets
+    
+    Each record added is merged into the first record of the bucket for its
+    minute, or kept alongside it if the two are Unmergable, so the cost of
+    adding a record does not depend on how many are pending. flush() closes
+    and returns the records of the buckets whose minute ended at least hold
+    seconds ago.
+    """
+    def __init__(self, hold=10.0):
+        self.hold=hold
+        self._buckets={}
+    
+    def __len__(self):
+        """ Return the number of open buckets """
+        return len(self._buckets)
+    
+    def add(self, record):
+        """ Merge record into the bucket for its minute """
+        minute=int(record.unixtime)//60
+        bucket=self._buckets.get(minute)
+        if bucket is None:
+            self._buckets[minute]=[record]
+            return
+        try:
+            bucket[0].merge(record)
+        except Unmergable:
+            bucket.append(record)
+    
+    def flush(self, now=None):
+        """
+        Return the records of the closed buckets, ordered by minute
+        
+        If now is None all buckets are closed.
+        """
+        closed=[m for m in self._buckets
+                if now is None or (m+1)*60+self.hold <= now]
+        closed.sort()
+        records=[]
+        for minute in closed:
+            records.extend(self._buckets.pop(minute))
+        return records
@@ -0,0 +1,324 @@
+"""
+Binary, chunked, append-only storage for datalogger records
+
+Temperatures and accelerations are written to separate files of fixed width
+little endian records so that any time range can be memory mapped straight
+into numpy structured arrays:
+
+    temps.bin   TEMPS_DTYPE   unixtime & the 9 temperatures in TEMP_COLUMNS
+                              order, NaN where a sensor had no reading
+    accels.bin  ACCELS_DTYPE  unixtime, side ('R' or 'B'), & the 32x3 FIFO of
+                              accelerations in Gs
+
+Each data file has a time index (<name>.idx, INDEX_DTYPE) holding the minimum
+and maximum unixtime of each CHUNK_RECORDS record chunk. Records needn't be
+strictly time ordered; a read only touches the chunks whose span overlaps
+the requested range.
+
+Writes are buffered and flushed, fsynced, and the index brought up to date at
+most every SYNC_INTERVAL seconds (and on close). A crash can at worst leave a
+partial trailing record, which readers ignore and the writer truncates on
+open. Index entries missing or stale after a crash are recomputed from the
+data.
+
+TempsRing keeps the most recent temperature rows in memory and binTemps
+computes min/mean/max statistics over time bins, together serving history
+queries without reading the whole store.
+"""
+import os, time
+import numpy
+from LoggerRecord import ADXL_FIFO_LENGTH, NUM_AXES
+
+TEMP_COLUMNS=('shackhartmanTemp', 'cradleRTemp', 'cradleBTemp',
+              'echelleRTemp', 'echelleBTemp', 'prismRTemp', 'prismBTemp',
+              'loresRTemp', 'loresBTemp')
+
+TEMPS_DTYPE=numpy.dtype([('unixtime', '<f8'),
+                         ('temps', '<f4', (len(TEMP_COLUMNS),))])
+ACCELS_DTYPE=numpy.dtype([('unixtime', '<f8'),
+                          ('side', 'S1'),
+                          ('accels', '<f4', (ADXL_FIFO_LENGTH, NUM_AXES))])
+INDEX_DTYPE=numpy.dtype([('tmin', '<f8'), ('tmax', '<f8')])
+
+CHUNK_RECORDS=1024
+SYNC_INTERVAL=10.0
+RING_RECORDS=8192
+
+TEMPS_FILE='temps.bin'
+ACCELS_FILE='accels.bin'
+
+
+def recordTemps(record):
+    """ Return the temperatures of a LoggerRecord in TEMP_COLUMNS order """
+    temps=[record.shackhartmanTemp,
+           record.sideR['cradleTemp'], record.sideB['cradleTemp'],
+           record.sideR['echelleTemp'], record.sideB['echelleTemp'],
+           record.sideR['prismTemp'], record.sideB['prismTemp'],
+           record.sideR['loresTemp'], record.sideB['loresTemp']]
+    return [numpy.nan if t is None else t for t in temps]
+
+
+def recordsToArrays(records):
+    """
+    Convert LoggerRecords into TEMPS_DTYPE & ACCELS_DTYPE arrays
+
+    A temps row is produced for each record with any temperature, an accels
+    row for each side of each record with accelerations.
+    """
+    temps=[]
+    accels=[]
+    for r in records:
+        row=recordTemps(r)
+        if not all(numpy.isnan(row)):
+            temps.append((r.unixtime, row))
+        for side, data in (('R', r.sideR), ('B', r.sideB)):
+            if data['accels'] is not None:
+                accels.append((r.unixtime, side, data['accels']))
+    return (numpy.array(temps, dtype=TEMPS_DTYPE),
+            numpy.array(accels, dtype=ACCELS_DTYPE))
+
+
+def chunkIndex(times, firstChunk=0):
+    """
+    Return the INDEX_DTYPE entries for times, which start at chunk firstChunk
+    """
+    nchunks=(len(times)+CHUNK_RECORDS-1)//CHUNK_RECORDS
+    index=numpy.empty(nchunks, dtype=INDEX_DTYPE)
+    if not nchunks:
+        return index
+    padded=numpy.empty(nchunks*CHUNK_RECORDS)
+    padded[len(times):]=numpy.nan
+    padded[:len(times)]=times
+    padded=padded.reshape(nchunks, CHUNK_RECORDS)
+    index['tmin']=numpy.nanmin(padded, axis=1)
+    index['tmax']=numpy.nanmax(padded, axis=1)
+    return index
+
+
+def binTemps(temps, start, binSize):
+    """
+    Compute per bin statistics of a TEMPS_DTYPE array
+    
+    Bins are binSize seconds wide starting at start. Returns a tuple of arrays
+    (binStarts, counts, mins, means, maxs) for the bins with any records. The
+    latter four are (nbins, len(TEMP_COLUMNS)); counts are of the non-NaN
+    readings and statistics are NaN where there were none.
+    """
+    ncol=len(TEMP_COLUMNS)
+    if not len(temps):
+        empty=numpy.empty((0, ncol))
+        return numpy.empty(0), numpy.empty((0, ncol), dtype=int), empty, empty, empty
+    bins=numpy.floor((temps['unixtime']-start)/binSize).astype(numpy.intp)
+    order=numpy.argsort(bins, kind='mergesort')
+    bins=bins[order]
+    values=temps['temps'][order].astype(numpy.float64)
+    firsts=numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(bins))+1))
+    valid=~numpy.isnan(values)
+    counts=numpy.add.reduceat(valid.astype(int), firsts, axis=0)
+    sums=numpy.add.reduceat(numpy.where(valid, values, 0), firsts, axis=0)
+    mins=numpy.minimum.reduceat(numpy.where(valid, values, numpy.inf),
+                                firsts, axis=0)
+    maxs=numpy.maximum.reduceat(numpy.where(valid, values, -numpy.inf),
+                                firsts, axis=0)
+    empty=counts==0
+    means=sums/numpy.maximum(counts, 1)
+    for a in (mins, means, maxs):
+        a[empty]=numpy.nan
+    return start+bins[firsts]*binSize, counts, mins, means, maxs
+
+
+class TempsRing(object):
+    """ A fixed size in memory ring of the most recent TEMPS_DTYPE rows """
+    def __init__(self, size=RING_RECORDS):
+        self._rows=numpy.zeros(size, dtype=TEMPS_DTYPE)
+        self._next=0
+        self._count=0
+    
+    def __len__(self):
+        return self._count
+    
+    def extend(self, rows):
+        """ Add rows, overwriting the oldest if full """
+        size=len(self._rows)
+        rows=rows[-size:]
+        n=len(rows)
+        first=min(n, size-self._next)
+        self._rows[self._next:self._next+first]=rows[:first]
+        self._rows[:n-first]=rows[first:]
+        self._next=(self._next+n) % size
+        self._count=min(self._count+n, size)
+    
+    def rows(self):
+        """ Return the rows in the order they were added """
+        if self._count < len(self._rows):
+            return self._rows[:self._count]
+        return numpy.concatenate((self._rows[self._next:],
+                                  self._rows[:self._next]))
+    
+    def oldest(self):
+        """ Return the earliest time in the ring, inf if empty """
+        if not self._count:
+            return numpy.inf
+        return self.rows()['unixtime'].min()
+    
+    def read(self, start, end):
+        """ Return the rows with start <= unixtime <= end """
+        rows=self.rows()
+        times=rows['unixtime']
+        return rows[(times >= start) & (times <= end)]
+
+
+class ChunkedFile(object):
+    """ A data file of fixed width records and its chunk time index """
+    def __init__(self, path, dtype):
+        self.path=path
+        self.indexPath=os.path.splitext(path)[0]+'.idx'
+        self.dtype=dtype
+
+    def count(self):
+        """ Return the number of complete records in the file """
+        try:
+            return os.path.getsize(self.path)//self.dtype.itemsize
+        except OSError:
+            return 0
+
+    def memmap(self):
+        """ Return a read only memmap of all the complete records """
+        n=self.count()
+        if n==0:
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.memmap(self.path, dtype=self.dtype, mode='r', shape=(n,))
+
+    def _storedIndex(self):
+        try:
+            return numpy.fromfile(self.indexPath, dtype=INDEX_DTYPE)
+        except (IOError, OSError, ValueError):
+            return numpy.empty(0, dtype=INDEX_DTYPE)
+
+    def index(self, data):
+        """
+        Return the chunk index for data (the memmap of the file) and the chunk
+        from which the stored index was out of date.
+
+        Only full chunks in the stored index are trusted, the final chunk and
+        any chunks beyond the stored index are recomputed.
+        """
+        nchunks=(len(data)+CHUNK_RECORDS-1)//CHUNK_RECORDS
+        stored=self._storedIndex()
+        firstStale=max(min(len(stored), nchunks)-1, 0)
+        if (firstStale+1)*CHUNK_RECORDS > len(data):
+            firstStale=max(nchunks-1, 0)
+        tail=chunkIndex(data['unixtime'][firstStale*CHUNK_RECORDS:], firstStale)
+        return numpy.concatenate((stored[:firstStale], tail)), firstStale
+
+    def writeIndex(self):
+        """ Bring the index file up to date with the data file and fsync it """
+        index, firstStale=self.index(self.memmap())
+        mode='r+b' if os.path.exists(self.indexPath) else 'wb'
+        with open(self.indexPath, mode) as f:
+            f.seek(firstStale*INDEX_DTYPE.itemsize)
+            f.write(index[firstStale:].tobytes())
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self, start=None, end=None):
+        """
+        Return the records with start <= unixtime <= end
+
+        If the records in the overlapping chunks are time ordered the result is
+        a view on the memmap, otherwise a copy.
+        """
+        data=self.memmap()
+        if not len(data):
+            return data
+        if start is None:
+            start=-numpy.inf
+        if end is None:
+            end=numpy.inf
+        index,junk=self.index(data)
+        chunks=numpy.flatnonzero((index['tmax'] >= start) &
+                                 (index['tmin'] <= end))
+        if not len(chunks):
+            return data[0:0]
+        block=data[chunks[0]*CHUNK_RECORDS:(chunks[-1]+1)*CHUNK_RECORDS]
+        times=block['unixtime']
+        if numpy.all(times[1:] >= times[:-1]):
+            lo=numpy.searchsorted(times, start, side='left')
+            hi=numpy.searchsorted(times, end, side='right')
+            return block[lo:hi]
+        return block[(times >= start) & (times <= end)]
+
+
+class LoggerStore(object):
+    """
+    Append LoggerRecords to, and read time ranges from, a store directory
+
+    See the module documentation for the file layout. A store may be opened
+    for reading by any number of processes while one process writes.
+    """
+    def __init__(self, directory, readonly=False):
+        self.directory=directory
+        self.readonly=readonly
+        self.temps=ChunkedFile(os.path.join(directory, TEMPS_FILE),
+                               TEMPS_DTYPE)
+        self.accels=ChunkedFile(os.path.join(directory, ACCELS_FILE),
+                                ACCELS_DTYPE)
+        self._files={}
+        self._lastSync=time.time()
+        if not readonly:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for column in (self.temps, self.accels):
+                f=open(column.path, 'ab')
+                #Drop any partial record left by a crash
+                complete=column.count()*column.dtype.itemsize
+                if os.fstat(f.fileno()).st_size != complete:
+                    f.truncate(complete)
+                self._files[column]=f
+
+    def append(self, records):
+        """ Append a list of LoggerRecords, syncing if SYNC_INTERVAL elapsed """
+        temps, accels=recordsToArrays(records)
+        self.appendArrays(temps, accels)
+
+    def appendArrays(self, temps, accels):
+        """ Append TEMPS_DTYPE & ACCELS_DTYPE arrays """
+        if self.readonly:
+            raise IOError('LoggerStore opened read only')
+        if len(temps):
+            self._files[self.temps].write(temps.tobytes())
+        if len(accels):
+            self._files[self.accels].write(accels.tobytes())
+        if time.time()-self._lastSync >= SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        """ Flush and fsync the data files and bring the indices up to date """
+        for column, f in self._files.items():
+            f.flush()
+            os.fsync(f.fileno())
+            column.writeIndex()
+        self._lastSync=time.time()
+
+    def close(self):
+        if self._files:
+            self.sync()
+            for f in self._files.values():
+                f.close()
+            self._files={}
+
+    def readTemps(self, start=None, end=None):
+        """ Return a TEMPS_DTYPE array of the records from start to end """
+        return self.temps.read(start, end)
+
+    def readAccels(self, start=None, end=None, side=None):
+        """
+        Return an ACCELS_DTYPE array of the records from start to end
+
+        If side is 'R' or 'B' only that side's records are returned.
+        """
+        accels=self.accels.read(start, end)
+        if side is not None:
+            accels=accels[accels['side']==side]
+        return accels
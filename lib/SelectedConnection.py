@@ -1,4 +1,5 @@
-import logging, sys, time, threading
+import logging, sys, time, threading, select
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +20,27 @@ BACKUP_TIMEOUT=0.125
 def escapeString(string):
     return string.replace('\n','\\n').replace('\r','\\r')
 
+class PendingRequest(object):
+    """
+    A message sent with sendMessage for which a response is expected
+    
+    Untagged requests are matched to responses in the order they were sent,
+    tagged requests by the request ID echoed at the start of the response.
+    An untagged request that times out is left in place as a tombstone so the
+    late response is discarded rather than given to the next request.
+    """
+    def __init__(self, message, responseCallback, errorCallback,
+                 timeout=None, requestID=None):
+        self.message=message
+        self.responseCallback=responseCallback
+        self.errorCallback=errorCallback
+        self.requestID=requestID
+        self.expired=False
+        if timeout is None:
+            self.deadline=None
+        else:
+            self.deadline=time.time()+timeout
+
 class SelectedConnection(object):
     """
     The SelectedConnection class
@@ -45,6 +67,9 @@ class SelectedConnection(object):
         the connection (that is, self) and the message received as arguments.
         See handle_read for further details.
         
+        The received callback is also called for messages that do not answer a
+        request made with sendMessage.
+        
         The sent callback is called when all of the requested message has been 
         sent. It is called with the connection (that is, self) as argument.
         the connection (that is, self) and the message received as arguments.
@@ -57,17 +82,27 @@ class SelectedConnection(object):
         error).
         
         The sent and received callbacks are called iff a message is sent or 
-        recieved. If there is an error they will not be called. """
+        recieved. If there is an error they will not be called.
+        
+        The owner of the event loop may set selectStateChangedCallback, it is
+        called with the connection as argument whenever the result of 
+        do_select_read/write/error may have changed (connect, disconnect, and
+        the output buffer filling or emptying). """
         self.rlock=threading.RLock()
         self.defaultResponseCallback=default_message_received_callback
         self.defaultSentCallback=default_message_sent_callback
         self.defaultErrorCallback=default_message_error_callabck
-        self.responseCallback=self.defaultResponseCallback
-        self.sentCallback=self.defaultSentCallback
         self.errorCallback=self.defaultErrorCallback
+        self._pending=deque()
+        self._tagged={}
+        self._lastRequestID=0
+        self._sentCallbacks=deque()
+        self._bytesQueued=0
+        self._bytesWritten=0
         self.out_buffer=''
         self.in_buffer=''
         self.messageTerminator='\n'
+        self.selectStateChangedCallback=None
     
     def __str__(self):
         """ String form of connection to make easy status reporting """
@@ -88,6 +123,11 @@ class SelectedConnection(object):
         """
         return getattr(self.connection, attr)
     
+    def _selectStateChanged(self):
+        """ Notify the event loop that select interest may have changed """
+        if self.selectStateChangedCallback is not None:
+            self.selectStateChangedCallback(self)
+    
     def connect(self):
         """
         Establish the connection.
@@ -108,6 +148,7 @@ class SelectedConnection(object):
             logger.info('Connect failed: %s' % str(e))
             self.connection=None
             raise ConnectError(str(e))
+        self._selectStateChanged()
     
     def isOpen(self):
         """ 
@@ -141,28 +182,43 @@ class SelectedConnection(object):
                     sentCallback=None,
                     responseCallback=None,
                     errorCallback=None,
-                    connect=True):
+                    connect=True,
+                    timeout=None,
+                    tagged=False):
         """
-        Place <message> in the output buffer. Null are not sent.
+        Append <message> to the output buffer. Null are not sent.
         
         Message will be be sent next time connection is selected. The message 
-        will be terminated by the _terminateMessage function.
+        will be terminated by the _terminateMessage function. Any number of
+        messages may be queued, they are sent in order.
+        
+        If given, the responseCallback will be called with self and the response
+        as arguments. Requests are pipelined: each message sent with a
+        responseCallback is placed in a FIFO and responses are matched to 
+        requests in the order they were sent. Messages which do not answer a
+        request go to the default received callback.
         
-        The responseCallback will be called upon receipt of the first
-        subsequent message with self and the messaage as arguments.
+        If tagged is true the message is prefixed with a request ID, '@<id> ',
+        and the response is matched by the ID the recipient echoes at the start
+        of its reply rather than by order. Agents echo IDs, so responses to
+        tagged requests may arrive in any order. The ID is stripped before the
+        responseCallback is called.
+        
+        If timeout is set and no response has arrived within timeout seconds
+        the errorCallback is called by expireRequests. An untagged request 
+        which times out holds its place in the FIFO so its (late) response is
+        discarded.
         
         The sentCallback will be called when the message is transmitted in full
         with self as the only argument.
         
         The errorCallback will only be called if an error occurs. It is called
         with self, and an error message starting with 'ERROR:' as arguments.
-
-        It is an error to send a message while there remains data in the output
-        buffer. If done and an errorCallback is passed that callback is called.
-        If no error callback is passed a WriteError is raised regardless of the 
-        presence of a defaultErrorHandler, which is not called. The thinking 
-        here is that code may be anticipating calls to the defaulterrorhandler 
-        comming from the previous send attempt.
+        If a responseCallback is given the errorCallback applies to that request
+        only: it is called if the request times out or the connection fails
+        before the response arrives. If no responseCallback is given the 
+        errorCallback will be used until an error or disconnect, whichever 
+        comes first. Once called the defaultErrorCallback will be restored.
         
         If the connection is not open and connect is true, an attempt will be
         made to establish a connection by the standard procedure. This is the
@@ -171,60 +227,120 @@ class SelectedConnection(object):
         WriteError is raised if there is no defaultErrorCallback or
         errorCallback.
         
-        If defined, errorCallback will be used for any errors that occur prior
-        to the responseCallback being called. If the responseCallback is not 
-        defined then it will be used until an error or disconnect, whichever 
-        comes first. Once called the defaultErrorCallback will be restored. If
-        out_buffer was not empty self.errorCallback is not updated.
-        
-        Finally, the message is placed in the output buffer and the response 
-        and message sent callbacks are updated if defined. They revert to their
-        defaults at disconnect. The sent callback will also revert to default
-        after the message is sucessfully sent, similarly the recieved after
-        the message is received.
+        The request callbacks are discarded at disconnect after their 
+        errorCallbacks are called.
         """
         with self.rlock:
-            #Check for a pending message
-            if self.out_buffer!='':
-                err=("Attempting to send '%s' on non-empty buffer '%s'" %
-                    (message, self.out_buffer))
-                err=escapeString(err)
-                logger.error(err)
-                if errorCallback is not None:
-                    errorCallback(self, 'ERROR: '+err)
-                else:
-                    raise WriteError(err)
-            #Update the error callback
-            if errorCallback is not None:
-                self.errorCallback=errorCallback
             #connect if needed
-            if connect:
-                try:
-                    self.connect()
-                except ConnectError, err:
-                    err="Unable to send '%s'" % escapeString(message)
-                    #Query state because calling resets to default (possibly None)
-                    doRaise=self.errorCallback is None
-                    self.handle_error(error=err)
-                    if doRaise:
-                        raise WriteError(err)
-            elif not self.isOpen():
-                err="Connect before sending '%s' to %s" % (message,self.addr_str())
-                err=escapeString(err)
+            try:
+                if connect:
+                    try:
+                        self.connect()
+                    except ConnectError, err:
+                        raise WriteError("Unable to send '%s'" %
+                                         escapeString(message))
+                elif not self.isOpen():
+                    err="Connect before sending '%s' to %s"
+                    raise WriteError(escapeString(err %
+                                                  (message, self.addr_str())))
+            except WriteError, err:
+                if errorCallback is not None:
+                    logger.error(str(err))
+                    errorCallback(self, 'ERROR: %s' % err)
+                    return
                 #Query state because calling resets to default (possibly None)
                 doRaise=self.errorCallback is None
-                self.handle_error(error=err)
+                self.handle_error(error=str(err))
                 if doRaise:
-                    raise WriteError(err)
+                    raise
+                return
             #Ignore empty strings
             if message=='':
                 return
             message=self._terminateMessage(message)
-            self.out_buffer=message
+            requestID=None
+            if tagged:
+                self._lastRequestID+=1
+                requestID=str(self._lastRequestID)
+                message='@%s %s' % (requestID, message)
             if responseCallback is not None:
-                self.responseCallback=responseCallback
+                request=PendingRequest(message, responseCallback, errorCallback,
+                                       timeout=timeout, requestID=requestID)
+                if requestID is None:
+                    self._pending.append(request)
+                else:
+                    self._tagged[requestID]=request
+            elif errorCallback is not None:
+                self.errorCallback=errorCallback
+            wasEmpty=self.out_buffer==''
+            self.out_buffer+=message
+            self._bytesQueued+=len(message)
             if sentCallback is not None:
-                self.sentCallback=sentCallback
+                self._sentCallbacks.append((self._bytesQueued, sentCallback))
+            if wasEmpty:
+                self._selectStateChanged()
+    
+    def hasPendingRequests(self):
+        """ Return true if any request is awaiting a response """
+        return bool(self._tagged) or any(not r.expired for r in self._pending)
+    
+    def nextRequestDeadline(self):
+        """ Return the earliest request deadline or None if there is none """
+        deadlines=[r.deadline for r in self._pending
+                   if r.deadline is not None and not r.expired]
+        deadlines.extend(r.deadline for r in self._tagged.itervalues()
+                         if r.deadline is not None)
+        if not deadlines:
+            return None
+        return min(deadlines)
+    
+    def expireRequests(self, now=None):
+        """
+        Call the errorCallback of every request past its deadline.
+        
+        Tagged requests are dropped, untagged requests are left as tombstones
+        to absorb their responses, should they ever arrive.
+        """
+        if now is None:
+            now=time.time()
+        with self.rlock:
+            expired=[]
+            for request in self._pending:
+                if (not request.expired and request.deadline is not None and
+                    request.deadline <= now):
+                    request.expired=True
+                    expired.append(request)
+            for requestID, request in self._tagged.items():
+                if request.deadline is not None and request.deadline <= now:
+                    del self._tagged[requestID]
+                    expired.append(request)
+            for request in expired:
+                err="Request '%s' to %s timed out."
+                err=escapeString(err % (request.message.rstrip('\n'),
+                                        self.addr_str()))
+                logger.error(err)
+                callback=request.errorCallback
+                request.responseCallback=None
+                request.errorCallback=None
+                if callback is not None:
+                    callback(self, 'ERROR: '+err)
+    
+    def _failPendingRequests(self, err):
+        """
+        Call the errorCallback of all pending requests and forget them.
+        
+        Return true if any errorCallback was called.
+        """
+        requests=[r for r in self._pending if not r.expired]
+        requests.extend(self._tagged.itervalues())
+        self._pending.clear()
+        self._tagged.clear()
+        called=False
+        for request in requests:
+            if request.errorCallback is not None:
+                request.errorCallback(self, err)
+                called=True
+        return called
     
     def sendMessageBlocking(self, message, connect=True):
         """
@@ -347,17 +463,21 @@ class SelectedConnection(object):
         error is a string describing the error.
         
         Log Error.
-        If an errorCallback is defined, call it with a string describing what
-        happened and set errorCallback to defaultErrorCallback
+        Call the errorCallback of every pending request with a string 
+        describing what happened. If none had an errorCallback and an
+        errorCallback is defined, call it and set errorCallback to
+        defaultErrorCallback.
         Close the connection via _disconnect.
         """
         with self.rlock:
             err="'%s' on %s." % (escapeString(str(error)), self.addr_str())
             logger.error(err)
+            called=self._failPendingRequests("ERROR: "+err)
             if self.errorCallback !=None:
                 callback=self.errorCallback
                 self.errorCallback=self.defaultErrorCallback
-                callback(self, "ERROR: "+err)
+                if not called:
+                    callback(self, "ERROR: "+err)
             self._disconnect()
     
     def _disconnect(self):
@@ -366,21 +486,23 @@ class SelectedConnection(object):
         
         Calls _implementationSpecificDisconnect to perform the disconnect.
         Trap and log any exceptions that occur.
-        Reset set, received, & error callbacks to their defaults.
+        Fail any pending requests and reset the error callback to its default.
         """
         if self.connection is None:
             return
         logger.info("%s disconnecting." % self)
         self.out_buffer=''
+        self._sentCallbacks.clear()
+        self._bytesQueued=self._bytesWritten=0
+        self._failPendingRequests("ERROR: %s disconnected." % self.addr_str())
         try:
             self._implementationSpecificDisconnect()
         except Exception, e:
             logger.error(
                 '_implementationSpecificDisconnect caused exception: %s' % str(e))
         self.connection = None
-        self.sentCallback=self.defaultSentCallback
-        self.responseCallback=self.defaultResponseCallback
         self.errorCallback=self.defaultErrorCallback
+        self._selectStateChanged()
     
     def close(self):
         """ Terminate the connection """
@@ -401,11 +523,9 @@ class SelectedConnection(object):
         Read callback for select
         
         Read with _implementationSpecificRead, appending data to in_buffer
-        If '\n' is in the in_buffer leftstrip the in_buffer through the first
-        '/n'
-        Then, if defined, call the responseCallback with the stripped data,
-        excluding the '\n', reset responseCallback and errorCallbacks to the
-        defaults
+        For each '\n' terminated message in in_buffer leftstrip the in_buffer
+        through the '\n' and dispatch the message, excluding the '\n', with
+        _dispatchResponse.
         
         If a ReadError is encountered, call error_handler
         """
@@ -414,23 +534,17 @@ class SelectedConnection(object):
                 data = self._implementationSpecificRead()
                 self.in_buffer += data
                 count=self.in_buffer.find('\n')
-                if count is not -1:
+                while count != -1 and self.connection is not None:
                     message_str=self.in_buffer[0:count+1]
                     self.in_buffer=self.in_buffer[count+1:]
                     logger.debug("Received message '%s' on %s" % 
                         (escapeString(message_str), self))
-                    if self.responseCallback:
-                        callback=self.responseCallback
-                        self.responseCallback=self.defaultResponseCallback
-                        self.errorCallback=self.defaultErrorCallback
-                        callback(self, message_str[:-1])
-                    remainingBackslashNs=self.in_buffer.count('\n')
-                    if remainingBackslashNs > 0:
-                        logger.warn('%i additional messages in buffer' % remainingBackslashNs)
-                else:
+                    self._dispatchResponse(message_str[:-1])
+                    count=self.in_buffer.find('\n')
+                if self.in_buffer:
                     msg="Handle_Read buffer @ %s: '%s'"
                     msg=msg % (time.time(), escapeString(self.in_buffer))
-                    if not self.responseCallback:
+                    if not self.defaultResponseCallback and not self._pending:
                         msg+=". No handler is defined."
                         logger.warn(msg)
                     else:
@@ -438,6 +552,40 @@ class SelectedConnection(object):
             except ReadError, err:
                 self.handle_error(err)
     
+    def _dispatchResponse(self, message):
+        """
+        Pass a received message to the callback of the request it answers
+        
+        A message beginning with '@<id> ' answers the tagged request with that
+        ID, if the ID was issued (IDs start at 1) but is no longer pending (e.g.
+        the request timed out) it is discarded.
+        Otherwise the message answers the oldest untagged request, if there is
+        one, and is discarded if that request has timed out. Any other message
+        goes to the default received callback, the error callback is reset to
+        its default.
+        """
+        if message.startswith('@'):
+            requestID, junk, response=message[1:].partition(' ')
+            request=self._tagged.pop(requestID, None)
+            if request is not None:
+                request.responseCallback(self, response)
+                return
+            if requestID.isdigit() and 0 < int(requestID) <= self._lastRequestID:
+                logger.warning("Discarding unmatched response '%s' on %s" %
+                               (escapeString(message), self))
+                return
+        if self._pending:
+            request=self._pending.popleft()
+            if request.expired:
+                logger.warning("Discarding late response '%s' on %s" %
+                               (escapeString(message), self))
+            else:
+                request.responseCallback(self, message)
+            return
+        self.errorCallback=self.defaultErrorCallback
+        if self.defaultResponseCallback:
+            self.defaultResponseCallback(self, message)
+    
     def do_select_write(self):
         """
         Return true if select should check if conncection is ready for writing.
@@ -455,8 +603,9 @@ class SelectedConnection(object):
         
         Attempt to write all of out_buffer with _implementationSpecificWrite
         If only part of buffer is sent, remove it from the buffer and move on.
-        If all of the buffer is sent and sentCallback is defined, call it with
-        self as the argument.
+        Call the sentCallback of each message sent in full with self as the 
+        argument. If all of the buffer is sent and no message had a 
+        sentCallback call the default sentCallback, if defined.
         
         If a WriteError is encountered, call error_handler
         """
@@ -473,10 +622,17 @@ class SelectedConnection(object):
                     logger.debug(msg)
                     # and remove the sent data from the buffer
                     self.out_buffer = self.out_buffer[count:]
-                    if self.sentCallback and self.out_buffer=='':
-                        callback=self.sentCallback
-                        self.sentCallback=self.defaultSentCallback
-                        callback(self)
+                    self._bytesWritten+=count
+                    if self.out_buffer=='':
+                        self._selectStateChanged()
+                    called=False
+                    while (self._sentCallbacks and
+                           self._sentCallbacks[0][0] <= self._bytesWritten):
+                        self._sentCallbacks.popleft()[1](self)
+                        called=True
+                    if (self.out_buffer=='' and not called and
+                        self.defaultSentCallback):
+                        self.defaultSentCallback(self)
             except WriteError,err:
                 self.handle_error(str(err))
     
@@ -490,6 +646,43 @@ class SelectedConnection(object):
 
 
 import serial, termios
+
+def parseAcknowledgedReplies(buf, count, start=0):
+    """
+    Split replies in the Galil acknowledgement framing from buf.
+    
+    Devices using the framing (the Galil and the fiber shoes) answer each 
+    command with ':' if accepted, '?' if rejected, or 'data\r\n:' if accepted
+    and returning data.
+    
+    Parse up to count replies from buf beginning at start. Return a tuple of a
+    list of replies and the index of the first unconsumed byte. Each reply is a
+    tuple (ack, data, raw) where ack is ':', '?', or '' if the data was not 
+    followed by a ':' (a protocol error), data is the stripped data, and raw is
+    the reply as received. Parsing stops early if buf ends partway through a
+    reply.
+    """
+    replies=[]
+    i=start
+    end=len(buf)
+    while len(replies) < count and i < end:
+        c=buf[i:i+1]
+        if c==':' or c=='?':
+            replies.append((str(c), '', str(c)))
+            i+=1
+            continue
+        j=buf.find('\n', i)
+        if j==-1 or j+1>=end:
+            break
+        raw=str(buf[i:j+2])
+        if raw[-1]==':':
+            replies.append((':', raw[:-1].strip(), raw))
+        else:
+            replies.append(('', raw[:-1].strip(), raw))
+        i=j+2
+    return replies, i
+
+
 class SelectedSerial(SelectedConnection):
     """ Serial implementation of SelectedConnection """
     def __init__(self, port, baudrate,
@@ -516,6 +709,7 @@ class SelectedSerial(SelectedConnection):
         self.port=port
         self.baudrate=baudrate
         self.timeout=timeout
+        self._rxbuf=bytearray()
         creation_message='Creating SelectedSerial: '+self.addr_str()
         logger.debug(creation_message)
         self.connection=None
@@ -553,8 +747,28 @@ class SelectedSerial(SelectedConnection):
         
         If nBytes is 0 then listen until we get a '/n' or the timeout occurs.
         
+        Data already read into the receive buffer by receiveAcknowledgedReplies
+        is returned first.
+        
         If a serial exception occurs raise ReadError.
         """
+        if self._rxbuf:
+            if nBytes==0:
+                count=self._rxbuf.find('\n')
+                if count!=-1:
+                    response=str(self._rxbuf[:count+1])
+                    del self._rxbuf[:count+1]
+                    return response
+            elif len(self._rxbuf)>=nBytes:
+                response=str(self._rxbuf[:nBytes])
+                del self._rxbuf[:nBytes]
+                return response
+            buffered=str(self._rxbuf)
+            del self._rxbuf[:]
+            if nBytes:
+                nBytes-=len(buffered)
+            return buffered+self._implementationSpecificBlockingReceive(nBytes,
+                                                                       timeout)
         saved_timeout=self.connection.timeout
         if type(timeout) in (int,float,long) and timeout>0:
             self.connection.timeout=timeout
@@ -574,19 +788,93 @@ class SelectedSerial(SelectedConnection):
     
     def _implementationSpecificConnect(self):
         """ Open a serial connection to self.port @ self.baudrate """ 
+        self._rxbuf=bytearray()
         self.connection=serial.Serial(self.port, baudrate=self.baudrate,
                 timeout=self.timeout)
     
+    def _fillReceiveBuffer(self, timeout):
+        """
+        Wait up to timeout seconds for data and append all of it to the buffer
+        
+        Return the number of bytes read, 0 on timeout. Raise ReadError if a
+        serial error occurs.
+        """
+        try:
+            readable,junk,junk=select.select([self.connection], [], [],
+                                             max(timeout, 0))
+            if not readable:
+                return 0
+            data=self.connection.read(max(self.connection.inWaiting(), 1))
+        except serial.SerialException, e:
+            raise ReadError(str(e))
+        except (select.error, IOError, OSError), e:
+            raise ReadError(str(e))
+        self._rxbuf.extend(data)
+        return len(data)
+    
+    def receiveAcknowledgedReplies(self, count, timeout=None):
+        """
+        Receive the replies to count commands sent in the Galil framing
+        
+        See parseAcknowledgedReplies for the framing and the form of the 
+        replies. All available bytes are read at once, replies are split from
+        the receive buffer as they complete. Bytes beyond the last reply are 
+        left in the buffer for the next receive.
+        
+        timeout is the time allowed between bytes, if it is not a number the 
+        default timeout, or if none, BACKUP_TIMEOUT is used. On timeout the 
+        replies received are returned, along with a final reply of 
+        ('', data, raw) holding any partial reply, which is discarded.
+        
+        If the connection is not open, an attempt will be made to establish a
+        connection. If it fails or a read error occurs handle_error is called
+        and ReadError raised.
+        """
+        if type(timeout) not in (int,float,long) or timeout<=0:
+            timeout=self.timeout if self.timeout else BACKUP_TIMEOUT
+        with self.rlock:
+            try:
+                self.connect()
+            except ConnectError, err:
+                err="Attempting to receive on %s" % str(self)
+                logger.error(err)
+                raise ReadError(err)
+            try:
+                replies=[]
+                while True:
+                    new,consumed=parseAcknowledgedReplies(self._rxbuf,
+                                                          count-len(replies))
+                    if consumed:
+                        del self._rxbuf[:consumed]
+                        replies.extend(new)
+                    if len(replies)==count:
+                        return replies
+                    if not self._fillReceiveBuffer(timeout):
+                        break
+                partial=str(self._rxbuf)
+                del self._rxbuf[:]
+                logger.warning('Receive on %s timed out with %i of %i replies' %
+                               (self.addr_str(), len(replies), count))
+                replies.append(('', partial.strip(), partial))
+                return replies
+            except ReadError, e:
+                self.handle_error(e)
+                raise e
+    
     def _implementationSpecificRead(self):
         """
         Perform a device specific read, raise ReadError if any error
         
-        Read and return all the data in waiting.
+        Read and return all the data in waiting, preceded by any data left in
+        the receive buffer.
         """
         try:
             data=self.connection.read(self.connection.inWaiting())
             if not data:
                 raise ReadError("Unexpectedly empty read")
+            if self._rxbuf:
+                data=str(self._rxbuf)+data
+                del self._rxbuf[:]
             return data
         except serial.SerialException, err:
             raise ReadError(err)
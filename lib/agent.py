@@ -2,16 +2,21 @@ import time, argparse, signal, atexit, sys, select
 import socket
 import Queue
 import logging, logging.handlers
+from collections import deque
 from command import Command
 from SelectedConnection import SelectedSocket, WriteError
 import SelectedConnection
 from m2fsConfig import m2fsConfig
+from eventloop import Poller, Waker, READ, WRITE, ERROR
 import threading
 
 SERVER_RETRY_TIME=10
 DEFAULT_LOG_LEVEL=logging.DEBUG
 SELECT_TIMEOUT=.25
 
+#Number of command reply latencies kept for the LATENCY command
+LATENCY_SAMPLES=1000
+
 MAX_ATTEMPTS=100
 
 def escapeString(string):
@@ -28,8 +33,12 @@ class Agent(object):
     the appropriate handler.
     It sends the command responses to the source of the command after the
         command has completed.
-    It runs the main event loop which uses select to read and write on all agent
-    conections, whether inbound or outbound.
+    It runs the main event loop which uses epoll (or poll/select where
+    unavailable) to read and write on all agent conections, whether inbound or
+    outbound. Connections are registered with the poller once and their
+    interest only updated when they connect, disconnect, or their output buffer
+    fills or empties. The loop sleeps until there is I/O or it is woken by a
+    worker thread completing a command or queueing a message.
     
     Agents have connections (SelectedConnections) to other entities. The 
     connections are mantained in the connections dictionary. Subclasses
@@ -39,12 +48,18 @@ class Agent(object):
     
     The inter-agent command protocol consists of \n terminated strings, the 
     first word (everything up to the first space) of which is the  command name.
+    A command may optionally be prefixed with a request ID, '@<id> ', which is
+    echoed at the start of the reply. Replies to tagged commands are sent as
+    soon as they complete, replies to untagged commands are sent in the order
+    the commands were received from the source. Agents accept up to
+    max_commands_per_source commands in flight from each connection.
     Sided commands (i.e. commands which act on the R or B side of the instrument
     have the additional constraint that the second word is either R or B. By
     convention polling commands typically have a ? as the second word (or third
     when R or B is present).
     
-    The agent supports the default commands STATUS and VERSION. Subclasses add
+    The agent supports the default commands STATUS, VERSION, and LATENCY.
+    Subclasses add
     support for additional commands by adding a command & handler pair to the
     command_handlers dictionary (e.g. 
         self.command_handlers['NEW_COMMAND']=self.NEW_COMMAND_handler_func
@@ -87,11 +102,14 @@ class Agent(object):
         Initialize the agent
         
         Set max clients to 1 (Only receive commands from one connection).
+        Set max commands per source to 1 (Subclasses may raise to accept 
+            pipelined commands).
         Create an instance cookie from the current time.
         Configure command line arguments (change defaults by overriding
         initialize_cli_parser() or add_additional_cli_arguments()
         Parse the command line arguments and place in self.args
-        Register default command handlers for STATUS and VERSION
+        Register default command handlers for STATUS, VERSION, and LATENCY
+        Create the poller & waker for the main loop.
         Define the agent name, appending SIDE if an argument
         Initialize logging.
         Start listening for connections on user supplied port. If no port 
@@ -104,12 +122,23 @@ class Agent(object):
         self.command_state={}
         self._blocked={}
         self.max_clients=1
+        self.max_commands_per_source=1
         self.cookie=str(int(time.time()))
+        self._poller=Poller()
+        self._waker=Waker()
+        self._registered={}
+        self._fd_owner={}
+        self._dirty=set()
+        self._reset=set()
+        self._muted=set()
+        self._loop_thread=None
+        self.reply_latencies=deque(maxlen=LATENCY_SAMPLES)
         self.initialize_cli_parser()
         self.args=self.cli_parser.parse_args()
         self.command_handlers={
             'STATUS':self.status_command_handler,
-            'VERSION':self.version_request_command_handler}
+            'VERSION':self.version_request_command_handler,
+            'LATENCY':self.latency_command_handler}
         if 'SIDE' in self.args:
             self.name=basename+self.args.SIDE
         else:
@@ -254,9 +283,12 @@ class Agent(object):
         This is intended to be the callback for any SelectedConnections created
         from incomming connections.
         
-        A Command is created from the received string and source.
-        If a command exists from the source log a warning and ignore the 
-            command.
+        A Command is created from the received string and source, any 
+            request ID is stripped and kept with the Command.
+        If max_commands_per_source commands exist from the source log a warning
+            and ignore the command. If the command is tagged or more than one
+            is permitted the client may be pipelining and the command is 
+            instead answered with an error to keep the replies in step.
         Otherwise add the Command to the list of commands. Then get the command
             handler from command_handlers using the first word in the message
             as a key after converting it to uppercase. Finally, call the command
@@ -266,9 +298,13 @@ class Agent(object):
             only if it doesn't will the command handler be called for a query.
         """
         #create a command object
-        command=Command(source, message_str)
-        #Verify there are no existing commands from this source, if so fail and
-        # return
+        requestID=None
+        if message_str.startswith('@'):
+            requestID,junk,message_str=message_str[1:].partition(' ')
+        command=Command(source, message_str, callback=self._wake_main_loop,
+                        requestID=requestID)
+        #Verify there aren't too many existing commands from this source, if so
+        # fail and return
         existing_from_source=filter(lambda x: x.source==source, self.commands)
         if self.getCommandName(command)=='FLUSH' and existing_from_source:
             warning="Flushing command '%s'."
@@ -278,10 +314,13 @@ class Agent(object):
                                existing_from_source[0])
             existing_from_source[0].setReply(reply)
             return
-        elif existing_from_source:
+        elif len(existing_from_source) >= self.max_commands_per_source:
             warning="Command '%s' received before command '%s' finished. Ignoring"
             warning=escapeString(warning % (message_str, existing_from_source[0]))
             self.logger.warning(warning)
+            if self.max_commands_per_source > 1 or requestID is not None:
+                self.commands.append(command)
+                command.setReply('!ERROR: Too many commands in progress.')
             return
         self.logger.info('Received command %s' % escapeString(command.string))
         self.commands.append(command)
@@ -348,6 +387,8 @@ class Agent(object):
             self.server_socket.close()
         for c in self.connections.values():
             c.close()
+        self._poller.close()
+        self._waker.close()
         time.sleep(1)
     
     def handle_connect(self):
@@ -392,46 +433,107 @@ class Agent(object):
         self.logger.error('Socket server error: "%s"' % error)
         sys.exit(1)
     
-    def update_select_maps(self, read_map, write_map, error_map):
+    def _wake_main_loop(self, *args):
         """
-        Update dictionaries for select call. 
+        Wake the main loop if called from any other thread.
         
-        always select on server reads (incomming connection) or errors (fatal)
-            with self.handle_connect and self.handle_server_error as the 
-            handlers
-        select on each of the connections for read, write, and error if the
-            connection reports it needs selecting on
-        Use the read, write, & error handlers defined by SelectedConnection
+        Used as the Command callback so replies set by worker threads go out
+        immediately.
+        """
+        if threading.current_thread() is not self._loop_thread:
+            self._waker.wake()
+    
+    def _connection_state_changed(self, connection):
+        """
+        selectStateChangedCallback for all connections
         
-        In case it isn't clear: The select maps are key value pairs of 
-            selectable_object:handler_for_when_select_indicates_object_is_ready
-            
-        Function aquires locks for all the items in the select map, if it
-        is unable to do so, it will not add an item to the map. They must all be
-        released after the select call. A list of aquired locks is returned
-        """
-        # check the server socket
-        read_map[self.server_socket] = self.handle_connect
-        error_map[self.server_socket] = self.handle_server_error
-        #check all other connections
-        locks=[]
-        for selectedconn in self.connections.values():
-            if selectedconn.rlock.acquire(False):
-                releaseLock=True
-                if selectedconn.do_select_read():
-                    read_map[selectedconn] = selectedconn.handle_read
-                    releaseLock=False
-                if selectedconn.do_select_write():
-                    write_map[selectedconn] = selectedconn.handle_write
-                    releaseLock=False
-                if selectedconn.do_select_error():
-                    error_map[selectedconn] = selectedconn.handle_error
-                    releaseLock=False
-                if releaseLock:
-                    selectedconn.rlock.release()
-                else:
-                    locks.append(selectedconn.rlock)
-        return locks
+        Mark the connection for a poller update and wake the main loop if the
+        change came from another thread.
+        """
+        if connection.connection is None:
+            self._reset.add(connection)
+        self._dirty.add(connection)
+        self._wake_main_loop()
+    
+    def _forget_connection(self, connection):
+        """ Remove connection from the poller """
+        fd=self._registered.pop(connection, None)
+        if fd is not None and self._fd_owner.get(fd) is connection:
+            self._poller.unregister(fd)
+            del self._fd_owner[fd]
+        self._dirty.discard(connection)
+        self._reset.discard(connection)
+        self._muted.discard(connection)
+        connection.selectStateChangedCallback=None
+    
+    def _register_connection(self, connection):
+        """
+        Bring the poller registration for connection up to date
+        
+        The connection's lock is aquired without blocking. If it is held (by a
+        worker thread) the connection is muted: removed from the poller until
+        a later iteration can aquire the lock. This keeps a level triggered
+        poller from spinning on a connection we are not permitted to service.
+        """
+        connection.selectStateChangedCallback=self._connection_state_changed
+        self._dirty.discard(connection)
+        old_fd=self._registered.get(connection)
+        fd, mask=None, 0
+        if connection.rlock.acquire(False):
+            try:
+                self._muted.discard(connection)
+                if connection.isOpen():
+                    fd=connection.fileno()
+                    if connection.do_select_read(): mask|=READ
+                    if connection.do_select_write(): mask|=WRITE
+                    if connection.do_select_error(): mask|=ERROR
+            finally:
+                connection.rlock.release()
+        else:
+            self._muted.add(connection)
+        #The underlying descriptor was closed (and perhaps reopened) or is
+        # going away, drop the old registration
+        if old_fd is not None and (old_fd!=fd or not mask or
+                                   connection in self._reset):
+            if self._fd_owner.get(old_fd) is connection:
+                self._poller.unregister(old_fd)
+                del self._fd_owner[old_fd]
+        self._reset.discard(connection)
+        if fd is None or not mask:
+            self._registered[connection]=None
+            return
+        #The OS may have reused the descriptor of a connection we haven't
+        # processed yet
+        previous=self._fd_owner.get(fd)
+        if previous is not None and previous is not connection:
+            self._poller.unregister(fd)
+            self._registered[previous]=None
+            self._dirty.add(previous)
+        self._poller.set(fd, mask)
+        self._fd_owner[fd]=connection
+        self._registered[connection]=fd
+    
+    def update_poller_registrations(self):
+        """
+        Register new connections and update the interest of changed ones.
+        
+        The server socket and waker are registered for reading the first time
+        through. Connections are registered when first seen and thereafter only
+        when they report a change or are muted. Connections that have been
+        removed from connections are unregistered.
+        """
+        if self.server_socket is not None:
+            self._poller.set(self.server_socket.fileno(), READ|ERROR)
+        self._poller.set(self._waker.fileno(), READ)
+        for connection in self.connections.values():
+            if (connection not in self._registered or
+                connection in self._dirty or connection in self._muted):
+                self._register_connection(connection)
+        if len(self._registered) > len(self.connections):
+            current=set(self.connections.values())
+            for connection in self._registered.keys():
+                if connection not in current:
+                    self._forget_connection(connection)
 
     def cull_dead_sockets_and_their_commands(self):
         """
@@ -447,6 +549,7 @@ class Agent(object):
         deadKeys=filter(lambda x: not self.connections[x].isOpen(), incomingKeys)
         for deadKey in deadKeys:
             deadSocket=self.connections.pop(deadKey)
+            self._forget_connection(deadSocket)
             self.logger.debug("Cull dead socket: %s" % deadSocket)
             dead_commands=filter(lambda x:x.source==deadSocket, self.commands)
             for dead_command in dead_commands:
@@ -457,21 +560,44 @@ class Agent(object):
         Return results of complete commands and cull the commands.
         
         Find all commands that are 'complete'.
-        For each command, send the reply to the source
-        Remove the command
-        """
-        completed_commands=filter(lambda x: x.state=='complete',self.commands)
-        for command in completed_commands:
+        For each command, send the reply to the source, prefixed by the
+        request ID if the command had one, attempting to write it out
+        immediately rather than waiting for the next poll. Replies to untagged
+        commands are held until all earlier untagged commands from the source
+        have been answered.
+        Remove the command and record the reply latency.
+        """
+        waiting=set()
+        for command in self.commands[:]:
+            if command.state!='complete':
+                if command.requestID is None:
+                    waiting.add(command.source)
+                continue
+            if command.requestID is None and command.source in waiting:
+                continue
             self.logger.info("Closing out command %s" % command)
             try:
-                if command.reply=='':
+                if command.requestID is not None:
+                    command.source.sendMessage('@%s %s' % (command.requestID,
+                                                          command.reply))
+                elif command.reply=='':
                     #Force sending of the empty response
                     command.source.sendMessage('\n')
                 else:
                     command.source.sendMessage(command.reply)
                 self.commands.remove(command)
             except WriteError:
-                pass
+                if command.requestID is None:
+                    waiting.add(command.source)
+                continue
+            source=command.source
+            if source.rlock.acquire(False):
+                try:
+                    if source.do_select_write():
+                        source.handle_write()
+                finally:
+                    source.rlock.release()
+            self.reply_latencies.append(time.time()-command.timestamp)
     
     def not_implemented_command_handler(self, command):
         """
@@ -493,6 +619,24 @@ class Agent(object):
         """ Handle a version request """ 
         command.setReply(self.get_version_string())
     
+    def latency_command_handler(self, command):
+        """
+        Report command reply latency statistics
+        
+        Latency is measured from receipt of a command to its reply being handed
+        to the connection, over the last LATENCY_SAMPLES commands. Reply is of
+        the form 'samples:N p50:Xms p99:Xms max:Xms'.
+        """
+        latencies=sorted(self.reply_latencies)
+        if not latencies:
+            command.setReply('samples:0')
+            return
+        def percentile(p):
+            return 1000.0*latencies[int(round(p*(len(latencies)-1)))]
+        command.setReply('samples:%i p50:%.3fms p99:%.3fms max:%.3fms' %
+                         (len(latencies), percentile(0.5), percentile(0.99),
+                          1000.0*latencies[-1]))
+    
     def status_command_handler(self,command):
         """
         Handle a status request
@@ -549,43 +693,86 @@ class Agent(object):
     
     def do_select(self):
         """
-        Select on all connections which require it.
+        Wait for and handle I/O on all connections.
         
-        First call update_select_maps to get object:handler pairs on which to
-            select for reading, writing, & errors.
-        Perform the select call
-        Call the appropriate handlers for each of the objects returned by select 
+        First call update_poller_registrations to bring the poller up to date.
+        Wait on the poller. The wait is indefinite (until I/O or a wakeup) 
+            unless run is overridden or a connection is muted, in which case
+            SELECT_TIMEOUT is used.
+        Call the appropriate handlers for each connection with events. The
+            connection lock is aquired without blocking, connections held by
+            a worker thread are muted rather than serviced.
         """
-        read_map, write_map, error_map = {}, {}, {}
-
-        #We can select on connections, but we should make sure that we lock all
-        # the connections we are going to use. To keep the main loop moving we
-        # don't want to block on any that are locked, rather we just don't
-        # select on them
-        locks=self.update_select_maps(read_map, write_map, error_map)
-        try:
-            readers, writers, errors = select.select(
-                read_map.keys(), write_map.keys(),
-                error_map.keys(), SELECT_TIMEOUT)
-        except select.error, err:
-            if err[0] != EINTR:
-                for lock in locks:
-                    lock.release()
-                raise
-        #select_end = time.time()
-        #self.logger.debug("select used %.3f s" % (select_end-select_start))
-        for reader in readers: read_map[reader]()
-        for writer in writers: write_map[writer]()
-        for error  in errors:  error_map[error]()
-        for lock in locks:
-            lock.release()
-        #self.logger.debug("select operation used %.3f s" % (time.time() - select_end))
+        self.update_poller_registrations()
+        if self._muted or self._run_overridden():
+            timeout=SELECT_TIMEOUT
+        else:
+            timeout=None
+        deadline=self._next_request_deadline()
+        if deadline is not None:
+            wait=max(deadline-time.time(), 0)
+            timeout=wait if timeout is None else min(timeout, wait)
+        events=self._poller.poll(timeout)
+        for fd, event in events:
+            if fd==self._waker.fileno():
+                self._waker.drain()
+                continue
+            if self.server_socket is not None and fd==self.server_socket.fileno():
+                if event & READ:
+                    self.handle_connect()
+                else:
+                    self.handle_server_error()
+                continue
+            connection=self._fd_owner.get(fd)
+            if connection is None:
+                continue
+            if not connection.rlock.acquire(False):
+                self._muted.add(connection)
+                continue
+            try:
+                #Errors and hangups surface as read errors
+                if event & (READ|ERROR) and connection.do_select_read():
+                    connection.handle_read()
+                if event & WRITE and connection.do_select_write():
+                    connection.handle_write()
+                if (event & ERROR and not event & READ and
+                    connection.do_select_error()):
+                    connection.handle_error()
+            finally:
+                connection.rlock.release()
+    
+    def _next_request_deadline(self):
+        """ Return the earliest deadline of any request made on connections """
+        deadlines=[c.nextRequestDeadline() for c in self.connections.values()]
+        deadlines=[d for d in deadlines if d is not None]
+        if not deadlines:
+            return None
+        return min(deadlines)
+    
+    def expire_requests(self):
+        """
+        Time out requests made on connections which are past their deadline
+        
+        Connections held by a worker thread are skipped until free.
+        """
+        now=time.time()
+        for connection in self.connections.values():
+            if connection.rlock.acquire(False):
+                try:
+                    connection.expireRequests(now)
+                finally:
+                    connection.rlock.release()
+    
+    def _run_overridden(self):
+        """ Return true if a subclass implements run and needs polling """
+        return type(self).run.im_func is not Agent.run.im_func
     
     def run(self):
         """
         Called once per main loop, after select & any handlers but
             before closing out commands.
-        Implement in subclass
+        Implement in subclass. If implemented the main loop will wake at least
+        every SELECT_TIMEOUT seconds.
         """
         pass
     
@@ -792,28 +979,33 @@ class Agent(object):
         
         In the main loop:
         
-        Then do_select is run, which checks each connection to see
-        if it needs reading, writing, or checking for errors. It then selects
-        on those connections, finally executing the read, write, or error 
+        Then do_select is run, which updates the poller registration of any
+        connection that may need reading, writing, or checking for errors. It
+        then waits on the poller, finally executing the read, write, or error 
         callbacks for each connected as indicated. For details of what these
         handlers do, see SelectedConnection. In essence they grab received data
         into an internal buffer until some criterion is met; transmit any
         pending data, & deal with an error, respectively.
+        Next, requests sent on connections that have passed their deadline are
+        timed out, see SelectedConnection.sendMessage.
         Next, any dead socket conectionions are dropped along with all commands
         received from those connections. Note that commands can only arrive from
         a connections with a key that starts with INCOMING. Also note that
         the dropped commands(') callback(s) will already have been executed.
         Finally, the loop closes out any completed commands. Essentially this
-        means taking the command response and sending it to the source. Note 
-        the data isn't actually sent until the next do_select call, at the
-        earliest
+        means taking the command response and sending it to the source. The
+        reply is written immediately if the connection will take it, any
+        remainder goes out on the next do_select call.
         """
         self.runSetup()
         if self.PORT is None:
             self.runOnce()
+        self._loop_thread=threading.current_thread()
         while True:
             self.do_select()
             
+            self.expire_requests()
+            
             self.run()
             
             #log commands
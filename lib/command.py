@@ -6,10 +6,11 @@ def escapeString(string):
 class Command:
     def __init__(self, source, command_string,
                  callback=None, state='recieved',
-                 replyRequired=True, reply=None):
+                 replyRequired=True, reply=None, requestID=None):
         self.timestamp=time.time()
         self.source=source
         self.string=command_string
+        self.requestID=requestID
         self.callback=callback
         self.state=state
         self.replyRequired=replyRequired
@@ -33,3 +34,5 @@ class Command:
         with self._lock:
             self.reply=reply
             self.state='complete'
+        if self.callback is not None:
+            self.callback(self)
@@ -0,0 +1,132 @@
+"""
+Watch a directory for files which have finished being written or moved in
+
+On Linux inotify is used (through ctypes, so no extra package is needed) and
+wait() sleeps in the kernel until a file is closed after writing or moved into
+the directory. Elsewhere, or if inotify can't be set up, wait() falls back to
+sleeping for the poll interval and asking the caller to rescan.
+"""
+import os, errno, select, struct, time, ctypes, ctypes.util, logging
+
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_TO=0x00000080
+IN_Q_OVERFLOW=0x00004000
+IN_IGNORED=0x00008000
+IN_ISDIR=0x40000000
+IN_NONBLOCK=os.O_NONBLOCK
+IN_CLOEXEC=0o2000000
+
+_EVENT_HEADER=struct.Struct('iIII')
+_READ_SIZE=64*1024
+
+logger=logging.getLogger('dirwatch')
+
+def _loadLibc():
+    try:
+        libc=ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                         use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc=_loadLibc()
+
+
+class DirectoryWatcher(object):
+    """
+    Report files closed after writing or moved into a directory
+
+    wait() returns a list of the file names which have arrived, or None if
+    the caller should rescan the entire directory: when polling or after the
+    kernel event queue overflowed. If the watch is lost (e.g. the directory
+    is removed) the watcher falls back to polling. kind is 'inotify' or
+    'poll'.
+    """
+    def __init__(self, path, pollInterval=5.0):
+        self.path=path
+        self.pollInterval=pollInterval
+        self._fd=None
+        self.kind='poll'
+        if _libc is None:
+            return
+        fd=_libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if fd < 0:
+            logger.warning('inotify unavailable (%s), polling %s' %
+                           (os.strerror(ctypes.get_errno()), path))
+            return
+        wd=_libc.inotify_add_watch(fd, path, IN_CLOSE_WRITE|IN_MOVED_TO)
+        if wd < 0:
+            logger.warning('Could not watch %s (%s), polling' %
+                           (path, os.strerror(ctypes.get_errno())))
+            os.close(fd)
+            return
+        self._fd=fd
+        self.kind='inotify'
+
+    def fileno(self):
+        """ Return the inotify descriptor, None if polling """
+        return self._fd
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for files to arrive
+
+        Returns a list of file names (an empty list on timeout) or None if the
+        directory should be rescanned.
+        """
+        if self._fd is None:
+            if timeout is None or timeout >= self.pollInterval:
+                time.sleep(self.pollInterval)
+                return None
+            time.sleep(timeout)
+            return []
+        try:
+            readable,junk,junk=select.select([self._fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0]!=errno.EINTR:
+                raise
+            return []
+        if not readable:
+            return []
+        return self._readEvents()
+
+    def _readEvents(self):
+        names=[]
+        rescan=False
+        lost=False
+        while True:
+            try:
+                buf=os.read(self._fd, _READ_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not buf:
+                break
+            offset=0
+            while offset+_EVENT_HEADER.size <= len(buf):
+                wd, mask, cookie, length=_EVENT_HEADER.unpack_from(buf, offset)
+                offset+=_EVENT_HEADER.size
+                name=buf[offset:offset+length].rstrip('\0')
+                offset+=length
+                if mask & IN_IGNORED:
+                    lost=True
+                elif mask & IN_Q_OVERFLOW:
+                    rescan=True
+                elif name and not mask & IN_ISDIR and name not in names:
+                    names.append(name)
+        if lost:
+            logger.warning('Lost inotify watch on %s, polling' % self.path)
+            self.close()
+            self.kind='poll'
+            return None
+        if rescan:
+            return None
+        return names
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd=None
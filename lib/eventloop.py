@@ -0,0 +1,152 @@
+import os, select, errno, fcntl
+
+#Event flags used by Poller. They match the epoll & poll values.
+READ=0x001
+WRITE=0x004
+ERROR=0x008|0x010
+
+class Waker(object):
+    """
+    Self-pipe used to wake a thread waiting on a Poller
+
+    Any thread may call wake(), the thread that owns the poller should call
+    drain() when the read end of the pipe is reported readable.
+    """
+    def __init__(self):
+        self._read_fd, self._write_fd=os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            flags=fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags=fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        """ Return the file descriptor to poll for reading """
+        return self._read_fd
+
+    def wake(self, *args):
+        """
+        Wake the poller. Arguments are ignored so wake may be used as a callback
+
+        A full pipe means a wakeup is already pending, so EAGAIN is ignored.
+        """
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def drain(self):
+        """ Discard all pending wakeups """
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def close(self):
+        for fd in (self._read_fd, self._write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class Poller(object):
+    """
+    Minimal level-triggered poller over epoll, falling back to poll or select
+
+    File descriptors are registered once with an event mask of READ, WRITE, &
+    ERROR; the mask need only be changed when interest changes. The poller
+    keeps the registered masks so register/modify races (e.g. a descriptor
+    closed and reused by the OS) are resolved internally.
+    """
+    def __init__(self):
+        self._masks={}
+        if hasattr(select, 'epoll'):
+            self._impl=select.epoll()
+            self.kind='epoll'
+        elif hasattr(select, 'poll'):
+            self._impl=select.poll()
+            self.kind='poll'
+        else:
+            self._impl=None
+            self.kind='select'
+
+    def __contains__(self, fd):
+        return fd in self._masks
+
+    def set(self, fd, mask):
+        """
+        Register fd with mask, modifying the registration if one exists.
+
+        A mask of 0 unregisters fd.
+        """
+        if not mask:
+            self.unregister(fd)
+            return
+        if self._masks.get(fd)==mask:
+            return
+        if self._impl is not None:
+            if fd in self._masks:
+                try:
+                    self._impl.modify(fd, mask)
+                except (IOError, OSError), e:
+                    if e.errno!=errno.ENOENT:
+                        raise
+                    self._impl.register(fd, mask)
+            else:
+                try:
+                    self._impl.register(fd, mask)
+                except (IOError, OSError), e:
+                    if e.errno!=errno.EEXIST:
+                        raise
+                    self._impl.modify(fd, mask)
+        self._masks[fd]=mask
+
+    def unregister(self, fd):
+        """ Stop polling fd. Closed or unknown descriptors are ignored. """
+        if self._masks.pop(fd, None) is None:
+            return
+        if self._impl is not None:
+            try:
+                self._impl.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for events.
+
+        Return a list of (fd, events) tuples. An interrupted wait returns an
+        empty list.
+        """
+        try:
+            if self.kind=='epoll':
+                return self._impl.poll(-1 if timeout is None else timeout)
+            elif self.kind=='poll':
+                return self._impl.poll(None if timeout is None
+                                       else int(timeout*1000))
+            else:
+                return self._select(timeout)
+        except (IOError, OSError, select.error), e:
+            if e.args[0]!=errno.EINTR:
+                raise
+            return []
+
+    def _select(self, timeout):
+        r=[fd for fd,m in self._masks.iteritems() if m & READ]
+        w=[fd for fd,m in self._masks.iteritems() if m & WRITE]
+        x=[fd for fd,m in self._masks.iteritems() if m & ERROR]
+        r,w,x=select.select(r, w, x, timeout)
+        events={}
+        for fd in r: events[fd]=events.get(fd,0)|READ
+        for fd in w: events[fd]=events.get(fd,0)|WRITE
+        for fd in x: events[fd]=events.get(fd,0)|ERROR
+        return events.items()
+
+    def close(self):
+        if self._impl is not None and self.kind=='epoll':
+            self._impl.close()
+        self._masks={}
@@ -1,4 +1,4 @@
-import serial, logging
+import serial, logging, zlib, time
 import SelectedConnection
 from SelectedConnection import logger
 from m2fsConfig import m2fsConfig
@@ -8,6 +8,11 @@ EXPECTED_M2FS_DMC_VERSION='0.2000'
 GALIL_RESET_CONNECTION_TIMEOUT=0.5
 #Normal io timout for galil communication
 GALIL_TIMEOUT=0.5
+#Longest command line the galil accepts, including the terminating \r
+GALIL_MAX_COMMAND_LENGTH=80
+#Seconds the galil's initialization & thread statuses are trusted by status
+# queries without asking the galil again
+GALIL_STATE_LIFETIME=1.0
 
 def escapeString(string):
     return string.replace('\n','\\n').replace('\r','\\r')
@@ -28,6 +33,21 @@ def stringIsNumber(string):
     except ValueError:
         return False
 
+def packCommands(statements, maxLength=GALIL_MAX_COMMAND_LENGTH):
+    """
+    Join statements with ; into as few galil command strings as possible
+    
+    No command string will exceed maxLength characters once terminated, unless
+    a single statement does so on its own.
+    """
+    commands=[]
+    for statement in statements:
+        if commands and len(commands[-1])+len(statement)+2 <= maxLength:
+            commands[-1]+=';'+statement
+        else:
+            commands.append(statement)
+    return commands
+
 class GalilSerial(SelectedConnection.SelectedSerial):
     """ 
     Galil DMC-4183 Controller Class
@@ -145,6 +165,14 @@ class GalilSerial(SelectedConnection.SelectedSerial):
             '3':None, '4':None, '5':None, '6':None, '7':None}
         # Error flag store
         self.errorFlags={}
+        #Galil defaults from the conf file & their checksum, see
+        # _initialize_galil
+        self.config=None
+        self.cfgsum=None
+        self.programming_deferred=False
+        #Time the initialization & threads were last checked, see
+        # _refresh_state
+        self.state_time=0
         logger.name='GalilCon'+side
         #Perform superclass initialization, note we implement the _postConnect
         # hook for the galil, see below
@@ -182,7 +210,10 @@ class GalilSerial(SelectedConnection.SelectedSerial):
         XCode editor.
         
         If the message isn't a command error log a warning.
+        
+        Either way the cached galil state is no longer trusted.
         """
+        self._invalidate_state()
         if 'CMDERR' in message:
             #extract the error
             parts=message.split()
@@ -258,7 +289,10 @@ class GalilSerial(SelectedConnection.SelectedSerial):
             threads again. If #AUTO won't execute fail by throwing ConnectError
         3) Query the galil for the software version. If if doesn't match the
             expected version fail with a ConnectError
+        The galil may have been reset while disconnected, so the cached state
+        is no longer trusted.
         """
+        self._invalidate_state()
         #Get the current threads
         self._update_executing_threads_and_commands()
         if self.thread_command_map['0']==None:
@@ -275,32 +309,15 @@ class GalilSerial(SelectedConnection.SelectedSerial):
             error_message=("Incompatible Firmware, Galil reported '%s', expected '%s'." % (response,expected_version))
             raise SelectedConnection.ConnectError(error_message)
     
-    def _initialize_galil(self):
+    def _load_config(self):
         """
-        Make sure configurable parameters are pushed to the galil
+        Load the galil defaults from m2fsConfig & compute their checksum
         
-        There are a variety of position settings for the various axes which may
-        change with time or otherwise need adjusting. Instead of changing the 
-        hardcoded defaults we use the files m2fs_galilR.conf & m2fs_galilB.conf
-        
-        Procedure is as follows:
-        Check to see if we are connecting for the first time since boot. If not
-        return otherwise continue.
-        Get the parameter values for the galil (R | B) from m2fsConfig
         Verify all of the settings are there, if not, the backing file got 
-        corrupted and needs to be rebuilt, so do so, querying the galil for the 
-        needed values and return after marking the galil as initialized.
-        The translation between galil parameter name and config file setting
-        is defined by self.settingName_to_variableName_map.
-        Finally, set each of the parmeters on the galil and mark it as 
-        initialized
-        
-        Raise IOError if the defaults can not be programmed.
+        corrupted and needs to be rebuilt, so raise IOError. The translation
+        between galil parameter name and config file setting is defined by
+        self.settingName_to_variableName_map.
         """
-        bootup1=self._send_command_to_galil('MG bootup1')
-        if bootup1=='0.0000':
-            return
-        logger.info("Programming galil defaults.")
         config=m2fsConfig.getGalilDefaults(self.SIDE)
         #make sure all the settings are there
         try:
@@ -312,18 +329,87 @@ class GalilSerial(SelectedConnection.SelectedSerial):
             #The config file is corrupted, this is a fatal error
             errMsg=('Galil'+self.SIDE+' configFile corrupted.'+
                 'git reset --hard likely needed')
-            logger.critical(errorMsg)
+            logger.critical(errMsg)
             raise IOError(errMsg)
+        self.config=config
+        self.cfgsum=self._config_checksum(config)
+    
+    def _config_statements(self, config):
+        """ Return the galil assignments for config, sorted by variable """
+        return sorted('%s=%s' % (self.settingName_to_variableName_map[name],
+                                 value)
+                      for name, value in config.items()
+                      if name in self.settingName_to_variableName_map)
+    
+    def _config_checksum(self, config):
+        """
+        Return the checksum of the galil assignments for config
+        
+        It is kept under 2^24 so the galil stores & reports it exactly.
+        """
+        return zlib.crc32(';'.join(self._config_statements(config))) & 0xffffff
+    
+    def _initialize_galil(self):
+        """
+        Make sure configurable parameters are pushed to the galil
+        
+        There are a variety of position settings for the various axes which may
+        change with time or otherwise need adjusting. Instead of changing the 
+        hardcoded defaults we use the files m2fs_galilR.conf & m2fs_galilB.conf
+        
+        Procedure is as follows:
+        Ask the galil for bootup1, which it sets to 1 at boot, and cfgsum, the
+        checksum of the settings it was last programmed with. cfgsum is
+        undefined until the galil has been programmed with one.
+        Load the settings from m2fsConfig if the galil has booted or they have
+        not yet been loaded.
+        If the galil has not booted since it was programmed and the checksums
+        match return.
+        If the galil has not booted but the checksums differ (the settings
+        changed since it was programmed, e.g. the conf file was edited while the
+        agent was stopped, or it was programmed before checksums were kept)
+        motion may be in progress, so update the executing threads and, if any
+        of the motion threads (3-6) are busy, warn and return. Programming is
+        retried on the next call.
+        Otherwise set each of the parameters on the galil, packed into as few
+        commands as the galil's line length allows, then record the checksum &
+        mark the galil as initialized.
+        
+        Raise IOError if the defaults can not be programmed.
+        """
+        try:
+            reply=self._send_command_to_galil('MG bootup1, cfgsum').split()
+        except GalilCommandNotAcknowledgedError:
+            reply=[self._send_command_to_galil('MG bootup1')]
+        bootup1=reply[0] if reply else ''
+        if bootup1!='0.0000' or self.config is None:
+            self._load_config()
+        try:
+            if bootup1=='0.0000' and float(reply[1])==self.cfgsum:
+                return
+        except (IndexError, ValueError):
+            pass
+        if bootup1=='0.0000':
+            self._update_executing_threads_and_commands()
+            busy=[i for i in '3456' if self.thread_command_map[i] is not None]
+            if busy:
+                if not self.programming_deferred:
+                    logger.warning("Galil defaults differ from the conf file, "
+                                   "not programming them while threads %s "
+                                   "are busy." % ','.join(busy))
+                self.programming_deferred=True
+                return
+        self.programming_deferred=False
+        logger.info("Programming galil defaults.")
         #Send the config to the galil
         try:
             #NB we are only here if bootup1=1, which implies nothing but the
-            # basic threads are running and thus we are guaranteed the
-            # settings are not blocked by some executing thread
-            for settingName, value in config.items():
-                variableName=self.settingName_to_variableName_map[settingName]
-                self._send_command_to_galil('%s=%s' % (variableName, value))
-            self.config=config
-            self._send_command_to_galil('bootup1=0')
+            # basic threads are running, or if we've just verified the motion
+            # threads are idle, thus we are guaranteed the settings are not
+            # blocked by some executing thread
+            for command in packCommands(self._config_statements(self.config)):
+                self._send_command_to_galil(command)
+            self._send_command_to_galil('cfgsum=%i;bootup1=0' % self.cfgsum)
         except IOError, e:
             raise IOError("Can not set galil defaults.") 
 
@@ -347,9 +433,9 @@ class GalilSerial(SelectedConnection.SelectedSerial):
 
         Procedure is as follows:
         Send the command string to the galil
-        grab a singe byte from the galil and if it isn't a : or a ? listen for 
-        a \n delimeted response followed by a :.
-        Repeat this for each of the commands in the command_string
+        Receive the replies to each of the commands in the command_string with
+        receiveAcknowledgedReplies, which reads everything the galil sends in
+        one go and splits the :, ?, and data\r\n: replies.
         
         Return a merged string of the responses to the individual commands. 
         Note the : ? are cons considered responses. ? gets the exception and :
@@ -366,43 +452,16 @@ class GalilSerial(SelectedConnection.SelectedSerial):
         num_colons_expected=command_string.count(';')+1
         #Send the command(s)
         self.sendMessageBlocking(command_string, connect=False)
-        #Initialize the for loop
-        acknowledgements=0 #acknowledgements for commands sent in command_string
-        commandReplies=num_colons_expected*[''] #store for replies beyond :|? 
-        galilReply=''
-        galilProtocolError=False
-        for i in range(0,num_colons_expected):
-            #Get the first byte from the galil, typically this will be it
-            response=self.receiveMessageBlocking(nBytes=1)
-            # 3 cases :, ?, or stuff followed by /r/n:
-            #case 1, command succeeds but returns nothing, return
-            if response ==':':
-                acknowledgements+=1
-            #command fails
-            elif response =='?':
-                pass
-            #command is returning something
-            else:
-                #do a blocking receive on \n
-                response=response+self.receiveMessageBlocking()
-                #...and a single byte read to grab the :
-                confByte=self.receiveMessageBlocking(nBytes=1)
-                if confByte==':':
-                    acknowledgements+=1
-                    commandReplies[i]=response.strip()
-                else:
-                    #Consider it a failure, but set a flag to log it once we've
-                    # got everything. Add the byte to the response for logging
-                    galilProtocolError=True
-                    response+=confByte
-            #Build up a record of everything we get from the galil in response
-            # to command string incase we need to log it
-            galilReply+=response
+        replies=self.receiveAcknowledgedReplies(num_colons_expected)
+        acknowledgements=len([r for r in replies if r[0]==':'])
+        #Build up a record of everything we get from the galil in response
+        # to command string incase we need to log it
+        galilReply=''.join(r[2] for r in replies)
         #warn that something was fishy with the galil
-        if galilProtocolError:
+        if any(r[0]=='' for r in replies):
             logger.warning(
                 "Galil did not adhere to protocol '%s' got '%s'" %
-                (command_string, galilReply) )
+                (command_string, escapeString(galilReply)) )
         #We didn't get acknowledgements for all the commands, fail
         if acknowledgements != num_colons_expected:
             raise GalilCommandNotAcknowledgedError(
@@ -410,7 +469,7 @@ class GalilSerial(SelectedConnection.SelectedSerial):
                 (command_string, galilReply) )
         #Join all of replies from the commands and return them as a single
         # string
-        return ''.join(commandReplies)
+        return ''.join(r[1] for r in replies)
     
     def _terminateMessage(self, message):
         """ Override default: Galil requires \r without a preceeding ; """
@@ -420,6 +479,27 @@ class GalilSerial(SelectedConnection.SelectedSerial):
             message+='\r'
         return message
     
+    def _invalidate_state(self):
+        """ Make the next _refresh_state ask the galil """
+        self.state_time=0
+    
+    def _refresh_state(self, force=False):
+        """
+        Initialize the galil if needed & update the executing threads
+        
+        Nothing is sent to the galil if this was done in the last
+        GALIL_STATE_LIFETIME seconds and the state hasn't been invalidated
+        since, unless force is set. The state is invalidated by unsolicited
+        messages from the galil, (re)connecting, and commands which may start
+        or stop threads.
+        """
+        if not force and time.time()-self.state_time < GALIL_STATE_LIFETIME:
+            return
+        self._invalidate_state()
+        self._initialize_galil()
+        self._update_executing_threads_and_commands()
+        self.state_time=time.time()
+    
     def _update_executing_threads_and_commands(self):
         """
         Retrieve and update the list of thread statuses from the galil
@@ -444,7 +524,7 @@ class GalilSerial(SelectedConnection.SelectedSerial):
         # 'HX= 1.0000 1.0000 1.0000 0.0000 0.0000 0.0000 0.0000 0.0000'
         response=self._send_command_to_galil(
             'MG "HX=",_HX0,_HX1,_HX2,_HX3,_HX4,_HX5,_HX6,_HX7')
-        if response[-1] == '?' or response[0:3] !='HX=':
+        if not response or response[-1] == '?' or response[0:3] !='HX=':
             raise GalilThreadUpdateException("Could not update galil threads.")
         #Extract the part we care about
         response=response[4:]
@@ -488,8 +568,8 @@ class GalilSerial(SelectedConnection.SelectedSerial):
         Execute a motion command, connecting and starting up if needed
         
         Connect to the galil
-        Initialize the galil (function just returns if not needed)
-        Update our knowledge of what is running
+        Initialize the galil (function just returns if not needed) & update
+        our knowledge of what is running, always asking the galil
         Fail if the command if blocked
         Test for ELO & ABORT switched beign engaged. This is VERY UNRELIABLE.
         Get a thread to execute the command on, failing if none available
@@ -502,10 +582,9 @@ class GalilSerial(SelectedConnection.SelectedSerial):
         try:
             #Make sure we are connected
             self.connect()
-            #Make sure galil is initialized, e.g all parameters are set
-            self._initialize_galil()
-            #Update galil thread statuses
-            self._update_executing_threads_and_commands()
+            #Make sure galil is initialized, e.g all parameters are set, and
+            # update galil thread statuses
+            self._refresh_state(force=True)
             #Check to see if the command is blocked
             if self._command_class_blocked(command_class):
                 return "ERROR: Command is blocked. Try again later."
@@ -531,14 +610,15 @@ class GalilSerial(SelectedConnection.SelectedSerial):
             # assume that the command is blocked anyway
             self._add_galil_command_to_executing_commands(
                 command_string, command_class, thread_number)
+            self._invalidate_state()
     
     def _do_status_query(self, command_string):
         """
         Execute a status command, connecting and starting up if needed
         
         Connect to the galil
-        Initialize the galil (function just returns if not needed)
-        Update our knowledge of what is running
+        Initialize the galil (function just returns if not needed) & update
+        our knowledge of what is running, if not done recently
         Send the command to the galil, status commands are never blocked
         Listen for a response
         Check to see if the response indicates an error ('ERR' will follow the 
@@ -549,10 +629,8 @@ class GalilSerial(SelectedConnection.SelectedSerial):
         try:
             #Make sure we are connected
             self.connect()
-            #Make sure galil is initialized
-            self._initialize_galil()
-            #Update galil thread statuses
-            self._update_executing_threads_and_commands()
+            #Make sure galil is initialized & update galil thread statuses
+            self._refresh_state()
             #Send the command to the galil
             self._send_command_to_galil(command_string)
             response=self.receiveMessageBlocking()
@@ -670,6 +748,7 @@ class GalilSerial(SelectedConnection.SelectedSerial):
                 self.connection=serial.Serial(self.port, baudrate=self.baudrate,
                                           timeout=GALIL_RESET_CONNECTION_TIMEOUT)
             #send the command
+            self._invalidate_state()
             self._send_command_to_galil('RS')
             #close the connection
             self.close()
@@ -702,6 +781,7 @@ class GalilSerial(SelectedConnection.SelectedSerial):
         finally:
             self._add_galil_command_to_executing_commands('HX3;XQ#SHTDWN,3',
                                                           'SHUTDOWN', 3)
+            self._invalidate_state()
 
     def getDefault(self, settingName):
         """
@@ -745,13 +825,17 @@ class GalilSerial(SelectedConnection.SelectedSerial):
             return "!ERROR: %s not a valid setting" % settingName
         try:
             self.connect()
-            self._initialize_galil()
-            self._update_executing_threads_and_commands()
+            self._refresh_state(force=True)
             #Check to see if the command is blocked
             if self._command_class_blocked(
                 self.settingNameCommandClasses[settingName]):
                 return "ERROR: Command is blocked. Try again later."
-            self._send_command_to_galil('%s=%s' % (variableName, value))
+            config=dict(self.config)
+            config[settingName]=value
+            cfgsum=self._config_checksum(config)
+            self._send_command_to_galil('%s=%s;cfgsum=%i' %
+                                        (variableName, value, cfgsum))
+            self.config, self.cfgsum=config, cfgsum
             m2fsConfig.setGalilDefault(self.SIDE, settingName, value)
             return 'OK'
         except IOError, e:
@@ -771,8 +855,9 @@ class GalilSerial(SelectedConnection.SelectedSerial):
             #Make sure we are connected
             self.connect()
             #Make sure galil is initialized
-            self._initialize_galil()
-            #Send the command to the galil
+            self._refresh_state()
+            #Send the command to the galil, it could do anything
+            self._invalidate_state()
             self.sendMessageBlocking(command_string, connect=False)
             response=self.receiveMessageBlocking(nBytes=1024)
             response=escapeString(response)
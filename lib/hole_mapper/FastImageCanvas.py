@@ -0,0 +1,332 @@
+'''
+NumPy rasterizer for hole map images
+
+FastImageCanvas is a drop in replacement for ImageCanvas which renders at the
+final resolution instead of at 4x and downsampling. Drawing calls are
+recorded and rendered when the image is saved: runs of consecutive circles
+(or squares) are rasterized together in one vectorized pass, with edges
+anti-aliased analytically from each pixel's distance to the shape. Lines are
+anti-aliased the same way and text is drawn with PIL into a coverage mask.
+
+Holes on a plate don't overlap, so the circles of a run are composited
+together against the image as it was before the run. Where the anti-aliased
+edges of two circles of a run share a pixel the later circle wins.
+
+Saving to a .svg file writes the recorded drawing as SVG instead.
+'''
+import math
+from itertools import groupby
+from xml.sax.saxutils import escape
+import numpy as np
+import PIL.Image
+import PIL.ImageColor
+import PIL.ImageDraw
+import PIL.ImageFont
+import ImageCanvas
+
+#Widths in final pixels, those ImageCanvas draws at its 4x supersampling
+LINE_WIDTH=1.75
+OUTLINE_WIDTH=0.25
+DASH_LENGTH=5.0
+FONT_SIZE=12
+#Shapes larger than this (px) are rasterized individually
+MAX_BATCH_PATCH=64
+
+_rgbCache={}
+
+def _rgb(color):
+    """ Return the (r,g,b) tuple of a PIL color name or spec """
+    try:
+        return _rgbCache[color]
+    except KeyError:
+        rgb=_rgbCache[color]=PIL.ImageColor.getrgb(color)[0:3]
+        return rgb
+
+def _hex(color):
+    if color is None:
+        return 'none'
+    return '#%02x%02x%02x' % _rgb(color)
+
+def _font():
+    try:
+        return PIL.ImageFont.truetype("Arial.ttf", FONT_SIZE)
+    except IOError:
+        return PIL.ImageFont.load_default()
+
+
+class FastImageCanvas(ImageCanvas.ImageCanvas):
+    def __init__(self, width, height, units_hwidth, units_hheight):
+        self.mult=1
+        self.default_color='White'
+        self.finishedSize=(width,height)
+
+        self.centerx=float(width)/2.0
+        self.centery=float(height)/2.0
+
+        self.scalex=self.centerx/units_hwidth
+        self.scaley=self.centery/units_hheight
+
+        self.font=_font()
+        self._ops=[]
+
+    def clear(self):
+        self._ops=[]
+
+    def save(self, file):
+        if file.lower().endswith('.svg'):
+            with open(file, 'w') as fp:
+                fp.write(self.svg())
+        else:
+            PIL.Image.fromarray(self.render()).save(file)
+
+    #assumes that canvas coord scaling is same in both x and y dimensions
+    def drawCircle(self, (x,y), r, fill=None, outline=None, width=None):
+        col=self.setupColors(outline, fill)
+        self._ops.append(('circle', self.canvasCoordx(x),
+                          self.canvasCoordy(y), abs(r*self.scalex),
+                          col[1], col[0]))
+
+    #x,y are at center len is length of side
+    def drawSquare(self, (x,y), len, outline=None, fill=None, width=None):
+        self.drawRectangle((x-len/2., y-len/2., x+len/2., y+len/2.),
+                           outline=outline, fill=fill)
+
+    # x0,y0 is one corner, x1,y1 is corner diagonally across
+    def drawRectangle(self, (x0,y0,x1,y1), outline=None, fill=None):
+        x0c, x1c=self.canvasCoordx(x0), self.canvasCoordx(x1)
+        y0c, y1c=self.canvasCoordy(y0), self.canvasCoordy(y1)
+        col=self.setupColors(outline, fill)
+        self._ops.append(('rect', min(x0c,x1c), min(y0c,y1c), max(x0c,x1c),
+                          max(y0c,y1c), col[1], col[0]))
+
+    ##takes either (x0,y0), (x1,y1)  or (x,y), r,theta
+    def drawLine(self, *args, **kw):
+        assert len(args) == 2 or len(args) == 3
+        pos0 = args[0]
+        if len(args) == 2:
+            pos1 = args[1]
+        else:
+            l = args[1]
+            th = args[2]
+            pos1=(pos0[0]+l*math.cos(math.radians(th)),
+                  pos0[1]+l*math.sin(math.radians(th)))
+        x0c, y0c=self.canvasCoordx(pos0[0]), self.canvasCoordy(pos0[1])
+        x1c, y1c=self.canvasCoordx(pos1[0]), self.canvasCoordy(pos1[1])
+        #Dashes start from the left end
+        if x0c > x1c:
+            x0c, y0c, x1c, y1c=x1c, y1c, x0c, y0c
+        col=self.setupColors(kw.get('fill',None), None)
+        self._ops.append(('line', x0c, y0c, x1c, y1c, col[0],
+                          bool(kw.get('dashing',None))))
+
+    # x,y is at upper left corner of text unless center is set to 1
+    def drawText(self,(x,y), text, color=None,center=0):
+        xc=self.canvasCoordx(x)
+        yc=self.canvasCoordy(y)
+        if center:
+            tmp=self.font.getsize(text)
+            xc-=tmp[0]/2.0
+            yc-=tmp[0]/2.0
+        col=self.setupColors(color, None)
+        self._ops.append(('text', xc, yc, text, col[0]))
+
+    def getTextSize(self,text):
+        wid,ht=self.font.getsize(text)
+        return ( self.inputCoordx(wid)-self.inputCoordx(0),
+                 self.inputCoordy(ht)-self.inputCoordy(0) )
+
+    # go from coordinates with 0,0 at center to 0,0 at upper left, unrounded
+    def canvasCoordx(self, x):
+        return -self.scalex*x+self.centerx
+
+    def canvasCoordy(self, y):
+        return -self.scaley*y + self.centery
+
+    def render(self):
+        """ Rasterize the drawing, return it as a (height, width, 3) uint8
+            array """
+        width, height=self.finishedSize
+        image=np.zeros((height, width, 3), dtype=np.uint8)
+        def batchKey((i, op)):
+            if op[0]=='circle':
+                big=2*op[3] > MAX_BATCH_PATCH
+            elif op[0]=='rect':
+                big=max(op[3]-op[1], op[4]-op[2]) > MAX_BATCH_PATCH
+            else:
+                return (op[0], i)
+            return (op[0], i if big else None)
+        for (kind, junk), ops in groupby(enumerate(self._ops), batchKey):
+            ops=[op for i, op in ops]
+            if kind=='circle':
+                self._renderCircles(image, ops)
+            elif kind=='rect':
+                self._renderRects(image, ops)
+            elif kind=='line':
+                self._renderLine(image, *ops[0][1:])
+            else:
+                self._renderText(image, *ops[0][1:])
+        return image
+
+    @staticmethod
+    def _colors(colors):
+        """ Return an (N,3) array of the colors and an (N,) array which is 0
+            where the color is None"""
+        rgb=np.array([_rgb(c) if c else (0,0,0) for c in colors],
+                     dtype=np.float32).reshape(-1,3)
+        have=np.array([c is not None for c in colors], dtype=np.float32)
+        return rgb, have
+
+    @staticmethod
+    def _composite(image, iy, ix, layers):
+        """
+        Blend layers onto the pixels iy, ix (arrays broadcastable to a common
+        shape S) of image. layers is a list of (alpha, color), alpha of shape S
+        & color broadcastable to S+(3,), composited in order. Only pixels with
+        coverage are written.
+        """
+        height, width=image.shape[0:2]
+        shape=layers[0][0].shape
+        iy=np.broadcast_to(iy, shape)
+        ix=np.broadcast_to(ix, shape)
+        covered=np.zeros(shape, dtype=bool)
+        for alpha, color in layers:
+            covered|=alpha > 0
+        covered&=(iy >= 0) & (iy < height) & (ix >= 0) & (ix < width)
+        iy, ix=iy[covered], ix[covered]
+        out=image[iy, ix].astype(np.float32)
+        for alpha, color in layers:
+            color=np.broadcast_to(color, shape+(3,))[covered]
+            out+=(color-out)*alpha[covered][:,None]
+        image[iy, ix]=np.round(out).astype(np.uint8)
+
+    @staticmethod
+    def _patch(ox, oy, p):
+        """ Return the iy, ix of (N,p,p) patches with origins ox, oy """
+        g=np.arange(p)
+        return (oy[:,None,None]+g[None,:,None], ox[:,None,None]+g[None,None,:])
+
+    def _renderCircles(self, image, ops):
+        cx=np.array([op[1] for op in ops])
+        cy=np.array([op[2] for op in ops])
+        r=np.array([op[3] for op in ops])
+        fill, haveFill=self._colors([op[4] for op in ops])
+        outline, haveOutline=self._colors([op[5] for op in ops])
+        pad=r.max()+OUTLINE_WIDTH+1
+        p=int(math.ceil(2*pad))+1
+        ox=np.floor(cx-pad).astype(int)
+        oy=np.floor(cy-pad).astype(int)
+        g=np.arange(p)+0.5
+        dx=ox[:,None]+g[None,:]-cx[:,None]
+        dy=oy[:,None]+g[None,:]-cy[:,None]
+        d=np.hypot(dy[:,:,None], dx[:,None,:])
+        rr=r[:,None,None]
+        fillAlpha=np.clip(rr+0.5-d, 0, 1)*haveFill[:,None,None]
+        ringAlpha=(np.clip(rr+OUTLINE_WIDTH/2+0.5-d, 0, 1)-
+                   np.clip(rr-OUTLINE_WIDTH/2+0.5-d, 0, 1))
+        ringAlpha*=haveOutline[:,None,None]
+        iy, ix=self._patch(ox, oy, p)
+        self._composite(image, iy, ix, [(fillAlpha, fill[:,None,None]),
+                                        (ringAlpha, outline[:,None,None])])
+
+    @staticmethod
+    def _boxCoverage(left, right, edges):
+        """ Coverage of the pixels with left edges edges (N,P) by the spans
+            [left, right) (N,) """
+        return np.clip(np.minimum(edges+1, right[:,None])-
+                       np.maximum(edges, left[:,None]), 0, 1)
+
+    def _renderRects(self, image, ops):
+        x0=np.array([op[1] for op in ops])
+        y0=np.array([op[2] for op in ops])
+        x1=np.array([op[3] for op in ops])
+        y1=np.array([op[4] for op in ops])
+        fill, haveFill=self._colors([op[5] for op in ops])
+        outline, haveOutline=self._colors([op[6] for op in ops])
+        w=OUTLINE_WIDTH/2
+        p=int(math.ceil(max((x1-x0).max(), (y1-y0).max())+2*w))+2
+        ox=np.floor(x0-w).astype(int)
+        oy=np.floor(y0-w).astype(int)
+        ex=ox[:,None]+np.arange(p)[None,:]
+        ey=oy[:,None]+np.arange(p)[None,:]
+        def coverage(grow):
+            cx=self._boxCoverage(x0-grow, x1+grow, ex)
+            cy=self._boxCoverage(y0-grow, y1+grow, ey)
+            return cy[:,:,None]*cx[:,None,:]
+        inner=coverage(-w)
+        fillAlpha=coverage(0)*haveFill[:,None,None]
+        ringAlpha=(coverage(w)-inner)*haveOutline[:,None,None]
+        iy, ix=self._patch(ox, oy, p)
+        self._composite(image, iy, ix, [(fillAlpha, fill[:,None,None]),
+                                        (ringAlpha, outline[:,None,None])])
+
+    def _renderLine(self, image, x0, y0, x1, y1, color, dashed):
+        """ Rasterize a band of pixels along the line's major axis """
+        vx, vy=x1-x0, y1-y0
+        length=math.hypot(vx, vy)
+        pad=LINE_WIDTH/2+1
+        swap=abs(vy) > abs(vx)
+        if swap:
+            x0, y0, x1, y1, vx, vy=y0, x0, y1, x1, vy, vx
+        #major axis pixels and the minor coordinate of the line at each
+        m=np.arange(int(math.floor(min(x0,x1)-pad)),
+                    int(math.ceil(max(x0,x1)+pad))+1)
+        slope=vy/vx if vx else 0.0
+        center=y0+(np.clip(m+0.5, min(x0,x1), max(x0,x1))-x0)*slope
+        band=int(math.ceil(pad*length/abs(vx))) if vx else int(math.ceil(pad))
+        k=np.arange(-band, band+1)
+        major=m[:,None]+np.zeros_like(k)[None,:]
+        minor=np.floor(center).astype(int)[:,None]+k[None,:]
+        pm, pn=major+0.5, minor+0.5
+        if length:
+            t=np.clip(((pm-x0)*vx+(pn-y0)*vy)/length**2, 0, 1)
+        else:
+            t=np.zeros(major.shape)
+        d=np.hypot(pm-(x0+t*vx), pn-(y0+t*vy))
+        alpha=np.clip(LINE_WIDTH/2+0.5-d, 0, 1)
+        if dashed and length > DASH_LENGTH:
+            alpha*=(t*length) % (2*DASH_LENGTH) < DASH_LENGTH
+        iy, ix=(major, minor) if swap else (minor, major)
+        self._composite(image, iy, ix, [(alpha, np.array(_rgb(color),
+                                                          dtype=np.float32))])
+
+    def _renderText(self, image, x, y, text, color):
+        w, h=self.font.getsize(text)
+        if not w or not h:
+            return
+        mask=PIL.Image.new('L', (w, h))
+        PIL.ImageDraw.Draw(mask).text((0,0), text, fill=255, font=self.font)
+        alpha=np.asarray(mask, dtype=np.float32)/255
+        iy=int(round(y))+np.arange(h)[:,None]
+        ix=int(round(x))+np.arange(w)[None,:]
+        self._composite(image, iy, ix, [(alpha, np.array(_rgb(color),
+                                                          dtype=np.float32))])
+
+    def svg(self):
+        """ Return the drawing as an SVG document """
+        width, height=self.finishedSize
+        out=['<svg xmlns="http://www.w3.org/2000/svg" width="%i" height="%i" '
+             'viewBox="0 0 %i %i">' % (width, height, width, height),
+             '<rect width="100%" height="100%" fill="black"/>']
+        for op in self._ops:
+            if op[0]=='circle':
+                out.append('<circle cx="%.2f" cy="%.2f" r="%.2f" fill="%s" '
+                           'stroke="%s" stroke-width="%.2f"/>' % (op[1], op[2],
+                           op[3], _hex(op[4]), _hex(op[5]), OUTLINE_WIDTH))
+            elif op[0]=='rect':
+                out.append('<rect x="%.2f" y="%.2f" width="%.2f" '
+                           'height="%.2f" fill="%s" stroke="%s" '
+                           'stroke-width="%.2f"/>' % (op[1], op[2],
+                           op[3]-op[1], op[4]-op[2], _hex(op[5]), _hex(op[6]),
+                           OUTLINE_WIDTH))
+            elif op[0]=='line':
+                dash=' stroke-dasharray="%g"' % DASH_LENGTH if op[6] else ''
+                out.append('<line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f" '
+                           'stroke="%s" stroke-width="%.2f"%s/>' % (op[1],
+                           op[2], op[3], op[4], _hex(op[5]), LINE_WIDTH, dash))
+            else:
+                out.append('<text x="%.2f" y="%.2f" font-family="Arial" '
+                           'font-size="%i" fill="%s" '
+                           'dominant-baseline="hanging">%s</text>' % (op[1],
+                           op[2], FONT_SIZE, _hex(op[4]), escape(op[3])))
+        out.append('</svg>\n')
+        return '\n'.join(out)
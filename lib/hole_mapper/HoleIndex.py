@@ -0,0 +1,109 @@
+'''
+Spatial index of plate holes
+
+Holes are hashed into a uniform grid of square cells by position and kept in
+dicts by Hole (equal holes are the same hole) and by hole ID, so lookups by
+ID, duplicate detection, and nearest hole queries don't scan the plate.
+'''
+import math
+
+CELL_SIZE=0.05 #plate units (plate radius is 1)
+
+class HoleIndex(object):
+    '''
+    A grid hash of Holes
+
+    add() returns the indexed hole equal to the one given, which is the given
+    hole if it is new. Holes may be looked up by hole ID with get(), and by
+    position with nearest() & within().
+    '''
+    def __init__(self, cellSize=CELL_SIZE):
+        self.cellSize=float(cellSize)
+        self._holes={}
+        self._byID={}
+        self._cells={}
+        self._bounds=None
+
+    def __len__(self):
+        return len(self._holes)
+
+    def __iter__(self):
+        return self._holes.iterkeys()
+
+    def __contains__(self, hole):
+        return hole in self._holes
+
+    def _cell(self, (x,y)):
+        return (int(math.floor(x/self.cellSize)),
+                int(math.floor(y/self.cellSize)))
+
+    def add(self, hole):
+        """ Add hole if it is not in the index, return the indexed hole """
+        try:
+            return self._holes[hole]
+        except KeyError:
+            pass
+        self._holes[hole]=hole
+        self._byID.setdefault(hole.hash, hole)
+        cell=self._cell(hole.position())
+        self._cells.setdefault(cell, []).append(hole)
+        if self._bounds is None:
+            self._bounds=cell+cell
+        else:
+            i0,j0,i1,j1=self._bounds
+            self._bounds=(min(i0,cell[0]), min(j0,cell[1]),
+                          max(i1,cell[0]), max(j1,cell[1]))
+        return hole
+
+    def get(self, holeID):
+        """ Return the hole with ID holeID or None """
+        return self._byID.get(long(holeID))
+
+    def clear(self):
+        self._holes.clear()
+        self._byID.clear()
+        self._cells.clear()
+        self._bounds=None
+
+    def _ring(self, (cx,cy), n):
+        """ Yield the holes in the cells n cells away from cell (cx,cy) """
+        if n==0:
+            cells=[(cx,cy)]
+        else:
+            cells=[(cx+i, cy+j) for i in range(-n,n+1) for j in (-n,n)]
+            cells+=[(cx+i, cy+j) for i in (-n,n) for j in range(-n+1,n)]
+        for cell in cells:
+            for h in self._cells.get(cell, ()):
+                yield h
+
+    def nearest(self, pos, maxDistance=None):
+        """
+        Return the hole whose center is nearest pos, an (x,y) tuple, or None
+        if there are no holes (within maxDistance)
+        """
+        if not self._holes:
+            return None
+        center=self._cell(pos)
+        best=None
+        bestDistance=float('inf') if maxDistance is None else maxDistance
+        #The cells are searched in rings, holes in ring n are at least
+        # (n-1)*cellSize away from pos, stop at the edge of the index
+        i0,j0,i1,j1=self._bounds
+        maxRing=max(abs(center[0]-i0), abs(center[0]-i1),
+                    abs(center[1]-j0), abs(center[1]-j1))
+        n=0
+        while n <= maxRing and (n-1)*self.cellSize <= bestDistance:
+            for h in self._ring(center, n):
+                d=h.distance(pos)
+                if d <= bestDistance:
+                    best, bestDistance=h, d
+            n+=1
+        return best
+
+    def within(self, pos, radius):
+        """ Return a list of the holes whose centers are within radius of pos """
+        x,y=pos
+        x0,y0=self._cell((x-radius, y-radius))
+        x1,y1=self._cell((x+radius, y+radius))
+        return [h for i in range(x0, x1+1) for j in range(y0, y1+1)
+                for h in self._cells.get((i,j), ()) if h.distance(pos) <= radius]
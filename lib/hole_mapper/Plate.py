@@ -4,7 +4,9 @@ Created on Dec 12, 2009
 @author: one
 '''
 from Hole import *
+from HoleIndex import HoleIndex
 import ImageCanvas
+import numpy as np
 import os.path
 import platefile
 class Plate(object):
@@ -41,6 +43,8 @@ class Plate(object):
         #x1,y1 = 0.4863742535097986, 0.19906175954231559
         #x2,y2 = 0.36245210964697655, 0.6497646036144594
         self.holeSet=set()
+        self.holeIndex=HoleIndex()
+        self.holeSetups={}
         self.setups={}
         self.plate_name=''
         self.doCoordShift=True
@@ -50,23 +54,16 @@ class Plate(object):
         self.coordShift_a=0.03
 
     def getHole(self, holeID):
-        for h in self.holeSet:
-            if h.hash == long(holeID):
-                return h
-        return None
+        return self.holeIndex.get(holeID)
+
+    def getNearestHole(self, (x,y), maxDistance=None):
+        """ Return the hole nearest plate position (x,y) (unshifted) or
+            None if there is no hole within maxDistance."""
+        return self.holeIndex.nearest((x,y), maxDistance=maxDistance)
 
     def getSetupsUsingHole(self, hole):
-        ret=[]
-        for k in self.setups:
-            v=self.setups[k]
-            if hole in v['unused_holes']:
-                ret.append(k)
-            else:
-                for chan in v['channels']:
-                    if hole in v['channels'][chan]:
-                        ret.append(k)
-                        break
-        return ret
+        setups=self.holeSetups.get(hole, ())
+        return [k for k in self.setups if k in setups]
 
 
     def getHoleInfo(self, holeID):
@@ -159,23 +156,7 @@ class Plate(object):
         return 'Red: %03d  Blue: %03d  Total: %04d'%(nr,nb,nt)
 
     def getHolesNotInAnySetup(self):
-        otherholes=[]
-        #gather all the holes not in any setup
-        for h in self.holeSet:
-            flag=1
-            for s in self.setups:
-                if h in self.setups[s]['unused_holes']:
-                    flag=0
-                if flag:
-                    for k in self.setups[s]['channels']:
-                        if h in self.setups[s]['channels'][k]:
-                            flag=0
-                            break
-                if flag == 0:
-                    break
-            if flag:
-                otherholes.append(h)
-        return otherholes
+        return [h for h in self.holeSet if not self.holeSetups.get(h)]
     
     def addHole(self, xin, yin, r, setup='', channel='', info=''):
         """Used to manually add a hole to the plate.
@@ -195,12 +176,7 @@ class Plate(object):
             hole['DEC']=dec
             hole['TYPE']=type
         
-        if hole in self.holeSet:
-            for h in self.holeSet:
-                if h.hash==hole.hash:
-                    hole=h
-                    break
-        
+        hole=self.holeIndex.add(hole)
         self.holeSet.add(hole)
 
         if setup:
@@ -215,6 +191,7 @@ class Plate(object):
                     self.setups[setupName]['channels'][channel]=[hole]
             else:
                 self.setups[setupName]['unused_holes'].append(hole)
+            self.holeSetups.setdefault(hole, set()).add(setupName)
             
 
     def initializeSetup(self, setupName):
@@ -273,9 +250,11 @@ class Plate(object):
                                 keep=True
                                 break
                         if not keep:
-                            self.setups.pop(curr_setup)
+                            self.dropSetup(curr_setup)
                             
                     curr_setup='Setup '+words[1]
+                    if curr_setup in self.setups:
+                        self.dropSetup(curr_setup)
                     self.setups[curr_setup]=self.initializeSetup(curr_setup)
                     
                 else:
@@ -297,14 +276,22 @@ class Plate(object):
     def clear(self):
         self.setups={}
         self.holeSet=set()
+        self.holeIndex.clear()
+        self.holeSetups={}
+
+    def dropSetup(self, setupName):
+        """Remove a setup, the holes remain on the plate"""
+        self.setups.pop(setupName)
+        for setups in self.holeSetups.itervalues():
+            setups.discard(setupName)
 
     def findPath(self, holeList, plateSide ):
         if plateSide == 'left':
             #we are going left to right
-            holeList.sort(lambda a,b: -cmp(a.x,b.x))
+            holeList.sort(key=lambda h: h.x, reverse=True)
         else:
             #we are going right to left to
-            holeList.sort(lambda a,b: cmp(a.x,b.x))
+            holeList.sort(key=lambda h: h.x)
 
         #The path starts at the first hole
         path=[]
@@ -324,21 +311,25 @@ class Plate(object):
             self.setups[active_setup]['groups']=[]
             for c in self.setups[active_setup]['channels']:
     
-                holes=[]
-                for h in self.setups[active_setup]['channels'][c]:
-                    if h.inRegion(initRegion):
-                        holes.append(h)
+                holes=self.setups[active_setup]['channels'][c]
+                xs=np.array([h.x for h in holes], dtype=float)
+                ys=np.array([h.y for h in holes], dtype=float)
+                inPlate=np.flatnonzero((xs >= -Plate.RADIUS) &
+                                       (xs <= Plate.RADIUS) &
+                                       (ys >= -Plate.RADIUS) &
+                                       (ys <= Plate.RADIUS))
     
                 #Break the holes on the channel into desired groups of 8 or less
-                regions=Plate.divideRegion((holes,initRegion))
+                regions=[([holes[i] for i in idx], region) for idx, region in
+                         Plate.divideIndices(xs, ys, inPlate, initRegion)]
     
                 #Associate these regions with groups of fibers
                 self.setups[active_setup]['groups'].extend(
                     Plate.regions2groups(c,regions))
     
-                #Create a path for the holes
-                for g in self.setups[active_setup]['groups']:
-                    g['path']=self.findPath(g['holes'],g['side'])
+            #Create a path for the holes
+            for g in self.setups[active_setup]['groups']:
+                g['path']=self.findPath(g['holes'],g['side'])
             
 
     def writeMapFile(self, out_dir, active_setup):
@@ -366,45 +357,42 @@ class Plate(object):
 
     @staticmethod
     def divideRegion(region):
-        tmpr=Plate.splitRegionHorizontally( region )
-        
-        if len(tmpr)==1:
-            regions=Plate.splitRegionVertically( tmpr[0] )
-        else:
-            regions=Plate.divideRegion( tmpr[0])
-            subregions2=Plate.divideRegion( tmpr[1])
-            regions[len(regions):]=subregions2
-            
-        return regions
+        """ Divide region, a (list of holes, (x0,y0,x1,y1)) tuple, into a list
+            of regions of 8 or fewer holes."""
+        holes, box=region
+        xs=np.array([h.x for h in holes], dtype=float)
+        ys=np.array([h.y for h in holes], dtype=float)
+        return [([holes[i] for i in idx], r) for idx, r in
+                Plate.divideIndices(xs, ys, np.arange(len(holes)), box)]
 
-                     
     @staticmethod
-    def splitRegionVertically( (holes, (x0,y0,x1,y1)), nminr=8):
-        if len(holes) <= nminr:
-            regions=[(holes,(x0,y0,x1,y1))]
-        else:
-            holes=sorted(holes, Hole.holeCompareX)
-            nr2=nminr*(len(holes)/nminr/2)+len(holes)%nminr
-            splitx=(holes[-nr2-1].x+holes[-nr2].x)/2.0
-            regions=[(holes[0:-nr2],(x0,y0,splitx,y1)),
-                     (holes[-nr2:],(splitx,y0,x1,y1))]
-        return regions
-
+    def divideIndices(xs, ys, idx, region):
+        """ divideRegion on hole coordinate arrays, the holes of the region are
+            the elements idx of xs & ys. Returns a list of 
+            (index array, (x0,y0,x1,y1)) tuples."""
+        tmpr=Plate.splitIndices(ys, idx, region, 16, 1)
+        if len(tmpr)==1:
+            return Plate.splitIndices(xs, idx, region, 8, 0)
+        return (Plate.divideIndices(xs, ys, *tmpr[0]) +
+                Plate.divideIndices(xs, ys, *tmpr[1]))
 
     @staticmethod
-    def splitRegionHorizontally((holes, (x0,y0,x1,y1)), nminr=16):
-        if len(holes) <= nminr:
-            regions=[(holes,(x0,y0,x1,y1))]
+    def splitIndices(coords, idx, (x0,y0,x1,y1), nminr, axis):
+        """ Split the holes idx of a region in two along axis (0 for x, 1 for
+            y) at coords if there are more than nminr. The second region gets
+            the holes with the largest coords, a multiple of nminr plus the
+            remainder. The sort is stable so ties split as a list sort would."""
+        if len(idx) <= nminr:
+            return [(idx,(x0,y0,x1,y1))]
+        idx=idx[np.argsort(coords[idx], kind='mergesort')]
+        nr2=nminr*(len(idx)/nminr/2)+len(idx)%nminr
+        split=(coords[idx[-nr2-1]]+coords[idx[-nr2]])/2.0
+        if axis==0:
+            return [(idx[0:-nr2],(x0,y0,split,y1)),
+                    (idx[-nr2:],(split,y0,x1,y1))]
         else:
-            #sort holes by y position increasing
-            holes=sorted(holes, Hole.holeCompareY)
-            #num holes in second group: nr2
-            nr2=nminr*(len(holes)/nminr/2)+len(holes)%nminr
-            #holes in first group: 0:-nr2
-            splity=(holes[-nr2-1].y+holes[-nr2].y)/2.0
-            regions=[(holes[0:-nr2],(x0,y0,x1,splity)),
-                     (holes[-nr2:],(x0,splity,x1,y1))]
-        return regions
+            return [(idx[0:-nr2],(x0,y0,x1,split)),
+                    (idx[-nr2:],(x0,split,x1,y1))]
 
 
     @staticmethod
@@ -419,12 +407,14 @@ class Plate(object):
         # leftmost go to the left. Of those on the right, the 8 right most go right.
         # any leftover on either side go on the other side.
     
-        regionxctr=[math.fsum([h.x for h in r[0]])/float(len(r[0])) for r in regions]
+        regionxctr=[math.fsum(h.x for h in r[0])/float(len(r[0])) for r in regions]
         num_left=sum([a > 0.0 for a in regionxctr])
         num_right=len(regions)-num_left
     
         #Sort the regions from leftmost to rightmost
-        regions.sort(key=lambda r:math.fsum([h.x for h in r[0]])/float(len(r[0])),reverse=True)
+        order=sorted(range(len(regions)), key=regionxctr.__getitem__,
+                     reverse=True)
+        regions=[regions[i] for i in order]
     
         #Place first min(8, num regions on left + max(0, num regions on right - 8))
         # regions on the left, the remainder on the right
@@ -434,8 +424,8 @@ class Plate(object):
         right=regions[num_left:]
   
 
-        left.sort(lambda a,b: -cmp(a[1][1]+a[1][3],b[1][1]+b[1][3]))
-        right.sort(lambda a,b: -cmp(a[1][1]+a[1][3],b[1][1]+b[1][3]))
+        left.sort(key=lambda r: r[1][1]+r[1][3], reverse=True)
+        right.sort(key=lambda r: r[1][1]+r[1][3], reverse=True)
 
         #Do the left and right sides of the plate separately
             #Now the groups are sorted vertically
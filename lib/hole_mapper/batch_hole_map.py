@@ -1,22 +1,162 @@
+#!/usr/bin/env python2.7
+"""
+Batch hole mapping
+
+Regionifies every setup of the given _Sum.asc plate files and writes its
+map file and images (all channels, blue, & red). Plates are parsed and
+regionified once, in the parent, then the images are rendered by a pool of
+worker processes, which inherit the parsed plates when they are forked.
+Plates whose .asc & .res files are unchanged since their outputs were last
+written in the same image format (per the cache file in the output
+directory) are skipped.
+Images are drawn with FastImageCanvas; with --svg they are written as SVG.
+
+Usage: batch_hole_map.py [-j JOBS] [-o OUTDIR] [--force] [--svg] FILE.asc [...]
+"""
+import os, sys, time, json, hashlib, argparse, multiprocessing
 import Plate
-import ImageCanvas
+import FastImageCanvas
+
+CACHE_FILE='.batch_hole_map.json'
+IMAGE_SIZE=768
+CHANNELS=(('all', ''), ('armB', '_blue'), ('armR', '_red'))
+
+#Parsed plates by file, filled before the pool is created so the workers
+# inherit them
+_plates={}
+
+def inputFiles(file):
+    """ Return the .asc & .res files plateHoleInfo reads for plate file """
+    dir=os.path.dirname(file)+os.path.sep
+    plateName=os.path.basename(file)[0:-4]
+    return [file, dir+plateName.replace('Sum','plate')+'.res']
+
+def inputHash(file):
+    """ Return the hex sha1 of the input files of plate file """
+    h=hashlib.sha1()
+    for f in inputFiles(file):
+        with open(f, 'rb') as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+def loadCache(outdir):
+    try:
+        with open(os.path.join(outdir, CACHE_FILE), 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+def saveCache(outdir, cache):
+    with open(os.path.join(outdir, CACHE_FILE), 'w') as fp:
+        json.dump(cache, fp, indent=1)
+
+def isCurrent(entry, hash, ext):
+    """
+    Return true if the cache entry is for the same input & image format and
+    its outputs exist. Entries without a format predate --svg, so are bitmaps.
+    """
+    return (entry is not None and entry['hash']==hash and
+            entry.get('ext', '.bmp')==ext and
+            all(os.path.exists(f) for f in entry['outputs']))
 
-dir='/Users/One/Documents/Mario_Research/plate_routing/plates/'
-files=['1_2_3_Sum.asc','411.1_411.2_Sum.asc','419.1_353.1_419.2_353.2_Sum.asc','1651.1_1846.1_1651.2_1846.2_Sum.asc','2155.1_2213.1_2155.2_2213.2_Sum.asc','n431n471n729n601n356_Sum.asc','n512n637n686n241n257n295_Sum.asc','A_B_Sum.asc']
+def render((file, setup, channel, outfile)):
+    """ Render & save one image, return (outfile, seconds) """
+    t=time.time()
+    ic=FastImageCanvas.FastImageCanvas(IMAGE_SIZE, IMAGE_SIZE, 1.0, 1.0)
+    _plates[file].drawImage(ic, channel=channel, active_setup=setup)
+    ic.save(outfile)
+    return outfile, time.time()-t
 
-p=Plate.Plate()
-for f in files:
-    file=dir+f
+def prepare(file, outdir, timings, ext='.bmp'):
+    """
+    Load & regionify plate file and write its map files, return the list of
+    render jobs and the list of output files
+    """
+    t=time.time()
+    p=Plate.Plate()
     p.loadHoles(file)
+    _plates[file]=p
+    timings['load']+=time.time()-t
+
+    t=time.time()
     for s in p.setups.keys():
         p.regionify(active_setup=s)
-        ic=ImageCanvas.ImageCanvas(768, 768, 1.0, 1.0)
-        p.drawImage(ic,channel='armB',active_setup=s)
-        ic.save(file+'_'+s+'_blue.bmp')
-        ic=ImageCanvas.ImageCanvas(768, 768, 1.0, 1.0)
-        p.drawImage(ic,channel='armR',active_setup=s)
-        ic.save(file+'_'+s+'_red.bmp')
-        ic=ImageCanvas.ImageCanvas(768, 768, 1.0, 1.0)
-        p.drawImage(ic,active_setup=s)
-        ic.save(file+'_'+s+'.bmp')
-        p.writeMapFile(dir, s)
\ No newline at end of file
+    timings['regionify']+=time.time()-t
+
+    t=time.time()
+    jobs=[]
+    outputs=[]
+    for s in p.setups.keys():
+        p.writeMapFile(outdir+os.path.sep, s)
+        outputs.append(os.path.join(outdir, p.plate_name+'_'+s+'.map'))
+        for channel, suffix in CHANNELS:
+            outfile=os.path.join(outdir,
+                                 os.path.basename(file)+'_'+s+suffix+ext)
+            jobs.append((file, s, channel, outfile))
+            outputs.append(outfile)
+    timings['map']+=time.time()-t
+    return jobs, outputs
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Batch hole mapper')
+    parser.add_argument('files', nargs='+', help='_Sum.asc plate files')
+    parser.add_argument('-o', dest='outdir', default=None,
+                        help='output directory (default: that of each file)')
+    parser.add_argument('-j', dest='jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='render processes')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='remap plates even if unchanged')
+    parser.add_argument('--svg', dest='svg', action='store_true',
+                        help='write SVG images instead of bitmaps')
+    args=parser.parse_args()
+
+    timings=dict.fromkeys(('load', 'regionify', 'map', 'render', 'workers'), 0.0)
+    caches={}
+    pending={}
+    jobs=[]
+    ext='.svg' if args.svg else '.bmp'
+    for file in map(os.path.abspath, args.files):
+        outdir=args.outdir or os.path.dirname(file)
+        cache=caches.setdefault(outdir, loadCache(outdir))
+        try:
+            hash=inputHash(file)
+            if not args.force and isCurrent(cache.get(file), hash, ext):
+                print 'Skipping %s, unchanged' % file
+                continue
+            fileJobs, outputs=prepare(file, outdir, timings, ext)
+        except Exception, e:
+            print 'Could not map %s: %s' % (file, e)
+            continue
+        jobs.extend(fileJobs)
+        pending[file]=(outdir, {'hash':hash, 'ext':ext, 'outputs':outputs})
+
+    t=time.time()
+    failed=set()
+    if jobs:
+        if args.jobs > 1:
+            pool=multiprocessing.Pool(min(args.jobs, len(jobs)))
+            results=pool.imap_unordered(render, jobs)
+        else:
+            results=(render(j) for j in jobs)
+        try:
+            for outfile, seconds in results:
+                timings['workers']+=seconds
+        except Exception, e:
+            print 'Rendering failed: %s' % e
+            failed.update(pending)
+        if args.jobs > 1:
+            pool.close()
+            pool.join()
+    timings['render']=time.time()-t
+
+    for file, (outdir, entry) in pending.items():
+        if file not in failed:
+            caches[outdir][file]=entry
+    for outdir, cache in caches.items():
+        saveCache(outdir, cache)
+
+    print ('%i plates, %i images: load %.2fs  regionify %.2fs  maps %.2fs  '
+           'render %.2fs (%.2fs in %i processes)' % (len(pending), len(jobs),
+           timings['load'], timings['regionify'], timings['map'],
+           timings['render'], timings['workers'], max(1, args.jobs)))
@@ -57,7 +57,10 @@ class ascfile(platefile):
         setup['nAqusition']=0
         setup['nGuide']=0
         setup['nScience']=0
-        for line in setup['setup_lines']:
+        #index of the first occurrence of each line, for getLineNumOfHole
+        setup['line_index']={}
+        for i, line in enumerate(setup['setup_lines']):
+            setup['line_index'].setdefault(line, i)
             words=line.split()
             if (words[4] == 'O' or words[4]=='S'):
                 #Line is for a science fiber
@@ -73,7 +76,14 @@ class ascfile(platefile):
                 pass
 
     def getLineNumOfHole(self, hole, setup):
-        return self.setups[setup]['setup_lines'].index(hole.idstr)
+        """ Return the number of the line of hole in setup. A nonexistent
+            setup is a KeyError, a hole not in the setup a ValueError """
+        try:
+            return self.setups[setup]['line_index'][hole.idstr]
+        except KeyError:
+            if setup in self.setups:
+                raise ValueError('Hole not in '+setup)
+            raise
         
     def getLineOfHole(self, hole, setup):
         linenum=self.getLineNumOfHole(hole, setup)
@@ -149,6 +159,7 @@ class plateHoleInfo:
     def __init__(self,dir,platename):
         self.rfile=resfile(dir+platename.replace('Sum','plate')+'.res')
         self.afile=ascfile(dir+platename+'.asc')
+        self._holeInfo={}
 
     def getHoleInfo(self, setupName, hole):
         '''Returns a line containing info about the hole requested,
@@ -156,7 +167,14 @@ class plateHoleInfo:
         "<sky Coords RA/DEC>  <plate Coords>  <hole type>  <additional info from .res file>"
         if there are no sky coordinates for the hole (such as for guide reference holes)
         then the sky coordinate string will be '00 00 00.00   00 00 00.0  0000.0'
+
+        Lines are cached by setup and hole line.
         '''
+        key=(setupName, hole.idstr)
+        try:
+            return self._holeInfo[key]
+        except KeyError:
+            pass
         try:
             linenum=self.afile.getLineNumOfHole(hole, setupName)
         except KeyError:
@@ -181,7 +199,9 @@ class plateHoleInfo:
             skycoords='00 00 00.00   00 00 00.0  0000.0'
             additnfo=''
 
-        return '  '.join([skycoords,platecoords,holetype,additnfo])
+        info='  '.join([skycoords,platecoords,holetype,additnfo])
+        self._holeInfo[key]=info
+        return info
         
     def getSetupInfo(self, setup):
         '''Returns a list of lines about the setup requested,
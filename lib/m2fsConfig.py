@@ -23,6 +23,7 @@ class m2fsConfig:
     getGalilLastPositions
     getGalilLastPosition
     getDataloggerLogfileNames
+    getDataloggerStoreDir
     """
     def __init__(self):
         pass
@@ -262,6 +263,15 @@ class m2fsConfig:
         dir=config.get('Directories','dataloggerDir')
         return dir+'datalogger_'+monthyear+'.log'
     
+    @staticmethod
+    def getDataloggerStoreDir():
+        """
+        Return the fully qualified datalogger LoggerStore directory
+        
+        string ends in a path seperator. The directory need not exist.
+        """
+        return m2fsConfig.getLogfileDir()+'store'+os.sep
+    
     @staticmethod
     def getLogfileDir():
         """
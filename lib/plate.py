@@ -1,6 +1,7 @@
 import ConfigParser, os.path
 from collections import defaultdict
 import operator
+import plateReader
 
 
 def Plate(file):
@@ -16,6 +17,8 @@ class Hole(object):
     
     Holes have x,y,z coordinates
     """
+    __slots__=('x', 'y', 'radius', 'tag', 'ID')
+
     def __init__(self, x, y, r, optional_tag=None):
         self.x=float(x)
         self.y=float(y)
@@ -38,6 +41,8 @@ class Fiber(object):
     
     Fibers are named, Fibers are equal if they have the same name.
     """
+    __slots__=('name',)
+
     def __init__(self, name):
         self.name=name
     
@@ -59,7 +64,8 @@ class Setup(object):
     def __init__(self, setupAttributes, targetDictList, guideDictList):
         """
         setupAttributes must have name
-        Target list:[header_record_str, (fiber_str_i, target_record_i), ...]
+        targetDictList & guideDictList are plateReader.RecordSections (or
+        lists of record dicts), targets must have fiber & id columns
         """
         self.name=setupAttributes['name']
         self.attrib=setupAttributes.copy()
@@ -67,11 +73,22 @@ class Setup(object):
         self._guide_list=guideDictList
         self.attrib['n']=self.n_fibers_used()
     
+    def _fiberIDs(self):
+        """ Return (fiber, id) pairs of the targets """
+        try:
+            return zip(self._target_list.column('fiber'),
+                       self._target_list.column('id'))
+        except AttributeError:
+            return [(t['fiber'], t['id']) for t in self._target_list]
+
     def get_nominal_fiber_hole_dict(self):
-        return {t['fiber']:t['id'] for t in self._target_list if t['id']}
+        return {fiber:id for fiber, id in self._fiberIDs() if id}
 
     def n_fibers_used(self):
-        return len([t for t in self._target_list if t['id']])
+        try:
+            return len([id for id in self._target_list.column('id') if id])
+        except AttributeError:
+            return len([t for t in self._target_list if t['id']])
 
 
 class NullSetup(object):
@@ -613,21 +630,25 @@ class PlugPlate(object):
         Plate file is vetted prior to loading. All errors found are returned as
         the description of the InvalidPlate exception which will be raised.
         Errors are /n seperated to ease dumping to a file with str(exception)
+
+        The file is read with plateReader.PlateFile, plate_holes and the setup
+        target & guide lists are plateReader.RecordSections.
         """
-        plateConfig=PlateConfigParser(file)
+        plateConfig=plateReader.PlateFile(file)
         self._plateConfig=plateConfig
         self.name=plateConfig.get('Plate', 'name')
         self.n_setups=len(plateConfig.setup_sections())
         self.plate_holes=plateConfig.get_plate_holes()
         self.file_version=plateConfig.file_version()
+        holesOfType=self._holesOfType
         if plateConfig.file_version() == '0.1':
             self.shackhartman=None
             self.mechanical=[]
         else:
-            self.shackhartman=[x for x in self.plate_holes if x['type']=='C'][0]
-            self.mechanical=[x for x in self.plate_holes if x['type'] in 'FT']
+            self.shackhartman=holesOfType('C')[0]
+            self.mechanical=holesOfType('F', 'T')
         try:
-            self.standard=[x for x in self.plate_holes if x['type']=='O'][0]
+            self.standard=holesOfType('O')[0]
             self.standard_offset=plateConfig.get('Plate','offset')
         except IndexError:
             self.standard={}
@@ -639,6 +660,12 @@ class PlugPlate(object):
             targets=plateConfig.get_targets(setup)
             guides=plateConfig.get_guides(setup)
             self.setups[attrib['name']]=Setup(attrib, targets, guides)
+
+    def _holesOfType(self, *types):
+        """ Return the plate hole dicts of the given type codes """
+        if not self.plate_holes:
+            return []
+        return self.plate_holes.rowsOfType(*types)
     
     def getSetup(self, setup):
         """
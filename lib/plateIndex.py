@@ -0,0 +1,135 @@
+"""
+Persistent sqlite index of plate files
+
+Holds each plate's name, file path, mtime, size, & content hash, its hole &
+setup counts, and the name, fiber count, & guide count of each of its setups,
+so plates & their setups can be listed without opening any plate file. The
+index is brought up to date incrementally: only plate files whose mtime or
+size have changed are parsed.
+"""
+import os, sqlite3, hashlib, threading, logging
+import plate
+
+SCHEMA="""
+CREATE TABLE IF NOT EXISTS plates (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    n_holes INTEGER NOT NULL,
+    n_setups INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS setups (
+    plate TEXT NOT NULL REFERENCES plates(name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    n_fibers INTEGER NOT NULL,
+    n_guides INTEGER NOT NULL,
+    PRIMARY KEY (plate, name));
+"""
+
+def fileHash(path):
+    """ Return the hex sha1 of the contents of path """
+    h=hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class PlateIndex(object):
+    """
+    A sqlite index of plates, safe for use from multiple threads
+
+    Plates are keyed by name, the platefile name without the .plate extension.
+    """
+    def __init__(self, path):
+        self.logger=logging.getLogger('PlateIndex')
+        self.lock=threading.Lock()
+        self._db=sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory=str
+        self._db.execute('PRAGMA foreign_keys=ON')
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        with self.lock:
+            self._db.close()
+
+    def isCurrent(self, name, path):
+        """ Return true if the entry for name matches path's mtime & size """
+        stat=os.stat(path)
+        with self.lock:
+            row=self._db.execute('SELECT path, mtime, size FROM plates '
+                                 'WHERE name=?', (name,)).fetchone()
+        return row is not None and tuple(row)==(path, stat.st_mtime,
+                                                 stat.st_size)
+
+    def add(self, name, path, parsedPlate=None):
+        """
+        Add or replace the entry for plate name at path
+
+        The plate is parsed if parsedPlate, a PlugPlate of the file, is not
+        given. Raises IOError or plate.InvalidPlate if the file can't be read
+        or parsed.
+        """
+        stat=os.stat(path)
+        sha1=fileHash(path)
+        if parsedPlate is None:
+            parsedPlate=plate.Plate(path)
+        setups=[(name, s.name, s.n_fibers_used(), len(s._guide_list))
+                for s in parsedPlate.setups.values()]
+        with self.lock:
+            with self._db:
+                self._db.execute('DELETE FROM plates WHERE name=?', (name,))
+                self._db.execute('INSERT INTO plates VALUES (?,?,?,?,?,?,?)',
+                                 (name, path, stat.st_mtime, stat.st_size, sha1,
+                                  len(parsedPlate.plate_holes), len(setups)))
+                self._db.executemany('INSERT INTO setups VALUES (?,?,?,?)',
+                                     setups)
+
+    def remove(self, name):
+        """ Remove the entry for plate name, if any """
+        with self.lock:
+            with self._db:
+                self._db.execute('DELETE FROM plates WHERE name=?', (name,))
+
+    def sync(self, plates):
+        """
+        Bring the index up to date with plates, a dict of name:path
+
+        Entries for plates not in plates are removed and those which are
+        missing or out of date are (re)parsed. Return a list of the names of
+        plates which could not be indexed.
+        """
+        with self.lock:
+            indexed=[r[0] for r in self._db.execute('SELECT name FROM plates')]
+        for name in indexed:
+            if name not in plates:
+                self.remove(name)
+        failed=[]
+        for name, path in plates.items():
+            try:
+                if not self.isCurrent(name, path):
+                    self.logger.info('Indexing plate %s' % name)
+                    self.add(name, path)
+            except Exception, e:
+                self.logger.error('Could not index plate %s: %s' % (name, e))
+                self.remove(name)
+                failed.append(name)
+        return failed
+
+    def setupSummaries(self):
+        """
+        Return a list of (plate name, n_holes, [(setup name, n_fibers), ...])
+        for all plates, sorted by plate name
+        """
+        with self.lock:
+            plates=self._db.execute('SELECT name, n_holes FROM plates '
+                                    'ORDER BY name').fetchall()
+            setups=self._db.execute('SELECT plate, name, n_fibers FROM setups '
+                                    'ORDER BY plate, name').fetchall()
+        bySetup={}
+        for plateName, name, nFibers in setups:
+            bySetup.setdefault(plateName, []).append((name, nFibers))
+        return [(name, nHoles, bySetup.get(name, []))
+                for name, nHoles in plates]
@@ -0,0 +1,300 @@
+"""
+Single pass reader for .plate files (format versions 0.1-0.3)
+
+PlateFile reads a plate file the way ConfigParser.RawConfigParser would
+(sections, key=value or key: value options with lowercased keys, # and ;
+comments, inline ; comments, continuation lines, later options replacing
+earlier ones) without the per line regular expressions. The list sections
+(PlateHoles, SetupN:Targets, SetupN:Guide, & SetupN:Unused) are converted
+to RecordSections: one column per header field rather than one dict per
+record. x, y, z, & r are also available as float arrays.
+
+PlateFile provides the subset of the PlateConfigParser interface PlugPlate
+uses to load a plate.
+"""
+import ConfigParser, os.path
+from array import array
+import plate
+
+INTERNED_COLUMNS=('type',)
+
+def _extract_tab_quote_list(s):
+    return [x[1:-1] for x in s.split('\t')]
+
+def _toFloat(s):
+    try:
+        return float(s)
+    except ValueError:
+        return float('nan')
+
+
+class RecordSection(object):
+    """
+    The records of a plate file list section, stored by column
+
+    Columns are named by the section's H record and hold the string values.
+    If keep_key_as is given the record keys (uppercased) are kept as the
+    column of that name. Type codes and record keys are interned. Rows may be
+    retrieved as dicts, as PlateConfigParser returned them, with row(i) or by
+    iterating; only those rows asked for are built. Rows are indexed by type
+    code on first use so selecting e.g. the 'C' hole doesn't scan the section.
+    """
+    def __init__(self, section, header, records, keep_key_as=None):
+        if '\t' in header:
+            names=[n.lower() for n in _extract_tab_quote_list(header)]
+            split=_extract_tab_quote_list
+        else:
+            names=header.lower().split()
+            split=str.split
+        rows=[]
+        n=len(names)
+        for key, value in records:
+            vals=split(value)
+            if len(vals) < n:
+                raise plate.InvalidPlate('%s record %s has %i of %i values\n' %
+                                   (section, key, len(vals), n))
+            rows.append(vals[:n])
+        self.names=[]
+        self.columns={}
+        columns=zip(*rows) if rows else [()]*n
+        for name, column in zip(names, columns):
+            if name in INTERNED_COLUMNS:
+                column=tuple(intern(v) for v in column)
+            if name not in self.columns:
+                self.names.append(name)
+            self.columns[name]=column
+        if keep_key_as:
+            if keep_key_as not in self.columns:
+                self.names.append(keep_key_as)
+            self.columns[keep_key_as]=tuple(intern(k.upper())
+                                            for k,v in records)
+        self._n=len(records)
+        self._floats={}
+        self._typeIndex=None
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for i in xrange(self._n):
+            yield self.row(i)
+
+    def __getitem__(self, i):
+        return self.row(i)
+
+    def column(self, name):
+        """ Return the tuple of string values of column name or KeyError """
+        return self.columns[name]
+
+    def floats(self, name):
+        """
+        Return column name (e.g. x, y, z, or r) as an array of doubles, NaN
+        where the value isn't a number
+        """
+        if name not in self._floats:
+            self._floats[name]=array('d', map(_toFloat, self.columns[name]))
+        return self._floats[name]
+
+    def row(self, i):
+        """ Return record i as a dict of column name:value """
+        return dict((name, self.columns[name][i]) for name in self.names)
+
+    def typeIndex(self):
+        """ Return a dict of type code:array of the indices of that type """
+        if self._typeIndex is None:
+            index={}
+            for i, t in enumerate(self.columns['type']):
+                try:
+                    index[t].append(i)
+                except KeyError:
+                    index[t]=array('i', (i,))
+            self._typeIndex=index
+        return self._typeIndex
+
+    def rowsOfType(self, *types):
+        """ Return the rows with any of the type codes types, in file order """
+        index=self.typeIndex()
+        return [self.row(i) for i in sorted(i for t in types
+                                            for i in index.get(t, ()))]
+
+
+class _Section(dict):
+    """ A dict which remembers the order its keys were first set in """
+    def __init__(self):
+        dict.__init__(self)
+        self.order=[]
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.order.append(key)
+        dict.__setitem__(self, key, value)
+
+    def pop(self, key):
+        self.order.remove(key)
+        return dict.pop(self, key)
+
+    def items(self):
+        return [(k, self[k]) for k in self.order]
+
+
+class PlateFile(object):
+    """
+    A plate file read in a single pass
+
+    Raises InvalidPlate if the file name has spaces or a line can't be parsed
+    and IOError if the file can't be read. get() and items() raise the
+    ConfigParser NoSectionError & NoOptionError.
+    """
+    def __init__(self, file):
+        #Platefiles may not have spaces in their filenames
+        if ' ' in os.path.basename(file):
+            raise plate.InvalidPlate('Filenames may not have spaces\n')
+        self.plate_filename=file
+        self._defaults=_Section()
+        self._sections=_Section()
+        with open(file, 'r') as f:
+            self._read(f)
+        if self.has_option('Plate','std_offset'):
+            plateSection=self._sections['Plate']
+            plateSection['offset']=plateSection.pop('std_offset')
+        self._records={}
+
+    def _read(self, f):
+        """ Tokenize the file as RawConfigParser._read would """
+        section=None
+        option=None
+        errors=[]
+        for lineno, line in enumerate(f, 1):
+            stripped=line.strip()
+            if not stripped or line[0] in '#;':
+                continue
+            if line[:3].lower()=='rem' and line.split(None, 1)[0].lower()=='rem':
+                continue
+            #Continuation line
+            if line[0].isspace() and section is not None and option:
+                section[option]+='\n'+stripped
+                continue
+            #Section header
+            if line[0]=='[':
+                end=line.find(']')
+                if end > 1:
+                    name=line[1:end]
+                    if name=='DEFAULT':
+                        section=self._defaults
+                    else:
+                        section=self._sections.get(name)
+                        if section is None:
+                            section=self._sections[name]=_Section()
+                    option=None
+                    continue
+            if section is None:
+                raise plate.InvalidPlate('File contains no section headers.\n'
+                                   'file: %s, line: %i\n%r\n' %
+                                   (self.plate_filename, lineno, line))
+            colon=line.find(':')
+            equals=line.find('=')
+            sep=min(colon, equals) if colon >= 0 and equals >= 0 else max(colon,
+                                                                          equals)
+            key=line[:sep].rstrip()
+            if sep < 0 or not key or line[0] in ':=' or line[0].isspace():
+                errors.append('\t[line %2d]: %r' % (lineno, line))
+                continue
+            value=line[sep+1:].lstrip()
+            comment=value.find(';')
+            if comment > 0 and value[comment-1].isspace():
+                value=value[:comment]
+            value=value.strip()
+            if value=='""':
+                value=''
+            option=key.lower()
+            section[option]=value
+        if errors:
+            raise plate.InvalidPlate('File contains parsing errors: %s\n%s\n' %
+                               (self.plate_filename, '\n'.join(errors)))
+
+    def sections(self):
+        return list(self._sections.order)
+
+    def has_section(self, section):
+        return section in self._sections
+
+    def has_option(self, section, option):
+        return (section in self._sections and
+                (option in self._sections[section] or
+                 option in self._defaults))
+
+    def get(self, section, option):
+        if section not in self._sections:
+            raise ConfigParser.NoSectionError(section)
+        option=option.lower()
+        if option in self._sections[section]:
+            return self._sections[section][option]
+        if option in self._defaults:
+            return self._defaults[option]
+        raise ConfigParser.NoOptionError(option, section)
+
+    def items(self, section):
+        if section not in self._sections:
+            raise ConfigParser.NoSectionError(section)
+        if not self._defaults:
+            return self._sections[section].items()
+        d=_Section()
+        for k, v in self._defaults.items()+self._sections[section].items():
+            d[k]=v
+        return d.items()
+
+    def setup_sections(self):
+        """Return setup section names only"""
+        sec=[j for j in self.sections() if j[:5]=='Setup' and ':' not in j]
+        return sorted(sec,key=lambda s: int(s[5:]))
+
+    def file_version(self):
+        return self.get('Plate','formatversion')
+
+    def setup_attrib(self,setup):
+        """Get the setup attribute dict"""
+        #Post process (ra,de) and (az,el) keys
+        attrib=dict(self.items(setup))
+        try:
+            azel=attrib.pop('(az,el)').split(',')
+            attrib['az']=azel[0].strip('() ')
+            attrib['el']=azel[1].strip('() ')
+        except KeyError:
+            pass
+        try:
+            rade=attrib.pop('(ra,de)').split(',')
+            attrib['ra']=rade[0].strip('() ')
+            attrib['de']=rade[1].strip('() ')
+        except KeyError:
+            pass
+        return attrib
+
+    def _recordSection(self, section, keep_key_as=None):
+        """ Return the RecordSection for section, converting it if needed """
+        if section not in self._records:
+            header=self.get(section, 'H')
+            records=[r for r in self.items(section) if r[0]!='h']
+            if not records:
+                return []
+            if records[0][0][0]=='t':
+                keep_key_as=None  #v.1 target sections have no fiber names
+            self._records[section]=RecordSection(section, header, records,
+                                                 keep_key_as=keep_key_as)
+        return self._records[section]
+
+    def get_targets(self, setup_section):
+        """Return the RecordSection of targets for setup section or []"""
+        return self._recordSection(setup_section+':Targets',
+                                   keep_key_as='fiber')
+
+    def get_guides(self, setup_section):
+        """Return the RecordSection of guides for setup section or []"""
+        if not self.has_section(setup_section+':Guide'):
+            return []
+        return self._recordSection(setup_section+':Guide')
+
+    def get_plate_holes(self):
+        """Return the RecordSection of plate holes or []"""
+        if not self.has_section('PlateHoles'):
+            return []
+        return self._recordSection('PlateHoles')
@@ -0,0 +1,12 @@
+'''
+Software simulators of the M2FS serial hardware
+
+Each simulator serves a pseudo-terminal which agents and SelectedSerial
+connections may open in place of the device's serial port. See
+simulatedDevice.py for the latency & error injection options common to all
+of them, and bin/hardwareSimulator.py to run them.
+'''
+from simulatedDevice import SimulatedDevice
+from galilSim import GalilSimulator
+from shoeSim import ShoeSimulator
+from pololuSim import MaestroSimulator, SMCSimulator, LEDSimulator
@@ -0,0 +1,202 @@
+'''
+Simulated Galil DMC-4183 running m2fs.dmc
+
+Commands are separated by ';' and terminated by '\r'. Each is answered with
+':' if accepted, '?' if not, or 'data\r\n:' if it returns data (MG). The
+simulator understands what galil.GalilSerial sends:
+    MG of string literals, variables, _HXn, _AB, & @IN[n]
+    variable=value assignment, including array elements (felencp[0]=...)
+    XQ#PROGRAM,thread & HXn
+    RS
+Other two letter commands are accepted and ignored. Lines longer than the
+galil's 80 character limit (with the terminator) are rejected.
+
+XQ of one of the m2fs.dmc motion programs marks the thread as executing for
+the duration of the move, the axis reports MOVING meanwhile, and at the end
+of the move the axis takes its new position (from a[thread] for the programs
+which take an argument). XQ of a status program (e.g. #GETFILT on thread 7)
+reports the axis as m2fs.dmc does, e.g. 'GETFILT: 3\r\n'.
+'''
+import re
+from simulatedDevice import TextDevice
+
+M2FS_VERSION=0.2
+#Threads 0-2 run #AUTO, #ANAMAF, & #MOMONI from power-on
+BOOT_THREADS={0:'AUTO', 1:'ANAMAF', 2:'MOMONI'}
+N_THREADS=8
+MAX_LINE_LENGTH=79
+#Seconds a status program runs before reporting
+QUERY_TIME=0.02
+#Status programs: axis reported
+QUERIES={'GETFILT':'FILTER', 'GETLRTL':'LREL', 'GETHRTL':'HREL',
+         'GETHRAZ':'HRAZ', 'GETGES2':'GES', 'GETFOC':'FOCUS',
+         'GETFLSI':'FLSIM', 'GETFESI':'FESIN'}
+#Motion programs: (axis moved, seconds, final position), position ARG is the
+# value of a[thread] & None leaves the position unchanged
+ARG='a[]'
+MOTIONS={
+    'PICKFIL':('FILTER', 12.0, ARG),
+    'SETLRTL':('LREL', 5.0, ARG), 'SETHRTL':('HREL', 5.0, ARG),
+    'SETHRAZ':('HRAZ', 5.0, ARG), 'SETFOC':('FOCUS', 3.0, ARG),
+    'HIRES':('GES', 20.0, 'HIRES'), 'LORES':('GES', 20.0, 'LORES'),
+    'LRSWAP':('GES', 25.0, 'LRSWAP'), 'NUDGGES':('GES', 1.0, None),
+    'INFESIN':('FESIN', 2.0, 'IN'), 'RMFESIN':('FESIN', 2.0, 'OUT'),
+    'INFLSIN':('FLSIM', 2.0, 'IN'), 'RMFLSIN':('FLSIM', 2.0, 'OUT'),
+    'CALLRT':('LREL', 15.0, '0'), 'CALHRTL':('HREL', 15.0, '0'),
+    'CALHRAZ':('HRAZ', 15.0, '0'), 'CALGES':('GES', 30.0, 'LORES'),
+    'SHTDWN':(None, 2.0, None)}
+INITIAL_POSITIONS={'FILTER':'9', 'LREL':'0', 'HREL':'0', 'HRAZ':'0',
+                   'GES':'LORES', 'FOCUS':'0', 'FLSIM':'OUT', 'FESIN':'IN'}
+
+_ASSIGNMENT=re.compile(r'^([A-Za-z][A-Za-z0-9]*(?:\[\d+\])?)=(.+)$')
+_XQ=re.compile(r'^XQ\s*#(\w+)\s*(?:,\s*(\d))?$')
+_HX=re.compile(r'^HX\s*(\d)?$')
+
+def splitStatements(string, separator):
+    """ Split string on separator, ignoring separators in quotes """
+    parts=['']
+    quoted=False
+    for c in string:
+        if c=='"':
+            quoted=not quoted
+        if c==separator and not quoted:
+            parts.append('')
+        else:
+            parts[-1]+=c
+    return parts
+
+def formatNumber(value):
+    """ Format value as the galil does: 4 decimals, a leading space if >=0 """
+    return ('%.4f' if value < 0 else ' %.4f') % value
+
+class GalilSimulator(TextDevice):
+    """ A Galil running the M2FS firmware """
+    TERMINATORS='\r\n'
+
+    def __init__(self, name='galil', **kwargs):
+        TextDevice.__init__(self, name, **kwargs)
+        self.inputs={}
+        self.abort=False
+        self._threadRuns=[0]*N_THREADS
+        self.boot()
+
+    def boot(self):
+        """ Return to the power-on state """
+        self.variables={'m2fsver':M2FS_VERSION, 'bootup1':1.0}
+        self.positions=dict(INITIAL_POSITIONS)
+        self.moving={}
+        self.threads=dict.fromkeys(range(N_THREADS))
+        self.threads.update(BOOT_THREADS)
+        #Orphan the timers of whatever was running
+        self._threadRuns=[run+1 for run in self._threadRuns]
+
+    def errorReply(self, line):
+        return '?'*len(splitStatements(line, ';'))
+
+    def answer(self, line):
+        if len(line) > MAX_LINE_LENGTH:
+            return self.errorReply(line)
+        return ''.join(self.execute(s.strip())
+                       for s in splitStatements(line, ';'))
+
+    def execute(self, statement):
+        """ Execute one command, return its reply """
+        try:
+            if statement.startswith('MG'):
+                return self.message(statement[2:])+'\r\n:'
+            match=_XQ.match(statement)
+            if match:
+                self.startThread(int(match.group(2) or 0), match.group(1))
+                return ':'
+            match=_HX.match(statement)
+            if match:
+                if match.group(1) is None:
+                    for thread in range(N_THREADS):
+                        self.haltThread(thread)
+                else:
+                    self.haltThread(int(match.group(1)))
+                return ':'
+            if statement=='RS':
+                self.boot()
+                return ':'
+            match=_ASSIGNMENT.match(statement)
+            if match:
+                self.variables[match.group(1)]=self.evaluate(match.group(2))
+                return ':'
+            if re.match('^[A-Z]{2}', statement):
+                return ':'
+        except (KeyError, ValueError, IndexError):
+            pass
+        return '?'
+
+    def evaluate(self, expression):
+        """ Return the value of a number, variable, or operand """
+        expression=expression.strip()
+        if expression.startswith('_HX'):
+            return 0.0 if self.threads[int(expression[3:])] is None else 1.0
+        if expression=='_AB':
+            return 0.0 if self.abort else 1.0
+        if expression.startswith('@IN['):
+            return float(self.inputs.get(int(expression[4:-1]), 1))
+        try:
+            return float(expression)
+        except ValueError:
+            return self.variables[expression]
+
+    def message(self, arguments):
+        """ Return the output of MG with arguments """
+        out=''
+        for arg in splitStatements(arguments.strip(), ','):
+            arg=arg.strip()
+            if arg.startswith('"'):
+                out+=arg.strip('"')
+            else:
+                out+=formatNumber(self.evaluate(arg))
+        return out
+
+    def startThread(self, thread, program):
+        """ Execute program on thread, replacing what is running """
+        if (program not in MOTIONS and program not in QUERIES and
+            program not in BOOT_THREADS.values()):
+            raise KeyError(program)
+        self.haltThread(thread)
+        self.threads[thread]=program
+        run=self._threadRuns[thread]
+        if program in QUERIES:
+            self.after(QUERY_TIME, self.report, thread, run, program)
+        elif program in MOTIONS:
+            axis, seconds, position=MOTIONS[program]
+            if position==ARG:
+                position='%i' % self.variables.get('a[%i]' % thread, 0)
+            if axis:
+                self.moving[axis]=thread
+            self.after(seconds, self.finishMotion, thread, run, axis, position)
+
+    def haltThread(self, thread):
+        """ Stop thread, a halted move leaves its axis where it was """
+        self._threadRuns[thread]+=1
+        self.threads[thread]=None
+        for axis, t in self.moving.items():
+            if t==thread:
+                del self.moving[axis]
+
+    def report(self, thread, run, program):
+        """ End a status program, sending its report """
+        if self._threadRuns[thread]!=run:
+            return
+        self.threads[thread]=None
+        axis=QUERIES[program]
+        if axis in self.moving:
+            self.send('%s: MOVING\r\n' % program)
+        else:
+            self.send('%s: %s\r\n' % (program, self.positions[axis]))
+
+    def finishMotion(self, thread, run, axis, position):
+        """ End a motion program, moving the axis to position """
+        if self._threadRuns[thread]!=run:
+            return
+        self.threads[thread]=None
+        if axis:
+            self.moving.pop(axis, None)
+            if position is not None:
+                self.positions[axis]=position
@@ -0,0 +1,202 @@
+'''
+Simulated binary protocol devices: the guider's Pololu Micro Maestro, the
+Shack-Hartman lenslet's Pololu Simple Motor Controller (SMC), and the
+Shack-Hartman LED controller (shLED.ino)
+
+The Pololu controllers speak the Pololu compact protocol: a command byte
+(>= 0x80) followed by data bytes (< 0x80), replies are binary and little
+endian, see maestro.pdf & simple_motor_controllers.pdf. Data bytes received
+outside a command are ignored and unknown command bytes set the serial
+protocol error bit. A rejected command (error injection) sets the serial
+error bit of the controller and is not answered.
+'''
+import time
+from simulatedDevice import SimulatedDevice
+
+def word(value):
+    """ Return value as 2 little endian bytes """
+    value=int(value) & 0xffff
+    return chr(value & 0xff)+chr(value>>8)
+
+class PololuDevice(SimulatedDevice):
+    """ A device speaking the Pololu compact protocol """
+    #Command byte: number of data bytes
+    COMMANDS={}
+    SERIAL_ERROR=0
+    PROTOCOL_ERROR=0
+
+    def __init__(self, name, **kwargs):
+        SimulatedDevice.__init__(self, name, **kwargs)
+        self.errors=0
+
+    def nextCommand(self, buffer):
+        command=ord(buffer[0])
+        if command < 0x80:
+            return None, 1
+        if command not in self.COMMANDS:
+            self.errors|=self.PROTOCOL_ERROR
+            return None, 1
+        length=1+self.COMMANDS[command]
+        if len(buffer) < length:
+            return None, 0
+        return buffer[:length], length
+
+    def errorReply(self, command):
+        self.errors|=self.SERIAL_ERROR
+        return ''
+
+
+class MaestroSimulator(PololuDevice):
+    """
+    A Micro Maestro servo controller
+
+    Servo positions are in quarter-microseconds and slew towards their
+    targets at SERVO_RATE.
+    """
+    SET_TARGET=0x84
+    GET_POSITION=0x90
+    GET_MOVING=0x93
+    GET_ERRORS=0xA1
+    GO_HOME=0xA2
+    COMMANDS={SET_TARGET:3, GET_POSITION:1, GET_MOVING:0, GET_ERRORS:0,
+              GO_HOME:0}
+    SERIAL_ERROR=0x0001
+    PROTOCOL_ERROR=0x0010
+    N_CHANNELS=6
+    HOME=6000 #quarter-microseconds
+    SERVO_RATE=4000.0 #quarter-microseconds/s
+
+    def __init__(self, name='maestro', **kwargs):
+        PololuDevice.__init__(self, name, **kwargs)
+        now=time.time()
+        #(position, target, time position was set) for each channel
+        self.channels=[(self.HOME, self.HOME, now)]*self.N_CHANNELS
+
+    def position(self, channel):
+        start, target, t=self.channels[channel]
+        travel=(time.time()-t)*self.SERVO_RATE/self.timeScale
+        if abs(target-start) <= travel:
+            return target
+        return start+travel if target > start else start-travel
+
+    def setTarget(self, channel, target):
+        self.channels[channel]=(self.position(channel), target, time.time())
+
+    def answer(self, command):
+        code=ord(command[0])
+        if code==self.SET_TARGET:
+            channel=ord(command[1])
+            if channel < self.N_CHANNELS:
+                self.setTarget(channel, ord(command[2])+128*ord(command[3]))
+        elif code==self.GET_POSITION:
+            channel=ord(command[1])
+            if channel < self.N_CHANNELS:
+                return word(round(self.position(channel)))
+        elif code==self.GET_MOVING:
+            return chr(any(self.position(i)!=self.channels[i][1]
+                           for i in range(self.N_CHANNELS)))
+        elif code==self.GET_ERRORS:
+            errors, self.errors=self.errors, 0
+            return word(errors)
+        elif code==self.GO_HOME:
+            for i in range(self.N_CHANNELS):
+                self.setTarget(i, self.HOME)
+        return ''
+
+
+class SMCSimulator(PololuDevice):
+    """
+    A Simple Motor Controller driving the Shack-Hartman lenslet
+
+    The lenslet travels between the IN limit (AN2) & the OUT limit (AN1) in
+    TRAVEL_TIME at full speed, forward is OUT. A limit switch stops the motor
+    & reads high when tripped.
+    """
+    EXIT_SAFE_START=0x83
+    FORWARD=0x85
+    REVERSE=0x86
+    FORWARD_7BIT=0x89
+    REVERSE_7BIT=0x8A
+    BRAKE=0x92
+    GET_VARIABLE=0xA1
+    STOP=0xE0
+    COMMANDS={EXIT_SAFE_START:0, FORWARD:2, REVERSE:2, FORWARD_7BIT:1,
+              REVERSE_7BIT:1, BRAKE:1, GET_VARIABLE:1, STOP:0}
+    SERIAL_ERROR=0x0004
+    PROTOCOL_ERROR=0x0004
+    #Variable IDs
+    ERROR_STATUS=0
+    AN1_RAW=12
+    AN2_RAW=16
+    SPEED=21
+    TEMPERATURE=24
+    MAX_SPEED=3200
+    TRAVEL_TIME=2.0
+    LIMIT_TRIPPED=4095
+    TEMPERATURE_VALUE=215 #0.1 deg C
+
+    def __init__(self, name='smc', **kwargs):
+        PololuDevice.__init__(self, name, **kwargs)
+        #Lenslet position, 0 is IN & 1 is OUT, speed, & time they were set
+        self.motion=(0.0, 0, time.time())
+
+    def state(self):
+        """ Return the current (position, speed) """
+        x, speed, t=self.motion
+        x+=(time.time()-t)*speed/float(self.MAX_SPEED)/(
+            self.TRAVEL_TIME*self.timeScale)
+        if x <= 0.0 or x >= 1.0:
+            return min(max(x, 0.0), 1.0), 0
+        return x, speed
+
+    def drive(self, speed):
+        x, junk=self.state()
+        if (x >= 1.0 and speed > 0) or (x <= 0.0 and speed < 0):
+            speed=0
+        self.motion=(x, speed, time.time())
+
+    def variable(self, id):
+        x, speed=self.state()
+        if id==self.ERROR_STATUS:
+            errors, self.errors=self.errors, 0
+            return errors
+        if id==self.AN1_RAW:
+            return self.LIMIT_TRIPPED if x >= 1.0 else 0
+        if id==self.AN2_RAW:
+            return self.LIMIT_TRIPPED if x <= 0.0 else 0
+        if id==self.SPEED:
+            return speed
+        if id==self.TEMPERATURE:
+            return self.TEMPERATURE_VALUE
+        return 0
+
+    def answer(self, command):
+        code=ord(command[0])
+        if code==self.GET_VARIABLE:
+            return word(self.variable(ord(command[1])))
+        if code in (self.FORWARD, self.REVERSE):
+            speed=ord(command[1])+32*ord(command[2])
+        elif code in (self.FORWARD_7BIT, self.REVERSE_7BIT):
+            speed=ord(command[1])*self.MAX_SPEED/127
+        elif code in (self.BRAKE, self.STOP):
+            speed=0
+        else:
+            return ''
+        if code in (self.REVERSE, self.REVERSE_7BIT):
+            speed=-speed
+        self.drive(min(max(speed, -self.MAX_SPEED), self.MAX_SPEED))
+        return ''
+
+
+class LEDSimulator(SimulatedDevice):
+    """ The Shack-Hartman LED, each byte received sets the brightness """
+    def __init__(self, name='shled', **kwargs):
+        SimulatedDevice.__init__(self, name, **kwargs)
+        self.brightness=0
+
+    def nextCommand(self, buffer):
+        return buffer[0], 1
+
+    def answer(self, command):
+        self.brightness=ord(command)
+        return ''
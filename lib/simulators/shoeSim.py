@@ -0,0 +1,196 @@
+'''
+Simulated fiber shoe running fibershoe.ino
+
+Commands are two letters followed by an optional axis (A-H, or * for all
+tetri) and arguments, terminated by '\n'. They are answered as the firmware
+does, in the same framing as the Galil: ':' if accepted, '?' if not, or
+'data\r\n:' if the command returns data. Commands other than those the
+firmware allows offline answer 'Powered Down' until the shoe is connected
+with CS.
+
+The tetri move at STEP_RATE, report MOVING while moving, and must be driven
+to the hardstop (DH) before slit (SL) or absolute (PA) moves are allowed.
+'''
+from simulatedDevice import TextDevice
+
+VERSION_STRING='Fibershoe v1.3'
+#Commands the firmware executes when the shoe is offline
+OFFLINE_COMMANDS=('AC', 'BL', 'BG', 'CS', 'DM', 'DS', 'GH', 'HM', 'PC', 'PV',
+                  'SD', 'SS', 'TE', 'TS', 'ZB')
+#Other commands, accepted & ignored if not simulated
+ONLINE_COMMANDS=('AH', 'CY', 'DH', 'DP', 'DZ', 'MO', 'PA', 'PH', 'PR', 'SG',
+                 'SH', 'SL', 'SP', 'ST', 'TD', 'VE', 'VO')
+N_TETRI=8
+STEP_RATE=400.0 #steps/s
+HARDSTOP_POSITION=7500
+HARDSTOP_TIME=30.0
+SLIT_POSITIONS=(6500, 5600, 4700, 3800, 2900, 2000, 500)
+TEMPERATURE=18.5
+
+class Tetris(object):
+    """ Position state of a tetris """
+    def __init__(self):
+        self.position=0
+        self.calibrated=False
+        self.moving=False
+        self.slits=list(SLIT_POSITIONS)
+        self.moves=0
+
+    def slit(self):
+        """ Return the slit (1-7) at the position or None """
+        try:
+            return self.slits.index(self.position)+1
+        except ValueError:
+            return None
+
+    def state(self, value):
+        """ Return MOVING, UNKNOWN, or value """
+        if self.moving:
+            return 'MOVING'
+        if not self.calibrated:
+            return 'UNKNOWN'
+        return value
+
+
+class ShoeSimulator(TextDevice):
+    """ A fiber shoe """
+    TERMINATORS='\n'
+
+    def __init__(self, name='shoe', side='R', **kwargs):
+        TextDevice.__init__(self, name, **kwargs)
+        self.side=side
+        self.online=False
+        self.activeHold=False
+        self.tetri=[Tetris() for i in range(N_TETRI)]
+
+    def errorReply(self, command):
+        return '?'
+
+    def answer(self, command):
+        name=command[0:2]
+        if name not in OFFLINE_COMMANDS and name not in ONLINE_COMMANDS:
+            return '?'
+        if not self.online and name not in OFFLINE_COMMANDS:
+            return 'Powered Down\r\n:'
+        handler=getattr(self, 'command'+name, None)
+        try:
+            reply=handler(command[2:]) if handler else ''
+        except (ValueError, IndexError):
+            return '?'
+        if reply is None:
+            return '?'
+        return reply+'\r\n:' if reply else ':'
+
+    def axes(self, arg):
+        """ Return the tetri selected by axis character arg, or raise """
+        if arg[0]=='*':
+            return self.tetri
+        return [self.tetri['ABCDEFGH'.index(arg[0])]]
+
+    def move(self, tetris, position, seconds=None):
+        """ Start a move of tetris to position """
+        if seconds is None:
+            seconds=abs(position-tetris.position)/STEP_RATE
+        tetris.moves+=1
+        tetris.moving=True
+        self.after(seconds, self.finishMove, tetris, tetris.moves, position)
+
+    def finishMove(self, tetris, move, position):
+        if tetris.moves!=move:
+            return
+        tetris.moving=False
+        tetris.position=position
+
+    def commandCS(self, arg):
+        self.online=True
+        return ''
+
+    def commandDS(self, arg):
+        self.online=False
+        return ''
+
+    def commandPV(self, arg):
+        return VERSION_STRING
+
+    def commandTE(self, arg):
+        return '%.4f' % TEMPERATURE
+
+    def commandTS(self, arg):
+        bits=lambda f: sum(1<<i for i, t in enumerate(self.tetri) if f(t))
+        status=(self.online<<2)|((self.side=='R')<<1)|self.online
+        return '%i %i %i %i' % (status,
+            bits(lambda t: self.online and (self.activeHold or t.moving)),
+            bits(lambda t: t.calibrated), bits(lambda t: t.moving))
+
+    def commandGH(self, arg):
+        return 'ON' if self.activeHold else 'OFF'
+
+    def commandAH(self, arg):
+        self.activeHold=True
+        return ''
+
+    def commandPH(self, arg):
+        self.activeHold=False
+        return ''
+
+    def commandSG(self, arg):
+        return ', '.join(t.state(str(t.slit() or 'INTERMEDIATE'))
+                         for t in self.axes(arg))
+
+    def commandTD(self, arg):
+        return ', '.join(t.state(str(t.position)) for t in self.axes(arg))
+
+    def commandSD(self, arg):
+        slit=int(arg[1])-1
+        return ', '.join(str(t.slits[slit]) for t in self.axes(arg))
+
+    def commandSS(self, arg):
+        slit=int(arg[1])-1
+        for t in self.axes(arg):
+            t.slits[slit]=int(arg[2:]) if len(arg) > 2 else t.position
+        return ''
+
+    def commandDH(self, arg):
+        tetri=self.axes(arg)
+        if any(t.moving for t in tetri):
+            return None
+        for t in tetri:
+            t.calibrated=True
+            self.move(t, HARDSTOP_POSITION, HARDSTOP_TIME)
+        return ''
+
+    def commandSL(self, arg):
+        if len(arg)==N_TETRI:
+            #A slit for each tetris
+            targets=zip(self.tetri, [int(c)-1 for c in arg])
+        else:
+            targets=[(t, int(arg[1])-1) for t in self.axes(arg)]
+        if any(not 0 <= s < 7 or not t.calibrated or t.moving
+               for t, s in targets):
+            return None
+        for t, s in targets:
+            self.move(t, t.slits[s])
+        return ''
+
+    def commandPA(self, arg):
+        tetri=self.axes(arg)
+        if any(not t.calibrated or t.moving for t in tetri):
+            return None
+        for t in tetri:
+            self.move(t, int(arg[1:]))
+        return ''
+
+    def commandPR(self, arg):
+        tetri=self.axes(arg)
+        if any(t.moving for t in tetri):
+            return None
+        for t in tetri:
+            self.move(t, t.position+int(arg[1:]))
+        return ''
+
+    def commandST(self, arg):
+        for t in self.axes(arg):
+            if t.moving:
+                t.moves+=1
+                t.moving=False
+        return ''
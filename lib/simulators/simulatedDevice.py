@@ -0,0 +1,187 @@
+'''
+Simulated serial device base class
+
+A SimulatedDevice opens a pseudo-terminal and answers the bytes written to
+its slave side, which stands in for the device's serial port: a
+SelectedSerial (or pySerial) connection may be opened on the device's port, or
+on a symlink to it, exactly as on the real hardware. Each device is served by
+its own thread.
+
+Replies are delayed by the latency, a random jitter, and the time to
+transmit them at the device's baud rate, and are sent in order. Each command
+may be dropped (neither executed nor answered) or answered with the device's
+error reply instead of being executed, at the configured rates.
+'''
+import os, tty, time, heapq, random, select, threading, logging
+
+#Seconds to wait in select when no timers are pending
+IDLE_POLL=0.1
+
+class SimulatedDevice(object):
+    """
+    A serial device served on a pseudo-terminal
+
+    Subclasses implement nextCommand() to split a command from the bytes
+    received, answer() to execute it, and errorReply() to reject it. They may
+    use send() for unsolicited output and after() to schedule delayed events
+    (e.g. the end of a move). All of these run in the device's thread.
+    """
+    BAUDRATE=115200
+
+    def __init__(self, name, latency=0.0, jitter=0.0, dropRate=0.0,
+                 errorRate=0.0, timeScale=1.0, seed=None, link=None):
+        """
+        Open the pseudo-terminal for the device
+
+        latency & jitter are in seconds, dropRate & errorRate are the
+        fractions of commands to drop and to reject, timeScale multiplies the
+        time simulated motions take. If link is given a symlink to the port is
+        created there (replacing any existing symlink).
+        """
+        self.name=name
+        self.latency=latency
+        self.jitter=jitter
+        self.dropRate=dropRate
+        self.errorRate=errorRate
+        self.timeScale=timeScale
+        self.random=random.Random(seed)
+        self.logger=logging.getLogger('Sim'+name)
+        self.counts={'commands':0, 'dropped':0, 'errors':0}
+        self._master, self._slave=os.openpty()
+        tty.setraw(self._slave)
+        self.port=os.ttyname(self._slave)
+        self.link=link
+        if link:
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+        self._buffer=''
+        self._timers=[]
+        self._timerCount=0
+        self._txFree=0.0
+        self._running=False
+        self._thread=None
+
+    def __str__(self):
+        if self.link:
+            return '%s on %s (%s)' % (self.name, self.port, self.link)
+        return '%s on %s' % (self.name, self.port)
+
+    def start(self):
+        """ Start serving the device in a daemon thread """
+        self._running=True
+        self._thread=threading.Thread(target=self.serve, name=self.name)
+        self._thread.daemon=True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop serving the device and close the pseudo-terminal """
+        self._running=False
+        if self._thread:
+            self._thread.join()
+            self._thread=None
+        os.close(self._master)
+        os.close(self._slave)
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def serve(self):
+        """ Answer commands & run timers until stopped """
+        while self._running:
+            if self._timers:
+                timeout=max(self._timers[0][0]-time.time(), 0)
+            else:
+                timeout=IDLE_POLL
+            try:
+                readable,junk,junk=select.select([self._master], [], [],
+                                                 min(timeout, IDLE_POLL))
+            except select.error:
+                continue
+            if readable:
+                try:
+                    self.received(os.read(self._master, 4096))
+                except OSError:
+                    #Nothing has the slave open
+                    time.sleep(IDLE_POLL)
+            now=time.time()
+            while self._timers and self._timers[0][0] <= now:
+                junk, junk, func, args=heapq.heappop(self._timers)
+                func(*args)
+
+    def received(self, data):
+        """ Execute & answer each complete command in data """
+        self._buffer+=data
+        while self._buffer:
+            command, consumed=self.nextCommand(self._buffer)
+            if not consumed:
+                break
+            self._buffer=self._buffer[consumed:]
+            if command is None:
+                continue
+            self.counts['commands']+=1
+            r=self.random.random()
+            if r < self.dropRate:
+                self.counts['dropped']+=1
+                self.logger.debug('Dropped %r' % command)
+                continue
+            if r < self.dropRate+self.errorRate:
+                self.counts['errors']+=1
+                self.logger.debug('Rejected %r' % command)
+                reply=self.errorReply(command)
+            else:
+                reply=self.answer(command)
+            if reply:
+                self.send(reply)
+
+    def send(self, data):
+        """ Write data after the reply delay, following anything pending """
+        delay=(self.latency+self.random.uniform(0, self.jitter)+
+               len(data)*10.0/self.BAUDRATE)
+        t=max(time.time()+delay, self._txFree)
+        self._txFree=t
+        self.at(t, self._write, data)
+
+    def _write(self, data):
+        try:
+            os.write(self._master, data)
+        except OSError, e:
+            self.logger.warning('Write failed: %s' % str(e))
+
+    def at(self, t, func, *args):
+        """ Call func(*args) at time t """
+        self._timerCount+=1
+        heapq.heappush(self._timers, (t, self._timerCount, func, args))
+
+    def after(self, seconds, func, *args):
+        """ Call func(*args) in seconds, scaled by timeScale """
+        self.at(time.time()+seconds*self.timeScale, func, *args)
+
+    def nextCommand(self, buffer):
+        """
+        Return (command, number of bytes consumed) for the first command in
+        buffer, consumed is 0 if the command is incomplete and command is None
+        if the bytes consumed should be ignored. Implemented by subclass.
+        """
+        raise NotImplementedError
+
+    def answer(self, command):
+        """ Execute command and return the reply. Implemented by subclass """
+        raise NotImplementedError
+
+    def errorReply(self, command):
+        """ Return the reply to command if rejected, by default none """
+        return ''
+
+
+class TextDevice(SimulatedDevice):
+    """ A device whose commands are lines ending in one of TERMINATORS """
+    TERMINATORS='\n'
+
+    def nextCommand(self, buffer):
+        ends=[i for i in map(buffer.find, self.TERMINATORS) if i!=-1]
+        if not ends:
+            return None, 0
+        end=min(ends)
+        command=buffer[:end].strip()
+        return (command if command else None), end+1
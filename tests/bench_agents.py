@@ -0,0 +1,255 @@
+#!/usr/bin/env python2.7
+"""
+End-to-end command latency benchmark of the agent stack
+
+Serves simulated galils & shoes (see lib/simulators), launches the director
+and the agents from bin/ on their m2fs_socket.conf ports with the simulated
+devices, then sends each command of the mix to the director at its fixed
+rate for the duration. Commands are pipelined with request IDs, so a slow
+reply delays no other command (up to MAX_IN_FLIGHT outstanding). Latency is
+measured from the time each command was scheduled to be sent, so sends
+delayed by a backlog count against it. Each command is sent once before
+timing starts, so the agents have connected to their devices. The agents
+run from a scratch copy of conf/ & plates/, so simulated positions, logs,
+and the plate index never touch the checkout.
+
+Reports the throughput and the p50, p95, & p99 latency of each command and
+saves them, with the commit and options, as JSON.
+
+Usage: bench_agents.py [--duration S] [--mix 'COMMAND@RATE' ...]
+    [--latency S] [--time-scale F] [--out FILE] [--no-launch]
+"""
+import sys, os, time, json, socket, select, shutil, tempfile, argparse
+import subprocess
+sys.path.append(sys.path[0]+'/../lib/')
+sys.path.append(sys.path[0]+'/../bin/')
+import numpy as np
+from m2fsConfig import m2fsConfig
+import hardwareSimulator
+
+ROOT=os.path.abspath(sys.path[0]+'/..')
+DEFAULT_MIX=('STATUS@1', 'GES R ?@5', 'SLITS R ?@5', 'PLATELIST@2',
+             'TEMPS@2')
+SIMULATED=('galilR', 'galilB', 'shoeR', 'shoeB')
+MAX_IN_FLIGHT=16
+STARTUP_TIMEOUT=30.0
+
+def agentCommands(linkDir):
+    """ Return (agent name, argument list) for each agent to launch """
+    return [('GalilAgentR', ['galilAgent.py', '--side', 'R',
+                             '--device', linkDir+'/galilR']),
+            ('GalilAgentB', ['galilAgent.py', '--side', 'B',
+                             '--device', linkDir+'/galilB']),
+            ('ShoeAgentR', ['shoeAgent.py', '--side', 'R',
+                            '--device', linkDir+'/shoeR']),
+            ('ShoeAgentB', ['shoeAgent.py', '--side', 'B',
+                            '--device', linkDir+'/shoeB']),
+            ('SlitController', ['slitController.py']),
+            ('PlugController', ['plugController.py']),
+            ('DataloggerAgent', ['dataloggerAgent.py']),
+            ('Director', ['director.py'])]
+
+def scratchRoot(dir):
+    """
+    Copy conf/ & plates/ into dir and make its logs/, so agents run from dir
+    write last known positions, logs, and the plate index there
+    """
+    for name in ('conf', 'plates'):
+        shutil.copytree(os.path.join(ROOT, name), os.path.join(dir, name))
+    os.mkdir(os.path.join(dir, 'logs'))
+    return dir
+
+def launchAgents(linkDir, logDir):
+    """
+    Start the agents from a scratch root in logDir, return the list of
+    processes
+    """
+    cwd=scratchRoot(logDir)
+    processes=[]
+    for name, argv in agentCommands(linkDir):
+        log=open(os.path.join(logDir, name+'.log'), 'w')
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'bin', argv[0])]+argv[1:]+
+            ['--log', 'ERROR'], cwd=cwd, stdout=log, stderr=subprocess.STDOUT))
+    return processes
+
+def waitForPort(port, process=None, timeout=STARTUP_TIMEOUT):
+    """
+    Return a socket connected to localhost:port, waiting for it to open, or
+    None if process exits first
+    """
+    deadline=time.time()+timeout
+    while True:
+        try:
+            return socket.create_connection(('localhost', port), 1.0)
+        except socket.error:
+            if process is not None and process.poll() is not None:
+                return None
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+def parseMix(mix):
+    """ Return [(command, rate)] from a list of 'COMMAND@RATE' """
+    out=[]
+    for item in mix:
+        command, junk, rate=item.rpartition('@')
+        out.append((command, float(rate)))
+    return out
+
+def warmUp(sock, mix, timeout=STARTUP_TIMEOUT):
+    """
+    Send each command once, waiting for the reply, so the agents' device
+    connections are open before timing
+    """
+    for command, rate in mix:
+        sock.sendall('@0 %s\n' % command)
+        buffer=''
+        deadline=time.time()+timeout
+        while '@0 ' not in buffer and time.time() < deadline:
+            readable,junk,junk=select.select([sock], [], [], 1.0)
+            if readable:
+                buffer+=sock.recv(65536)
+
+def run(sock, mix, duration):
+    """
+    Send the command mix for duration seconds, return {command: latencies}
+    and {command: list of error replies}
+    """
+    start=time.time()+0.5
+    #Each command's sends as (scheduled time, command), in time order
+    schedule=sorted((start+i/rate, command) for command, rate in mix
+                    for i in range(int(duration*rate)))
+    latencies=dict((command, []) for command, rate in mix)
+    errors=dict((command, []) for command in latencies)
+    inFlight={}
+    requestID=0
+    buffer=''
+    sock.setblocking(0)
+    while schedule or inFlight:
+        now=time.time()
+        while schedule and schedule[0][0] <= now and len(inFlight) < MAX_IN_FLIGHT:
+            scheduled, command=schedule.pop(0)
+            requestID+=1
+            inFlight[str(requestID)]=(scheduled, command)
+            sock.sendall('@%i %s\n' % (requestID, command))
+        timeout=max(schedule[0][0]-now, 0) if schedule else 1.0
+        if len(inFlight) >= MAX_IN_FLIGHT:
+            timeout=1.0
+        readable,junk,junk=select.select([sock], [], [], timeout)
+        if not readable:
+            continue
+        data=sock.recv(65536)
+        if not data:
+            raise IOError('Director closed the connection')
+        buffer+=data
+        lines=buffer.split('\n')
+        buffer=lines.pop()
+        now=time.time()
+        for line in lines:
+            if not line.startswith('@'):
+                continue
+            tag,junk,reply=line[1:].partition(' ')
+            if tag not in inFlight:
+                continue
+            scheduled, command=inFlight.pop(tag)
+            latencies[command].append(now-scheduled)
+            if 'ERROR' in reply:
+                errors[command].append(reply)
+    return latencies, errors
+
+def summarize(latencies, errors, duration):
+    results={}
+    for command, times in latencies.items():
+        ms=np.array(times)*1e3
+        results[command]={'count':len(times), 'errors':len(errors[command]),
+                          'throughput':len(times)/duration}
+        if errors[command]:
+            results[command]['first_error']=errors[command][0]
+        if len(times):
+            p50, p95, p99=np.percentile(ms, (50, 95, 99))
+            results[command].update({'p50_ms':p50, 'p95_ms':p95,
+                                     'p99_ms':p99, 'max_ms':ms.max()})
+    return results
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Agent stack latency benchmark')
+    parser.add_argument('--duration', dest='duration', type=float, default=30,
+                        help='seconds to send commands')
+    parser.add_argument('--mix', dest='mix', nargs='+', default=DEFAULT_MIX,
+                        help="commands & rates (per s) as 'COMMAND@RATE'")
+    parser.add_argument('--latency', dest='latency', type=float,
+                        default=0.0, help='simulated device latency (s)')
+    parser.add_argument('--time-scale', dest='timeScale', type=float,
+                        default=0.01, help='simulated motion time multiplier')
+    parser.add_argument('--out', dest='out', default='bench_agents.json',
+                        help='JSON results file')
+    parser.add_argument('--no-launch', dest='launch', action='store_false',
+                        help='use the director & agents already running')
+    args=parser.parse_args()
+    mix=parseMix(args.mix)
+
+    tmp=tempfile.mkdtemp()
+    devices=[]
+    processes=[]
+    failed=[]
+    try:
+        if args.launch:
+            devices=hardwareSimulator.startDevices(SIMULATED, linkDir=tmp,
+                latency=args.latency, timeScale=args.timeScale)
+            processes=launchAgents(tmp, tmp)
+        ports=m2fsConfig.getAgentPorts()
+        #Wait for the agents, then talk to the director
+        for i, (name, argv) in enumerate(agentCommands(tmp)[:-1]):
+            s=waitForPort(ports[name], processes[i] if processes else None)
+            if s is None:
+                print '%s exited, see below' % name
+                failed.append(name)
+            else:
+                s.close()
+        sock=waitForPort(ports['Director'])
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        warmUp(sock, mix)
+        t=time.time()
+        latencies, errors=run(sock, mix, args.duration)
+        elapsed=time.time()-t
+        sock.close()
+    except Exception:
+        failed=[name[:-4] for name in os.listdir(tmp) if name.endswith('.log')]
+        raise
+    finally:
+        for name in failed:
+            log=os.path.join(tmp, name+'.log')
+            if os.path.exists(log):
+                print '---- %s\n%s' % (name, open(log).read())
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+        for p in processes:
+            p.wait()
+        for d in devices:
+            d.stop()
+        shutil.rmtree(tmp)
+
+    results=summarize(latencies, errors, elapsed)
+    print '%-16s %6s %6s %8s %9s %9s %9s' % ('command', 'n', 'errors',
+        'per s', 'p50 ms', 'p95 ms', 'p99 ms')
+    for command, rate in mix:
+        r=results[command]
+        print '%-16s %6i %6i %8.2f %9.2f %9.2f %9.2f' % (command, r['count'],
+            r['errors'], r['throughput'], r.get('p50_ms', np.nan),
+            r.get('p95_ms', np.nan), r.get('p99_ms', np.nan))
+    with open(args.out, 'w') as fp:
+        json.dump({'commit':gitCommit(), 'time':time.time(),
+                   'options':{'duration':args.duration, 'mix':args.mix,
+                              'latency':args.latency,
+                              'timeScale':args.timeScale},
+                   'results':results}, fp, indent=1, sort_keys=True)
+    print 'Saved %s' % args.out
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark Galil reply framing against a pty based fake Galil
+
+Compares the byte at a time receive GalilSerial._send_command_to_galil used
+to do with SelectedSerial.receiveAcknowledgedReplies, for a single command
+and for a multi-statement command string.
+
+Usage: bench_galil_framing.py [-n ITERATIONS] [--latency SECONDS]
+"""
+import sys, os, pty, tty, threading, time, argparse
+sys.path.append(sys.path[0]+'/../lib/')
+from SelectedConnection import SelectedSerial
+
+class FakeGalil(threading.Thread):
+    """
+    Answer \\r terminated, ; separated command strings on a pty like a Galil
+
+    MG statements return data (' 0.2000\\r\\n:'), statements starting with BAD
+    are rejected ('?'), everything else is acknowledged (':').
+    """
+    def __init__(self, latency=0):
+        threading.Thread.__init__(self)
+        self.daemon=True
+        self.latency=latency
+        self.master, slave=pty.openpty()
+        tty.setraw(slave)
+        self.port=os.ttyname(slave)
+        self._slave=slave
+    
+    def reply(self, statement):
+        statement=statement.strip()
+        if statement.startswith('MG'):
+            return ' 0.2000\r\n:'
+        if statement.startswith('BAD'):
+            return '?'
+        return ':'
+    
+    def run(self):
+        buf=''
+        while True:
+            buf+=os.read(self.master, 1024)
+            while '\r' in buf:
+                line,junk,buf=buf.partition('\r')
+                if self.latency:
+                    time.sleep(self.latency)
+                os.write(self.master,
+                         ''.join(self.reply(s) for s in line.split(';')))
+
+class GalilFramedSerial(SelectedSerial):
+    """ SelectedSerial terminating messages with \\r as the Galil requires """
+    def _terminateMessage(self, message):
+        if message[-1] != '\r':
+            message+='\r'
+        return message
+
+def legacy_receive(connection, count):
+    """ The byte at a time receive loop from GalilSerial, for comparison """
+    replies=[]
+    for i in range(count):
+        response=connection.receiveMessageBlocking(nBytes=1)
+        if response in (':', '?'):
+            replies.append(response)
+            continue
+        response+=connection.receiveMessageBlocking()
+        confByte=connection.receiveMessageBlocking(nBytes=1)
+        replies.append(response.strip()+confByte)
+    return replies
+
+def framed_receive(connection, count):
+    return connection.receiveAcknowledgedReplies(count)
+
+def time_exchanges(connection, command_string, receive, iterations):
+    count=command_string.count(';')+1
+    times=[]
+    for i in xrange(iterations):
+        t=time.time()
+        connection.sendMessageBlocking(command_string)
+        replies=receive(connection, count)
+        times.append(time.time()-t)
+        if len(replies)!=count:
+            raise RuntimeError('Got %s for %s' % (replies, command_string))
+    times.sort()
+    return (1000*sum(times)/len(times), 1000*times[len(times)/2],
+            1000*times[int(0.99*(len(times)-1))])
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Galil framing benchmark')
+    parser.add_argument('-n', dest='N', type=int, default=500,
+                        help='exchanges per case')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='fake galil reply latency in seconds')
+    args=parser.parse_args()
+    galil=FakeGalil(latency=args.latency)
+    galil.start()
+    connection=GalilFramedSerial(galil.port, 115200, timeout=0.5)
+    cases=[('single', 'MG m2fsver'),
+           ('multi', 'MG m2fsver;a=1;b=2;MG bootup1;c=3;MG _HX0;d=4;e=5')]
+    print '%-8s %-8s %10s %10s %10s' % ('case', 'method', 'mean(ms)',
+                                        'p50(ms)', 'p99(ms)')
+    for name, command_string in cases:
+        for method, receive in (('legacy', legacy_receive),
+                                ('framed', framed_receive)):
+            print '%-8s %-8s %10.3f %10.3f %10.3f' % ((name, method)+
+                time_exchanges(connection, command_string, receive, args.N))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark FastImageCanvas against the supersampled PIL ImageCanvas
+
+Draws a synthetic hole map (filled science holes, small squares for the
+other holes, & dashed and solid path lines, as Plate.drawImage does) on both
+canvases, reports the time to draw & save and the size of each canvas's
+image buffer, and the mean absolute difference between the two images.
+
+Usage: bench_image_canvas.py [--size PIXELS] [--holes HOLES] [-n RENDERS]
+"""
+import sys, os, time, random, shutil, tempfile, argparse
+sys.path.append(sys.path[0]+'/../lib/hole_mapper/')
+import numpy as np
+import PIL.Image
+import ImageCanvas
+import FastImageCanvas
+
+def makeDrawing(nHoles, seed=1):
+    """ Return a list of (method, args, kw) drawing calls """
+    random.seed(seed)
+    calls=[]
+    holes=[(random.uniform(-.9, .9), random.uniform(-.9, .9))
+           for i in range(nHoles)]
+    for i, pos in enumerate(holes[:256]):
+        color='Blue' if i%2 else 'Red'
+        calls.append(('drawCircle', (pos, .0075), {'outline':color,
+                                                   'fill':color}))
+    for a, b in zip(holes[:256:2], holes[2:256:2]):
+        calls.append(('drawLine', (a, b), {'fill':'Red'}))
+    for pos in holes[0:16]:
+        calls.append(('drawLine', ((-.85, .3), pos), {'fill':'Blue',
+                                                       'dashing':1}))
+    for pos in holes[256:]:
+        calls.append(('drawSquare', (pos, .0025), {'fill':'White',
+                                                   'outline':'White'}))
+    return calls
+
+def render(canvasClass, size, calls, file):
+    t=time.time()
+    canvas=canvasClass(size, size, 1.0, 1.0)
+    for method, args, kw in calls:
+        getattr(canvas, method)(*args, **kw)
+    canvas.save(file)
+    return time.time()-t, canvas
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Hole map canvas benchmark')
+    parser.add_argument('--size', dest='size', type=int, default=768,
+                        help='image size (pixels)')
+    parser.add_argument('--holes', dest='holes', type=int, default=2000,
+                        help='plate holes')
+    parser.add_argument('-n', dest='N', type=int, default=3,
+                        help='renders per canvas')
+    args=parser.parse_args()
+    calls=makeDrawing(args.holes)
+    dir=tempfile.mkdtemp()
+    try:
+        results={}
+        for name, canvasClass in (('ImageCanvas', ImageCanvas.ImageCanvas),
+                                  ('FastImageCanvas',
+                                   FastImageCanvas.FastImageCanvas)):
+            file=os.path.join(dir, name+'.bmp')
+            times=[render(canvasClass, args.size, calls, file)[0]
+                   for i in range(args.N)]
+            canvas=render(canvasClass, args.size, calls, file)[1]
+            if hasattr(canvas, 'image'):
+                nbytes=len(canvas.image.tobytes())
+            else:
+                nbytes=canvas.render().nbytes
+            results[name]=np.asarray(PIL.Image.open(file).convert('RGB'),
+                                     dtype=float)
+            print '%-16s %7.3f s/image  %6.1f MB buffer' % (name, min(times),
+                nbytes/1e6)
+        render(FastImageCanvas.FastImageCanvas, args.size, calls,
+               os.path.join(dir, 'map.svg'))
+        print 'mean abs pixel difference %.2f, svg %i kB' % (
+            np.abs(results['ImageCanvas']-results['FastImageCanvas']).mean(),
+            os.path.getsize(os.path.join(dir, 'map.svg'))/1024)
+    finally:
+        shutil.rmtree(dir)
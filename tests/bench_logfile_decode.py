@@ -0,0 +1,87 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark the bulk datalogger logfile decoder against processLogfile
+
+Writes a synthetic ring buffer logfile of temperature, acceleration, and
+composite records, decodes it with both logfileReader.processLogfile and
+logfileReader.decodeLogfile, checks they agree, and reports the times.
+
+Usage: bench_logfile_decode.py [-n RECORDS] [--keep FILE]
+"""
+import sys, os, struct, time, random, tempfile, argparse
+sys.path.append(sys.path[0]+'/../lib/')
+sys.path.append(sys.path[0]+'/../bin/')
+import numpy as np
+from logfileReader import processLogfile, decodeLogfile
+
+HEADER_ID='R'
+
+def makeRecord(kind, t):
+    """ Return the length prefixed record of kind ('T', 'A', or 'C') at t """
+    temps=struct.pack('<3f', *[random.uniform(-10, 30) for i in range(3)])
+    accels=struct.pack('<96h', *[random.randint(-512, 512) for i in range(96)])
+    stamp=struct.pack('<2I', int(t), random.randint(0, 999))
+    payload={'T':temps+stamp,
+             'A':accels+stamp,
+             'C':temps+accels+stamp}[kind]
+    return chr(len(payload))+payload
+
+def writeLogfile(path, nrecords):
+    """ Write a logfile of nrecords, mostly temperature records """
+    headersize=1+len(HEADER_ID)+12
+    t=1.4e9
+    body=[]
+    for i in range(nrecords):
+        t+=random.uniform(0.5, 5)
+        body.append(makeRecord(random.choice('TTTTAAC'), t))
+    body=''.join(body)
+    wp=headersize+len(body)
+    eof=wp+16
+    rp=wp+1
+    with open(path, 'wb') as f:
+        f.write(chr(headersize)+HEADER_ID+struct.pack('<3I', wp, rp, eof))
+        f.write(body)
+        f.write('\x00'*(eof-wp))
+
+def check(legacy, decoded):
+    """ Verify the bulk decode matches processLogfile """
+    assert len(legacy)==len(decoded['unixtime'])
+    accelRow=dict((j, i) for i, j in enumerate(decoded['accelsIndex']))
+    for i, (unixtime, temps, accels) in enumerate(legacy):
+        assert abs(unixtime-decoded['unixtime'][i]) < 1e-6
+        if temps is None:
+            assert np.isnan(decoded['temps'][i]).all()
+        else:
+            assert np.allclose(temps, decoded['temps'][i])
+        if accels is None:
+            assert i not in accelRow
+        elif temps is None:
+            #processLogfile decodes composite record accels from the wrong
+            # offset, so only compare acceleration only records
+            assert np.allclose(accels, decoded['accels'][accelRow[i]])
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Logfile decode benchmark')
+    parser.add_argument('-n', dest='N', type=int, default=50000,
+                        help='records in the synthetic logfile')
+    parser.add_argument('--keep', dest='keep', default='',
+                        help='write the synthetic logfile here & keep it')
+    args=parser.parse_args()
+    path=args.keep or tempfile.mktemp(suffix='.log')
+    writeLogfile(path, args.N)
+    try:
+        print 'Logfile: %i records, %.1f MB' % (args.N,
+                                               os.path.getsize(path)/1e6)
+        t=time.time()
+        legacy=processLogfile(path)
+        legacyTime=time.time()-t
+        t=time.time()
+        decoded=decodeLogfile(path)
+        bulkTime=time.time()-t
+        check(legacy, decoded)
+        print 'processLogfile: %8.3f s' % legacyTime
+        print 'decodeLogfile:  %8.3f s (%.0fx)' % (bulkTime,
+                                                   legacyTime/bulkTime)
+    finally:
+        if not args.keep:
+            os.remove(path)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2.7
+"""
+Microbenchmark LoggerRecord.fromDataloggerData against the construct parsers
+
+Decodes random temperature, acceleration, and composite records with the
+construct based parse fromDataloggerData used to do and with the current
+struct/numpy implementation, checks they agree, and reports records/second.
+
+Usage: bench_logger_record.py [-n RECORDS]
+"""
+import sys, struct, time, random, argparse
+sys.path.append(sys.path[0]+'/../lib/')
+import numpy as np
+import LoggerRecord
+from LoggerRecord import (tempsParser, accelsParser, unsigned32BitParser,
+                          ACCELS_TO_GEES, N_TEMP_SENSORS,
+                          COMPOSITE_RECORD_LENGTH, ACCEL_RECORD_LENGTH)
+
+def makeRecord(kind):
+    """ Return the raw data of a record of kind 'T', 'A', or 'C' """
+    temps=struct.pack('<3f', *[random.uniform(-10, 30) for i in range(3)])
+    accels=struct.pack('<96h', *[random.randint(-512, 512) for i in range(96)])
+    stamp=struct.pack('<2I', int(time.time()), random.randint(0, 999))
+    return {'T':temps+stamp, 'A':accels+stamp, 'C':temps+accels+stamp}[kind]
+
+def legacyParse(data):
+    """ The construct parse fromDataloggerData used to do """
+    if len(data)==COMPOSITE_RECORD_LENGTH:
+        temps=tempsParser(data[0:4*N_TEMP_SENSORS+1])
+        accels=accelsParser(data[0:-8])
+    elif len(data)==ACCEL_RECORD_LENGTH:
+        temps=None
+        accels=accelsParser(data[0:-8])
+    else:
+        temps=tempsParser(data[0:-8])
+        accels=None
+    unixtime=float(unsigned32BitParser(data[-8:-4]))
+    unixtime+=float(unsigned32BitParser(data[-4:]) % 1000) /1000
+    if accels !=None:
+        accels=ACCELS_TO_GEES*np.array(accels).reshape([32,3])
+    return unixtime, temps, accels
+
+def rate(func, records):
+    t=time.time()
+    for data in records:
+        func(data)
+    return len(records)/(time.time()-t)
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='LoggerRecord decode benchmark')
+    parser.add_argument('-n', dest='N', type=int, default=20000,
+                        help='records per case')
+    args=parser.parse_args()
+    for kind, name in (('T', 'temps'), ('A', 'accels'), ('C', 'composite')):
+        records=[makeRecord(kind) for i in range(args.N)]
+        for data in records[:100]:
+            unixtime, temps, accels=legacyParse(data)
+            r=LoggerRecord.fromDataloggerData('B', data)
+            assert r.unixtime==unixtime
+            if kind=='A':
+                assert (r.sideB['accels']==accels).all()
+        before=rate(legacyParse, records)
+        after=rate(lambda d: LoggerRecord.fromDataloggerData('B', d), records)
+        print '%-9s before: %8.0f rec/s  after: %8.0f rec/s  (%.1fx)' % (
+            name, before, after, after/before)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark plate file loading with plateReader against PlateConfigParser
+
+Writes a synthetic format 0.3 plate with many plate holes and several setups
+of 256 targets & a few guides, loads it with the PlateConfigParser based load
+PlugPlate used to do and with plate.Plate, checks they agree, and reports
+loads/second.
+
+Usage: bench_plate_parse.py [--holes HOLES] [--setups SETUPS] [-n LOADS]
+"""
+import sys, os, time, random, shutil, tempfile, argparse
+sys.path.append(sys.path[0]+'/../lib/')
+import plate
+from plate import PlateConfigParser, ORDERED_FIBER_NAMES
+
+HOLE_FMT='{:>8.4f} {:>8.4f} {:>8.4f} {:>7.4f} {:>5}'
+TARGET_FMT=('{:>23} {:>12} {:>12} {:>7} {:>4} {:>8} {:>5} '
+            '{:>8.4f} {:>8.4f} {:>8.4f} {:>7.4f}')
+GUIDE_FMT='{:>12} {:>12} {:>7} {:>5} {:>8.4f} {:>8.4f} {:>8.4f} {:>7.4f}'
+
+def randomHole():
+    return [random.uniform(-14, 14), random.uniform(-14, 14),
+            random.uniform(-1, 0), random.choice([0.0845, 0.1685])]
+
+def writePlate(file, nHoles, nSetups):
+    with open(file, 'w') as fp:
+        fp.write('[Plate]\nformatversion = 0.3\nname = Bench\n'
+                 'std_offset = 0.5\n')
+        fp.write('[PlateHoles]\nH    : x y z r type\n')
+        types=['C', 'F', 'T', 'O']+['S']*(nHoles-4)
+        for i, t in enumerate(types):
+            fp.write('H{:<3}: '.format(i+1)+HOLE_FMT.format(*(randomHole()+[t]))
+                     +'\n')
+        for s in range(1, nSetups+1):
+            fp.write('[Setup{0}]\nname = Setup {0}\n'
+                     '(ra,de) = (10:00:00.0, -30:00:00.0)\n'
+                     '(az,el) = (0, 90)\nepoch = 2000.0\n'.format(s))
+            fp.write('[Setup{}:Targets]\nH     : '.format(s)+
+                     ' '.join(['id','ra','de','ep','slit','priority','type',
+                               'x','y','z','r'])+'\n')
+            for i, fiber in enumerate(ORDERED_FIBER_NAMES):
+                id='T{}_{}'.format(s, i) if i%16 else '-'
+                fp.write('{:<6}: '.format(fiber)+TARGET_FMT.format(id,
+                         '10:00:00.00', '-30:00:00.0', '2000', '180', '1', 'T',
+                         *randomHole())+'\n')
+            fp.write('[Setup{}:Guide]\nH  : ra de ep type x y z r\n'.format(s))
+            for i in range(4):
+                fp.write('G{:<2}: '.format(i+1)+GUIDE_FMT.format(
+                         '10:00:00.00', '-30:00:00.0', '2000', 'G',
+                         *randomHole())+'\n')
+
+def legacyLoad(file):
+    """ The parse PlugPlate used to do, returns holes, {setup:targets} """
+    plateConfig=PlateConfigParser(file)
+    holes=plateConfig.get_plate_holes()
+    [x for x in holes if x['type']=='C'][0]
+    [x for x in holes if x['type'] in 'FT']
+    setups={}
+    for setup in plateConfig.setup_sections():
+        attrib=plateConfig.setup_attrib(setup)
+        targets=plateConfig.get_targets(setup)
+        plateConfig.get_guides(setup)
+        setups[attrib['name']]=targets
+    return holes, setups
+
+def rate(func, file, n):
+    t=time.time()
+    for i in range(n):
+        func(file)
+    return n/(time.time()-t)
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Plate load benchmark')
+    parser.add_argument('--holes', dest='holes', type=int, default=5000,
+                        help='plate holes')
+    parser.add_argument('--setups', dest='setups', type=int, default=4,
+                        help='setups')
+    parser.add_argument('-n', dest='N', type=int, default=10,
+                        help='loads per case')
+    args=parser.parse_args()
+    dir=tempfile.mkdtemp()
+    try:
+        file=os.path.join(dir, 'bench.plate')
+        writePlate(file, args.holes, args.setups)
+        holes, setups=legacyLoad(file)
+        p=plate.Plate(file)
+        assert list(p.plate_holes)==holes
+        for name, targets in setups.items():
+            assert list(p.getSetup(name)._target_list)==targets
+            assert (p.getSetup(name).get_nominal_fiber_hole_dict()==
+                    {t['fiber']:t['id'] for t in targets if t['id']})
+        before=rate(legacyLoad, file, args.N)
+        after=rate(plate.Plate, file, args.N)
+        print '%i holes, %i setups  before: %6.1f loads/s  after: %6.1f loads/s'\
+              '  (%.1fx)' % (args.holes, args.setups, before, after,
+                             after/before)
+    finally:
+        shutil.rmtree(dir)
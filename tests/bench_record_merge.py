@@ -0,0 +1,100 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark LoggerRecord.RecordMerger against the old list based merge
+
+Feeds synthetic LoggerRecords (temperatures from both loggers and the agents,
+and accelerations from both loggers, as a reconnecting logger dumping its
+backlog would) through the sort, groupby, merge, and list.remove pass
+DataloggerAgent.run used to do and through RecordMerger, checks they produce
+the same number of records, and reports records/second.
+
+The old merge is O(n^2), so by default it is only run on the first 20000
+records.
+
+Usage: bench_record_merge.py [-n RECORDS] [--legacy-max RECORDS]
+"""
+import sys, time, random, argparse
+from itertools import groupby
+from operator import attrgetter
+sys.path.append(sys.path[0]+'/../lib/')
+import numpy as np
+from LoggerRecord import LoggerRecord, RecordMerger, Unmergable
+
+ACCELS=np.zeros((32,3))
+
+def makeRecords(n):
+    """ Return n records at ~1 s intervals in shuffled (arrival) order """
+    t=1.4e9
+    records=[]
+    for i in range(n):
+        t+=random.uniform(0.1, 2)
+        kind=random.choice(['R', 'B', 'RA', 'BA', 'SH'])
+        if kind=='R':
+            r=LoggerRecord(t, echelleRTemp=20.0, prismRTemp=20.1,
+                           loresRTemp=20.2)
+        elif kind=='B':
+            r=LoggerRecord(t, echelleBTemp=20.0, prismBTemp=20.1,
+                           loresBTemp=20.2)
+        elif kind=='RA':
+            r=LoggerRecord(t, accelsR=ACCELS)
+        elif kind=='BA':
+            r=LoggerRecord(t, accelsB=ACCELS)
+        else:
+            r=LoggerRecord(t, shackhartmanTemp=19.0, cradleRTemp=18.0,
+                           cradleBTemp=18.1)
+        records.append(r)
+    random.shuffle(records)
+    return records
+
+def legacyMerge(records):
+    """ The merge DataloggerAgent.run used to do """
+    records.sort(key=attrgetter('unixtime'))
+    toRemove=[]
+    for minute, group in groupby(records, lambda x: int(x.unixtime)/60):
+        recordGroup=list(group)
+        if len(recordGroup) == 1:
+            pass
+        else:
+            for record in recordGroup[1:]:
+                try:
+                    recordGroup[0].merge(record)
+                    toRemove.append(record)
+                except Unmergable:
+                    pass
+    if toRemove:
+        map(records.remove, toRemove)
+    return records
+
+def streamingMerge(records):
+    records.sort(key=attrgetter('unixtime'))
+    merger=RecordMerger()
+    for record in records:
+        merger.add(record)
+    return merger.flush()
+
+def timeMerge(func, n, seed):
+    random.seed(seed)
+    records=makeRecords(n)
+    t=time.time()
+    merged=func(records)
+    return len(merged), n/(time.time()-t)
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Record merge benchmark')
+    parser.add_argument('-n', dest='N', type=int, default=100000,
+                        help='records to merge')
+    parser.add_argument('--legacy-max', dest='legacyMax', type=int,
+                        default=20000, help='records for the old merge')
+    args=parser.parse_args()
+    nLegacy=min(args.N, args.legacyMax)
+    legacyCount, legacyRate=timeMerge(legacyMerge, nLegacy, 1)
+    count, rate=timeMerge(streamingMerge, nLegacy, 1)
+    assert count==legacyCount
+    print 'old merge:       %7i records -> %7i, %8.0f rec/s' % (nLegacy,
+        legacyCount, legacyRate)
+    print 'RecordMerger:    %7i records -> %7i, %8.0f rec/s' % (nLegacy,
+        count, rate)
+    if args.N > nLegacy:
+        count, rate=timeMerge(streamingMerge, args.N, 1)
+        print 'RecordMerger:    %7i records -> %7i, %8.0f rec/s' % (args.N,
+            count, rate)
@@ -0,0 +1,60 @@
+import sys, os, time, shutil, tempfile
+import unittest
+sys.path.append(sys.path[0]+'/../bin/')
+sys.path.append(sys.path[0]+'/../lib/')
+from m2fsConfig import m2fsConfig
+import galil
+import simulators
+from galilAgent import PositionPoller, POSITION_AXES
+
+class TestPositionPoller(unittest.TestCase):
+
+    def setUp(self):
+        #Keep the simulated last known positions out of the real conf/
+        self.confDir=tempfile.mkdtemp()
+        conf=os.path.join(self.confDir, 'conf')+os.sep
+        shutil.copytree(m2fsConfig.getConfDir(), conf)
+        self.getConfDir=m2fsConfig.__dict__['getConfDir']
+        m2fsConfig.getConfDir=staticmethod(lambda: conf)
+        self.sim=simulators.GalilSimulator('galilR', timeScale=0.01).start()
+        self.galil=galil.GalilSerial(self.sim.port, 'R')
+        queries={'FILTER':self.galil.get_filter, 'LREL':self.galil.get_loel,
+                 'HREL':self.galil.get_hrel, 'HRAZ':self.galil.get_hraz,
+                 'FOCUS':self.galil.get_foc, 'GES':self.galil.get_ges,
+                 'FLSIM':self.galil.get_flsim}
+        self.poller=PositionPoller(self.galil, queries, 0.05)
+        self.poller.start()
+
+    def tearDown(self):
+        self.poller.stop()
+        self.galil.close()
+        self.sim.stop()
+        m2fsConfig.getConfDir=self.getConfDir
+        shutil.rmtree(self.confDir)
+
+    def waitForCycle(self):
+        cycle=self.poller.cycles
+        deadline=time.time()+5
+        while self.poller.cycles < cycle+2 and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_snapshot(self):
+        """ Test every axis is polled and served from the snapshot """
+        self.waitForCycle()
+        self.assertEqual([p[0] for p in self.poller.positions()],
+                         list(POSITION_AXES))
+        self.assertEqual(self.poller.get('FILTER'), '9')
+        self.assertEqual(self.poller.get('GES'), 'LORES')
+
+    def test_invalidate(self):
+        """ Test a command discards the snapshot until the next poll """
+        self.waitForCycle()
+        with self.galil.rlock:
+            self.assertEqual(self.galil.set_filter('3'), 'OK')
+            self.poller.invalidate()
+        self.assertEqual(self.poller.get('FILTER'), None)
+        self.waitForCycle()
+        self.assertEqual(self.poller.get('FILTER'), 'MOVING')
+
+if __name__ == '__main__':
+    unittest.main()
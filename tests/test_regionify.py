@@ -0,0 +1,197 @@
+import sys, os, math, random, shutil, tempfile
+import unittest
+sys.path.append(sys.path[0]+'/../lib/hole_mapper/')
+import Plate
+from Hole import Hole
+
+#The list based region division and group assignment Plate used before
+# regionify was vectorized, the reference the groupings are checked against
+def legacySplitVertically((holes, (x0,y0,x1,y1)), nminr=8):
+    if len(holes) <= nminr:
+        return [(holes,(x0,y0,x1,y1))]
+    holes=sorted(holes, Hole.holeCompareX)
+    nr2=nminr*(len(holes)/nminr/2)+len(holes)%nminr
+    splitx=(holes[-nr2-1].x+holes[-nr2].x)/2.0
+    return [(holes[0:-nr2],(x0,y0,splitx,y1)),
+            (holes[-nr2:],(splitx,y0,x1,y1))]
+
+def legacySplitHorizontally((holes, (x0,y0,x1,y1)), nminr=16):
+    if len(holes) <= nminr:
+        return [(holes,(x0,y0,x1,y1))]
+    holes=sorted(holes, Hole.holeCompareY)
+    nr2=nminr*(len(holes)/nminr/2)+len(holes)%nminr
+    splity=(holes[-nr2-1].y+holes[-nr2].y)/2.0
+    return [(holes[0:-nr2],(x0,y0,x1,splity)),
+            (holes[-nr2:],(x0,splity,x1,y1))]
+
+def legacyDivideRegion(region):
+    tmpr=legacySplitHorizontally(region)
+    if len(tmpr)==1:
+        return legacySplitVertically(tmpr[0])
+    return legacyDivideRegion(tmpr[0])+legacyDivideRegion(tmpr[1])
+
+def legacyRegions2groups(channel, regions):
+    groups=[]
+
+    regionxctr=[math.fsum([h.x for h in r[0]])/float(len(r[0])) for r in regions]
+    num_left=sum([a > 0.0 for a in regionxctr])
+    num_right=len(regions)-num_left
+
+    regions.sort(key=lambda r:math.fsum([h.x for h in r[0]])/float(len(r[0])),reverse=True)
+
+    num_left = min(8, num_left) + max(0, num_right - 8)
+
+    left=regions[0:num_left]
+    right=regions[num_left:]
+
+    left.sort(lambda a,b: -cmp(a[1][1]+a[1][3],b[1][1]+b[1][3]))
+    right.sort(lambda a,b: -cmp(a[1][1]+a[1][3],b[1][1]+b[1][3]))
+
+    nextbundle=0
+    numbundles=len(Plate.Plate.FIBER_BUNDLES[channel][0])
+    while len(left):
+        assert len(left) <= numbundles-nextbundle
+        if len(left) ==  numbundles-nextbundle:
+            for g in left:
+                groups.append(Plate.Plate.initializeGroup(
+                                Plate.Plate.FIBER_BUNDLES[channel][0][nextbundle],
+                                g[0], g[1], 'left', channel))
+                nextbundle+=1
+            break
+        else:
+            groupy=max(left[0][0],key=lambda a:a.x).y
+            angleoffvert=math.degrees(math.pi/2 -
+                            math.asin(groupy/Plate.Plate.LABEL_RADIUS))
+            tmp=max(angleoffvert/Plate.Plate.LABEL_INC-1,0)
+
+            bundlenum = min(round(tmp), numbundles-len(left) )
+            bundlenum = int(max(bundlenum, nextbundle))
+
+            groups.append(Plate.Plate.initializeGroup(
+                            Plate.Plate.FIBER_BUNDLES[channel][0][bundlenum],
+                            left[0][0], left[0][1], 'left', channel))
+
+            nextbundle=bundlenum+1
+
+            left.pop(0)
+
+    nextbundle=0
+    numbundles=len(Plate.Plate.FIBER_BUNDLES[channel][1])
+    while len(right):
+        assert len(right) <= numbundles-nextbundle
+        if len(right) == numbundles-nextbundle:
+            for g in right[:]:
+                groups.append(Plate.Plate.initializeGroup(
+                                Plate.Plate.FIBER_BUNDLES[channel][1][nextbundle],
+                                g[0], g[1], 'right', channel))
+                nextbundle+=1
+            break
+        else:
+            groupy=min(right[0][0],key=lambda a:a.x).y
+            angleoffvert=math.degrees(math.pi/2 -
+                            math.asin(groupy/Plate.Plate.LABEL_RADIUS))
+
+            tmp=(angleoffvert-Plate.Plate.LABEL_INC)/Plate.Plate.LABEL_INC
+
+            bundlenum = min(round(tmp), numbundles-len(right) )
+            bundlenum = int(max(bundlenum, nextbundle))
+
+            groups.append(Plate.Plate.initializeGroup(
+                            Plate.Plate.FIBER_BUNDLES[channel][1][bundlenum],
+                            right[0][0], right[0][1], 'right', channel))
+
+            nextbundle=bundlenum+1
+            right.pop(0)
+
+    return groups
+
+def legacyFindPathOrder(holeList, plateSide):
+    if plateSide == 'left':
+        return sorted(holeList, lambda a,b: -cmp(a.x,b.x))
+    return sorted(holeList, lambda a,b: cmp(a.x,b.x))
+
+def randomHoles(n, seed, decimals=None):
+    """ n holes within the label radius, optionally rounded to force ties """
+    random.seed(seed)
+    holes=[]
+    while len(holes) < n:
+        x, y=random.uniform(-.8, .8), random.uniform(-.8, .8)
+        if decimals is not None:
+            x, y=round(x, decimals), round(y, decimals)
+        if math.hypot(x, y) < .8:
+            holes.append(Hole(x, y, .006, idstr=str(len(holes))))
+    return holes
+
+def describe(groups):
+    return [(g['fiber_group'], [h.idstr for h in g['holes']], g['region'],
+             g['side'], g['path']) for g in groups]
+
+
+class TestRegionify(unittest.TestCase):
+
+    BOX=(-Plate.Plate.RADIUS,-Plate.Plate.RADIUS,
+         Plate.Plate.RADIUS,Plate.Plate.RADIUS)
+
+    def assertSameRegions(self, holes):
+        old=legacyDivideRegion((holes, self.BOX))
+        new=Plate.Plate.divideRegion((holes, self.BOX))
+        self.assertEqual([([h.idstr for h in r[0]], r[1]) for r in old],
+                         [([h.idstr for h in r[0]], r[1]) for r in new])
+
+    def test_divide_region(self):
+        """ Test divideRegion splits as the list implementation did """
+        for n in (1, 8, 9, 16, 17, 31, 32, 33, 100, 128):
+            for seed in range(5):
+                self.assertSameRegions(randomHoles(n, seed))
+
+    def test_divide_region_ties(self):
+        """ Test holes with equal coordinates split in the same order """
+        for seed in range(10):
+            self.assertSameRegions(randomHoles(128, seed, decimals=1))
+
+    def test_regions2groups(self):
+        """ Test the regions are ordered and grouped as before """
+        for seed in range(10):
+            holes=randomHoles(128, seed, decimals=2)
+            regions=legacyDivideRegion((holes, self.BOX))
+            self.assertEqual(
+                describe(Plate.Plate.regions2groups('armR', list(regions))),
+                describe(legacyRegions2groups('armR', list(regions))))
+
+    def test_regionify(self):
+        """ Test regionify on a loaded plate matches the legacy pipeline """
+        dir=tempfile.mkdtemp()
+        try:
+            random.seed(1)
+            with open(os.path.join(dir, 'T_Sum.asc'), 'w') as asc:
+                with open(os.path.join(dir, 'T_plate.res'), 'w') as res:
+                    for s in (1, 2):
+                        asc.write('Setup %d\n' % s)
+                        res.write('hdr\nhdr\nhdr\n')
+                        for h in randomHoles(200, s, decimals=2):
+                            asc.write('%8.4f %8.4f %8.4f %8.4f  S   B-01-01'
+                                '    %s\n' % (h.x*Plate.Plate.SCALE,
+                                h.y*Plate.Plate.SCALE, -.2, .17,
+                                random.choice('RB')))
+                        res.write('END\n')
+            p=Plate.Plate()
+            p.loadHoles(os.path.join(dir, 'T_Sum.asc'))
+        finally:
+            shutil.rmtree(dir)
+        for name, setup in p.setups.items():
+            expected=[]
+            for c in setup['channels']:
+                holes=[h for h in setup['channels'][c] if h.inRegion(self.BOX)]
+                regions=legacyDivideRegion((holes, self.BOX))
+                expected.extend(legacyRegions2groups(c, regions))
+            for g in expected:
+                g['holes']=legacyFindPathOrder(g['holes'], g['side'])
+                g['path']=[[a.position(), b.position()]
+                           for a, b in zip(g['holes'], g['holes'][1:])]
+                if len(g['holes'])==1:
+                    g['path']=[[g['holes'][0].position()]]
+            p.regionify(active_setup=name)
+            self.assertEqual(describe(setup['groups']), describe(expected))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import sys, time
+import unittest
+sys.path.append(sys.path[0]+'/../lib/')
+import SelectedConnection
+import galil
+import simulators
+
+class TestGalilSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.sim=simulators.GalilSimulator('galilR', timeScale=0.01).start()
+        self.galil=galil.GalilSerial(self.sim.port, 'R')
+
+    def tearDown(self):
+        self.galil.close()
+        self.sim.stop()
+
+    def test_connect(self):
+        """ Test GalilSerial connects and programs the defaults """
+        self.assertTrue(self.galil.isOpen())
+        self.assertEqual(self.sim.variables['bootup1'], 0)
+        self.assertIn('felencp[0]', self.sim.variables)
+        self.assertEqual(self.sim.variables['cfgsum'], self.galil.cfgsum)
+
+    def test_reconnect(self):
+        """ Test a reconnect only programs the defaults if they changed """
+        self.galil.close()
+        self.sim.variables['felencp[0]']=0.0
+        self.galil=galil.GalilSerial(self.sim.port, 'R')
+        self.assertEqual(self.sim.variables['felencp[0]'], 0.0)
+        self.galil.close()
+        self.sim.variables['cfgsum']=0.0
+        self.galil=galil.GalilSerial(self.sim.port, 'R')
+        self.assertNotEqual(self.sim.variables['felencp[0]'], 0.0)
+
+    def test_motion(self):
+        """ Test a move runs on a thread, reports MOVING, then the position """
+        self.assertEqual(self.galil.set_filter('3'), 'OK')
+        self.assertEqual(self.sim.threads[3], 'PICKFIL')
+        self.assertEqual(self.galil.get_filter(), 'MOVING')
+        time.sleep(0.2)
+        self.assertEqual(self.galil.get_filter(), '3')
+        self.assertEqual(self.sim.threads[3], None)
+
+    def test_reprogram_waits_for_motion(self):
+        """ Test changed defaults aren't programmed during a move """
+        self.assertEqual(self.galil.set_filter('3'), 'OK')
+        self.sim.variables['cfgsum']=0.0
+        self.sim.variables['felencp[0]']=0.0
+        self.galil._initialize_galil()
+        self.assertEqual(self.sim.variables['felencp[0]'], 0.0)
+        time.sleep(0.2)
+        self.galil._initialize_galil()
+        self.assertNotEqual(self.sim.variables['felencp[0]'], 0.0)
+
+    def test_state_cache(self):
+        """ Test status queries reuse the thread statuses until a motion """
+        self.galil.get_filter()
+        commands=self.sim.counts['commands']
+        self.galil.get_filter()
+        self.assertEqual(self.sim.counts['commands']-commands, 1)
+        self.galil.set_filter('3')
+        commands=self.sim.counts['commands']
+        self.assertEqual(self.galil.get_filter(), 'MOVING')
+        self.assertEqual(self.sim.counts['commands']-commands, 3)
+
+    def test_error_injection(self):
+        """ Test rejected commands are answered with ? """
+        self.sim.errorRate=1.0
+        self.assertRaises(galil.GalilCommandNotAcknowledgedError,
+                          self.galil._send_command_to_galil, 'MG _AB;MG _AB')
+
+
+class TestShoeSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.sim=simulators.ShoeSimulator('shoeR', timeScale=0.001).start()
+        self.shoe=SelectedConnection.SelectedSerial(self.sim.port, 115200,
+                                                    timeout=1)
+
+    def tearDown(self):
+        self.shoe.close()
+        self.sim.stop()
+
+    def command(self, command):
+        self.shoe.sendMessageBlocking(command)
+        return self.shoe.receiveAcknowledgedReplies(1)[0][:2]
+
+    def test_offline(self):
+        """ Test motion commands need the shoe to be connected """
+        self.assertEqual(self.command('PV'), (':', 'Fibershoe v1.3'))
+        self.assertEqual(self.command('SLA1'), (':', 'Powered Down'))
+        self.assertEqual(self.command('XX'), ('?', ''))
+
+    def test_slits(self):
+        """ Test slits may be set once the tetri are calibrated """
+        self.command('CS')
+        self.assertEqual(self.command('SLA1'), ('?', ''))
+        self.assertEqual(self.command('DH*'), (':', ''))
+        self.assertEqual(self.command('TS'), (':', '7 255 255 255'))
+        time.sleep(0.1)
+        self.assertEqual(self.command('SL12345671'), (':', ''))
+        time.sleep(0.1)
+        self.assertEqual(self.command('SG*'),
+                         (':', '1, 2, 3, 4, 5, 6, 7, 1'))
+
+
+class TestPololuSimulators(unittest.TestCase):
+
+    def test_maestro(self):
+        """ Test a servo slews to its target """
+        sim=simulators.MaestroSimulator('guider', timeScale=0.01).start()
+        try:
+            maestro=SelectedConnection.SelectedSerial(sim.port, 115200,
+                                                      timeout=1)
+            maestro.sendMessageBlocking('\x84\x01\x40\x3e')
+            time.sleep(0.1)
+            maestro.sendMessageBlocking('\x90\x01')
+            self.assertEqual(maestro.receiveMessageBlocking(nBytes=2),
+                             '\x40\x1f')
+            maestro.close()
+        finally:
+            sim.stop()
+
+    def test_smc(self):
+        """ Test the lenslet drives out to the limit """
+        sim=simulators.SMCSimulator('shLenslet', timeScale=0.01).start()
+        try:
+            smc=SelectedConnection.SelectedSerial(sim.port, 115200, timeout=1)
+            smc.sendMessageBlocking('\x89\x7f')
+            time.sleep(0.1)
+            smc.sendMessageBlocking('\xa1\x0c')
+            self.assertEqual(smc.receiveMessageBlocking(nBytes=2), '\xff\x0f')
+            smc.sendMessageBlocking('\xa1\x15')
+            self.assertEqual(smc.receiveMessageBlocking(nBytes=2), '\x00\x00')
+            smc.close()
+        finally:
+            sim.stop()
+
+if __name__ == '__main__':
+    unittest.main()